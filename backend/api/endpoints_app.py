@@ -1,9 +1,17 @@
-from fastapi import APIRouter, Depends, UploadFile, File, Form, HTTPException, status
+from fastapi import APIRouter, Depends, UploadFile, File, Form, Query, HTTPException, status
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from backend.utils import util
-from backend.utils.db_session import get_db
-from sqlalchemy.orm import Session
+from backend.utils.db_session import get_async_db, get_async_read_db, get_pool_stats
+from backend.utils.ingest import ingest_upload
+from backend.utils.food_catalogue import food_catalogue, FOOD_SEARCH_MAX_LIMIT
+from backend.utils import metrics
+from sqlalchemy import Row
+from sqlalchemy.ext.asyncio import AsyncSession
 from pydantic import BaseModel
-from typing import Any, Optional
+from typing import Any, Dict, List, Optional, Literal, Union
+from datetime import date, datetime
+import asyncio
+import pytz
 import shutil
 import os
 from backend.utils.gemini_api import FoodRecognition
@@ -39,6 +47,16 @@ class DietHistoryRequest(BaseModel):
     fat: int
 
 
+class ImageUploadRequest(BaseModel):
+    content_type: str
+    content_length: int  # Bytes, the upload must send exactly this Content-Length
+
+
+class DietHistoryImportRequest(BaseModel):
+    entries: List[Any]  # Validated row by row, see util.parse_import_entry
+    time_zone: str = util.DEFAULT_TIME_ZONE  # For timestamps without an offset
+
+
 class BaseResponse(BaseModel):
     message: str
     data: Optional[Any] = None
@@ -52,6 +70,102 @@ class LoginResponseData(BaseModel):
     jwtToken: str
 
 
+# Response Models (typed so FastAPI serializes them with pydantic-core instead of the generic encoder)
+class UserInfoData(BaseModel):
+    height: Optional[int] = None
+    weight: Optional[int] = None
+    age: Optional[int] = None
+    gender: Optional[str] = None
+    activity_level: Optional[str] = None
+    target: Optional[str] = None
+    preference: Optional[str] = None
+    tdee: Optional[int] = None
+    target_protein: Optional[int] = None
+    target_carbohydrates: Optional[int] = None
+    target_fat: Optional[int] = None
+
+
+class UserInfoDataResponse(BaseResponse):
+    data: UserInfoData
+
+
+class DietHistoryEntry(BaseModel):
+    id: int
+    datetime: datetime
+    meal: Optional[str] = None
+    calories: Optional[int] = None
+    protein: Optional[int] = None
+    carbohydrates: Optional[int] = None
+    fat: Optional[int] = None
+    img_url: Optional[str] = None
+    images: Optional[Dict[str, Dict[str, str]]] = None  # {"thumb"|"card"|"full": {"webp"|"jpg": url}}
+
+
+class DietHistoryData(BaseModel):
+    diet_history: List[DietHistoryEntry]
+    next_cursor: Optional[str] = None
+
+
+class DietHistoryResponse(BaseResponse):
+    data: DietHistoryData
+
+
+class GeminiNutrition(BaseModel):
+    Calories: Union[int, float]
+    Fat: Union[int, float]
+    Protein: Union[int, float]
+    Carbs: Union[int, float]
+
+
+class GeminiFoodItem(BaseModel):
+    label: str
+    bbox: Optional[List[Union[int, float]]] = None  # [ymin, xmin, ymax, xmax], None when the model gave no box
+    nutrition: GeminiNutrition
+    servings: Optional[float] = None  # Estimated portion, 1 = one typical serving
+    source: Optional[Literal["catalogue", "model"]] = None  # Where the nutrition numbers come from
+    food_id: Optional[int] = None  # Matched food_nutrition entry
+
+
+class GeminiAnalysisData(BaseModel):
+    pixel: List[int]  # [width, height]
+    list: List[GeminiFoodItem]
+
+
+class GeminiAnalysisResponse(BaseResponse):
+    data: GeminiAnalysisData
+
+
+class FoodMatch(BaseModel):
+    id: int
+    food: str
+    calories: Optional[int] = None
+    protein: Optional[int] = None
+    carbohydrates: Optional[int] = None
+    fat: Optional[int] = None
+    match: Literal["exact", "prefix", "fuzzy"]
+    score: float  # Trigram similarity between the query and the name
+
+
+class FoodSearchData(BaseModel):
+    foods: List[FoodMatch]
+
+
+class FoodSearchResponse(BaseResponse):
+    data: FoodSearchData
+
+
+class SimilarMeal(DietHistoryEntry):
+    similarity: float  # Cosine similarity between the photos' embeddings
+
+
+class SimilarMealsData(BaseModel):
+    meals: List[SimilarMeal]
+
+
+class SimilarMealsResponse(BaseResponse):
+    data: SimilarMealsData
+
+
 def create_success_response(message: str, data: Optional[Any] = None) -> BaseResponse:
     return BaseResponse(message=message, data=data)
 
@@ -86,9 +200,9 @@ def create_error_response(code: int, details: str) -> HTTPException:
         }
     }
 })
-async def sign_up(signup_request: SignUpRequest, db: Session = Depends(get_db)):
+async def sign_up(signup_request: SignUpRequest, db: AsyncSession = Depends(get_async_db)):
     # Check if the username already exists
-    existing_user = util.get_user_by_username(signup_request.username, db)
+    existing_user = await util.get_user_by_username(signup_request.username, db)
     if existing_user:
         raise create_error_response(
             code=status.HTTP_400_BAD_REQUEST,
@@ -99,7 +213,7 @@ async def sign_up(signup_request: SignUpRequest, db: Session = Depends(get_db)):
     hashed_password = util.hash_password(signup_request.password)
 
     # Save the new user in the database
-    new_user = util.create_user(
+    new_user = await util.create_user(
         username=signup_request.username,
         password=hashed_password,
         db=db
@@ -137,9 +251,9 @@ async def sign_up(signup_request: SignUpRequest, db: Session = Depends(get_db)):
         }
     }
 })
-async def login(login_request: LoginRequest, db: Session = Depends(get_db)):
+async def login(login_request: LoginRequest, db: AsyncSession = Depends(get_async_db)):
     # Authenticate user using the single database
-    auth_result = util.authenticate_user(login_request.username, login_request.password, db)
+    auth_result = await util.authenticate_user(login_request.username, login_request.password, db)
 
     if "error" in auth_result:
         raise create_error_response(
@@ -158,7 +272,7 @@ async def login(login_request: LoginRequest, db: Session = Depends(get_db)):
     )
 
 
-@router.get("/get_user_info", response_model=BaseResponse, responses={
+@router.get("/get_user_info", response_model=UserInfoDataResponse, responses={
     200: {
         "description": "User Info Retrieved Successfully",
         "content": {
@@ -182,41 +296,22 @@ async def login(login_request: LoginRequest, db: Session = Depends(get_db)):
             }
         }
     },
-    404: {
-        "description": "User Info Not Found",
-        "content": {
-            "application/json": {
-                "example": {
-                    "details": "User XXX information not found"
-                }
-            }
-        }
+    304: {
+        "description": "Not Modified - If-None-Match matches the current ETag"
     }
 })
-async def get_user_info(db: Session = Depends(get_db), username: str = Depends(util.get_current_user)):
-    user_info = util.get_user_info(username, db)
-
-    if not user_info:
-        raise create_error_response(
-            code=status.HTTP_404_NOT_FOUND,
-            details=f"User {username} information not found"
-        )
-
+async def get_user_info(
+        db: AsyncSession = Depends(get_async_read_db),
+        current_user: Row = Depends(util.get_current_user),
+        etag_headers: dict = Depends(util.conditional_get)  # 304 when If-None-Match is current
+):
+    # Read from the replica, in the session the ETag's data version was read in. A profile the replica
+    # has not caught up with yet (just signed up) is answered from the principal, read on the primary
+    # get_current_user has already answered 401 for unknown users
+    user_info = await util.get_user_info(current_user.user, db) or current_user
     return create_success_response(
         message="User info retrieved successfully",
-        data=UserInfoResponse(
-            height=user_info.height,
-            weight=user_info.weight,
-            age=user_info.age,
-            gender=user_info.gender,
-            activity_level=user_info.activity_level,
-            target=user_info.target,
-            preference=user_info.preference,
-            tdee=user_info.tdee,
-            target_protein=user_info.target_protein,
-            target_carbohydrates=user_info.target_carbohydrates,
-            target_fat=user_info.target_fat
-        )
+        data=user_info._asdict()
     )
 
 
@@ -242,10 +337,10 @@ async def get_user_info(db: Session = Depends(get_db), username: str = Depends(u
         }
     }
 })
-async def save_user_info(user_info: UserInfoResponse, db: Session = Depends(get_db),
-                         username: str = Depends(util.get_current_user)):
+async def save_user_info(user_info: UserInfoResponse, db: AsyncSession = Depends(get_async_db),
+                         current_user: Row = Depends(util.get_current_user)):
     # Save user info to the database for the current user
-    result = util.save_user_info_to_db(user_info, db, username)
+    result = await util.save_user_info_to_db(user_info, db, current_user.user)
 
     if not result:
         raise create_error_response(
@@ -276,8 +371,18 @@ async def save_user_info(user_info: UserInfoResponse, db: Session = Depends(get_
             }
         }
     },
+    413: {
+        "description": "Image Too Large",
+        "content": {
+            "application/json": {
+                "example": {
+                    "details": "Image must be at most 10485760 bytes"
+                }
+            }
+        }
+    },
     422: {
-        "description": "Unprocessable Entity - Missing Required Data",
+        "description": "Unprocessable Entity - Missing Required Data or Unusable Photo (blurry, dark, empty)",
         "content": {
             "application/json": {
                 "example": {
@@ -289,8 +394,8 @@ async def save_user_info(user_info: UserInfoResponse, db: Session = Depends(get_
 })
 async def analyze(
         food_img: UploadFile = File(None),  # Make food_img optional
-        db: Session = Depends(get_db),
-        user_name: str = Depends(util.get_current_user),
+        db: AsyncSession = Depends(get_async_read_db),
+        current_user: Row = Depends(util.get_current_user),
         manual_protein: int = Form(None),  # Make manual input fields optional
         manual_carbohydrates: int = Form(None),
         manual_fat: int = Form(None),
@@ -305,10 +410,10 @@ async def analyze(
 
     obj = {}
 
-    # If an image is provided, read it
+    # If an image is provided, read it (streamed, capped at DIET_IMAGE_MAX_BYTES)
     if food_img:
-        image_bytes = await food_img.read()
-        obj['img'] = image_bytes
+        image = await ingest_upload(food_img, util.DIET_IMAGE_MAX_BYTES)
+        obj['img'] = image.data
 
     # If manual input is provided, include it in the obj
     if manual_protein and manual_carbohydrates and manual_fat:
@@ -316,13 +421,61 @@ async def analyze(
         obj['carbohydrates'] = manual_carbohydrates
         obj['fat'] = manual_fat
 
-    analysis_result = util.analysis(obj, db, user_name=user_name, time_zone=time_zone)
+    analysis_result = await util.analysis(obj, db, user_info=current_user, time_zone=time_zone)
     return create_success_response(
         message="Analysis completed successfully",
         data={"result": analysis_result}
     )
 
 
+@router.post("/create_image_upload", response_model=BaseResponse, responses={
+    200: {
+        "description": "Presigned Upload Created",
+        "content": {
+            "application/json": {
+                "example": {
+                    "message": "Image upload created",
+                    "data": {
+                        "img_key": "uploads/5e884898da280471/0f8e6c2a4b1d4f0e9d3c2b1a0f9e8d7c.jpg",
+                        "upload_url": "https://example-bucket.s3.amazonaws.com/uploads/...?X-Amz-Signature=...",
+                        "method": "PUT",
+                        "headers": {"Content-Type": "image/jpeg"},
+                        "expires_in": 300
+                    }
+                }
+            }
+        }
+    },
+    413: {
+        "description": "Image Too Large",
+        "content": {
+            "application/json": {
+                "example": {
+                    "details": "Images must be between 1 and 10485760 bytes"
+                }
+            }
+        }
+    },
+    415: {
+        "description": "Unsupported Image Type",
+        "content": {
+            "application/json": {
+                "example": {
+                    "details": "Unsupported image type image/gif"
+                }
+            }
+        }
+    }
+})
+async def create_image_upload(
+        upload_request: ImageUploadRequest,
+        current_user: Row = Depends(util.get_current_user)
+):
+    # The client PUTs the photo straight to storage, then saves the meal with img_key
+    upload = util.create_diet_image_upload(current_user.user, upload_request.content_type, upload_request.content_length)
+    return create_success_response(message="Image upload created", data=upload)
+
+
 @router.post("/save_diet_history", response_model=BaseResponse, responses={
     200: {
         "description": "Diet History Saved Successfully",
@@ -334,6 +487,16 @@ async def analyze(
             }
         }
     },
+    413: {
+        "description": "Image Too Large",
+        "content": {
+            "application/json": {
+                "example": {
+                    "details": "Image must be at most 10485760 bytes"
+                }
+            }
+        }
+    },
     500: {
         "description": "Internal Server Error - Failed to Save Diet History",
         "content": {
@@ -351,24 +514,26 @@ async def save_diet_history(
         protein: int = Form(...),
         carbohydrates: int = Form(...),
         fat: int = Form(...),
-        db: Session = Depends(get_db),
-        username: str = Depends(util.get_current_user)
+        time_zone: str = Form(util.DEFAULT_TIME_ZONE),  # Decides which day the meal counts towards
+        img_key: str = Form(None),  # From /create_image_upload, instead of food_img
+        db: AsyncSession = Depends(get_async_db),
+        current_user: Row = Depends(util.get_current_user)
 ):
-    # If an image is provided, read it
-    if food_img:
-        image_bytes = await food_img.read()
-    else:
-        image_bytes = None
+    # If an image is provided, read it (streamed, capped at DIET_IMAGE_MAX_BYTES)
+    image = await ingest_upload(food_img, util.DIET_IMAGE_MAX_BYTES) if food_img else None
 
-    saved_history = util.save_diet_history(
-        user=username,
+    saved_history = await util.save_diet_history(
+        user=current_user.user,
         meal='lunch',
         calories=calories,
         protein=protein,
         carbohydrates=carbohydrates,
         fat=fat,
-        image_bytes=image_bytes,
+        image_bytes=image.data if image else None,
+        image_sha256=image.sha256 if image else None,
         db=db,
+        time_zone=time_zone,
+        img_key=img_key,
     )
 
     if not saved_history:
@@ -379,7 +544,91 @@ async def save_diet_history(
     return create_success_response(message="Diet history saved successfully")
 
 
-@router.get("/get_diet_history", response_model=BaseResponse, responses={
+@router.post("/import_diet_history", response_model=BaseResponse, responses={
+    200: {
+        "description": "Diet History Imported",
+        "content": {
+            "application/json": {
+                "example": {
+                    "message": "Diet history imported",
+                    "data": {
+                        "imported": 2,
+                        "errors": [
+                            {"row": 1, "error": "calories must be an integer"}
+                        ]
+                    }
+                }
+            }
+        }
+    },
+    413: {
+        "description": "Too Many Entries",
+        "content": {
+            "application/json": {
+                "example": {
+                    "details": "At most 5000 entries per import"
+                }
+            }
+        }
+    }
+})
+async def import_diet_history(
+        import_request: DietHistoryImportRequest,
+        db: AsyncSession = Depends(get_async_db),
+        current_user: Row = Depends(util.get_current_user)
+):
+    # Rows that fail validation or image upload come back in errors, the rest are saved
+    result = await util.import_diet_history(
+        current_user.user, import_request.entries, db, time_zone=import_request.time_zone
+    )
+    return create_success_response(message="Diet history imported", data=result)
+
+
+@router.post("/import_diet_history_csv", response_model=BaseResponse, responses={
+    200: {
+        "description": "Diet History Imported",
+        "content": {
+            "application/json": {
+                "example": {
+                    "message": "Diet history imported",
+                    "data": {
+                        "imported": 2,
+                        "errors": [
+                            {"row": 1, "error": "calories must be an integer"}
+                        ]
+                    }
+                }
+            }
+        }
+    },
+    413: {
+        "description": "Too Many Entries or File Too Large",
+        "content": {
+            "application/json": {
+                "example": {
+                    "details": "At most 5000 entries per import"
+                }
+            }
+        }
+    }
+})
+async def import_diet_history_csv(
+        file: UploadFile = File(...),  # Header: datetime,meal,calories,protein,carbohydrates,fat
+        time_zone: str = Form(util.DEFAULT_TIME_ZONE),
+        db: AsyncSession = Depends(get_async_db),
+        current_user: Row = Depends(util.get_current_user)
+):
+    try:
+        upload = await ingest_upload(file, util.DIET_IMPORT_CSV_MAX_BYTES, name="CSV file")
+        entries = util.parse_diet_csv(upload.data)
+    finally:
+        await file.close()
+
+    result = await util.import_diet_history(current_user.user, entries, db, time_zone=time_zone)
+    return create_success_response(message="Diet history imported", data=result)
+
+
+@router.get("/get_diet_history", response_model=DietHistoryResponse, responses={
     200: {
         "description": "Diet History Retrieved Successfully",
         "content": {
@@ -389,40 +638,275 @@ async def save_diet_history(
                     "data": {
                         "diet_history": [
                             {
-                                "date": "2024-10-29",
+                                "id": 43,
+                                "datetime": "2024-10-29T04:30:00",
                                 "meal": "lunch",
                                 "calories": 500,
                                 "protein": 30,
                                 "carbohydrates": 50,
-                                "fat": 20
+                                "fat": 20,
+                                "img_url": "https://example-bucket.s3.amazonaws.com/lunch.jpg",
+                                "images": {
+                                    "thumb": {
+                                        "webp": "https://example-bucket.s3.amazonaws.com/derivatives/9f86d0/thumb.webp",
+                                        "jpg": "https://example-bucket.s3.amazonaws.com/derivatives/9f86d0/thumb.jpg"
+                                    },
+                                    "card": {
+                                        "webp": "https://example-bucket.s3.amazonaws.com/derivatives/9f86d0/card.webp",
+                                        "jpg": "https://example-bucket.s3.amazonaws.com/derivatives/9f86d0/card.jpg"
+                                    },
+                                    "full": {
+                                        "webp": "https://example-bucket.s3.amazonaws.com/derivatives/9f86d0/full.webp",
+                                        "jpg": "https://example-bucket.s3.amazonaws.com/derivatives/9f86d0/full.jpg"
+                                    }
+                                }
                             },
                             {
-                                "date": "2024-10-28",
+                                "id": 42,
+                                "datetime": "2024-10-28T12:00:00",
                                 "meal": "dinner",
                                 "calories": 600,
                                 "protein": 40,
                                 "carbohydrates": 60,
-                                "fat": 25
+                                "fat": 25,
+                                "img_url": None,
+                                "images": None
+                            }
+                        ],
+                        "next_cursor": "MjAyNC0xMC0yOFQxMjowMDowMHw0Mg"
+                    }
+                }
+            }
+        }
+    },
+    304: {
+        "description": "Not Modified - If-None-Match matches the current ETag"
+    }
+})
+async def get_diet_history(
+        limit: int = Query(util.DIET_HISTORY_PAGE_SIZE, ge=1, le=util.DIET_HISTORY_MAX_PAGE_SIZE),
+        cursor: Optional[str] = Query(None),  # next_cursor from the previous page
+        db: AsyncSession = Depends(get_async_read_db),
+        current_user: Row = Depends(util.get_current_user),
+        etag_headers: dict = Depends(util.conditional_get)  # 304 when If-None-Match is current
+):
+    # Fetch one page of the diet history, newest first
+    diet_history, next_cursor = await util.get_diet_history_page(current_user.user, db, limit=limit, cursor=cursor)
+
+    # The rows already carry DietHistoryEntry's column types, so skip response validation and let
+    # orjson render them directly (the response model still documents the payload)
+    return ORJSONResponse({
+        "message": "Diet history retrieved successfully",
+        "data": {"diet_history": diet_history, "next_cursor": next_cursor}
+    }, headers=etag_headers)
+
+
+@router.get("/export_diet_history", response_class=StreamingResponse, responses={
+    200: {
+        "description": "Diet History Export (streamed)",
+        "content": {
+            "text/csv": {
+                "example": "id,datetime,meal,calories,protein,carbohydrates,fat,img_url\n"
+                           "42,2024-10-28T12:00:00+00:00,dinner,600,40,60,25,\n"
+            },
+            "application/vnd.apache.parquet": {}
+        }
+    },
+    501: {
+        "description": "Parquet Export Not Available",
+        "content": {
+            "application/json": {
+                "example": {
+                    "details": "Parquet export requires pyarrow"
+                }
+            }
+        }
+    }
+})
+async def export_diet_history(
+        file_format: Literal["csv", "parquet"] = Query("csv", alias="format"),
+        current_user: Row = Depends(util.get_current_user)
+):
+    # Rows are streamed from a server-side cursor, memory stays flat for any history length
+    if file_format == "parquet":
+        if util.pa is None:
+            raise create_error_response(
+                code=status.HTTP_501_NOT_IMPLEMENTED,
+                details="Parquet export requires pyarrow"
+            )
+        content, media_type = util.export_diet_history_parquet(current_user.user), "application/vnd.apache.parquet"
+    else:
+        content, media_type = util.export_diet_history_csv(current_user.user), "text/csv"
+
+    return StreamingResponse(content, media_type=media_type, headers={
+        "Content-Disposition": f'attachment; filename="diet_history.{file_format}"'
+    })
+
+
+@router.get("/get_diet_summary", response_model=BaseResponse, responses={
+    200: {
+        "description": "Diet Summary Retrieved Successfully",
+        "content": {
+            "application/json": {
+                "example": {
+                    "message": "Diet summary retrieved successfully",
+                    "data": {
+                        "bucket": "week",
+                        "time_zone": "Asia/Taipei",
+                        "summary": [
+                            {
+                                "start": "2024-10-28",
+                                "calories": 12500,
+                                "protein": 700,
+                                "carbohydrates": 1400,
+                                "fat": 450,
+                                "meal_count": 18
                             }
                         ]
                     }
                 }
             }
         }
+    },
+    400: {
+        "description": "Bad Request - Invalid date range or time zone",
+        "content": {
+            "application/json": {
+                "example": {
+                    "details": "end_date must not be before start_date"
+                }
+            }
+        }
     }
 })
-async def get_diet_history(db: Session = Depends(get_db), username: str = Depends(util.get_current_user)):
-    # Fetch the diet history from the database using the `get_diet_history` utility function
-    diet_history = util.get_diet_history_from_db(username, db)
+async def get_diet_summary(
+        start_date: date = Query(...),  # Local dates, both inclusive
+        end_date: date = Query(...),
+        time_zone: str = Query(util.DEFAULT_TIME_ZONE),
+        bucket: Literal["day", "week", "month"] = Query("day"),
+        db: AsyncSession = Depends(get_async_read_db),
+        current_user: Row = Depends(util.get_current_user)
+):
+    if end_date < start_date:
+        raise create_error_response(
+            code=status.HTTP_400_BAD_REQUEST,
+            details="end_date must not be before start_date"
+        )
+    if (end_date - start_date).days >= util.SUMMARY_MAX_DAYS:
+        raise create_error_response(
+            code=status.HTTP_400_BAD_REQUEST,
+            details=f"The date range may cover at most {util.SUMMARY_MAX_DAYS} days"
+        )
+    if time_zone not in pytz.all_timezones_set:
+        raise create_error_response(
+            code=status.HTTP_400_BAD_REQUEST,
+            details=f"Unknown time zone {time_zone}"
+        )
+
+    summary = await util.get_diet_summary(current_user.user, db, start_date, end_date, time_zone, bucket)
 
-    # Return the diet history in a structured format
     return create_success_response(
-        message="Diet history retrieved successfully",
-        data={"diet_history": diet_history}
+        message="Diet summary retrieved successfully",
+        data={"bucket": bucket, "time_zone": time_zone, "summary": summary}
     )
 
 
-@router.post("/analyze_gemini", response_model=BaseResponse, responses={
+@router.get("/search_food", response_model=FoodSearchResponse, responses={
+    200: {
+        "description": "Foods Found",
+        "content": {
+            "application/json": {
+                "example": {
+                    "message": "Food search completed successfully",
+                    "data": {
+                        "foods": [
+                            {
+                                "id": 12,
+                                "food": "Fried Rice",
+                                "calories": 520,
+                                "protein": 12,
+                                "carbohydrates": 70,
+                                "fat": 20,
+                                "match": "prefix",
+                                "score": 0.417
+                            }
+                        ]
+                    }
+                }
+            }
+        }
+    }
+})
+async def search_food(
+        q: str = Query(..., min_length=1, max_length=45),
+        limit: int = Query(10, ge=1, le=FOOD_SEARCH_MAX_LIMIT),
+        current_user: Row = Depends(util.get_current_user)
+):
+    # Served from the in-memory catalogue, no database query
+    return create_success_response(
+        message="Food search completed successfully",
+        data={"foods": food_catalogue.search(q, limit)}
+    )
+
+
+@router.post("/similar_meals", response_model=SimilarMealsResponse, responses={
+    200: {
+        "description": "Similar Meals Found (empty when none is similar enough)",
+        "content": {
+            "application/json": {
+                "example": {
+                    "message": "Similar meals retrieved successfully",
+                    "data": {
+                        "meals": [
+                            {
+                                "id": 2,
+                                "datetime": "2026-10-13T04:21:09",
+                                "meal": "lunch",
+                                "calories": 650,
+                                "protein": 30,
+                                "carbohydrates": 80,
+                                "fat": 20,
+                                "img_url": "https://example.com/diet/2.jpg",
+                                "images": None,
+                                "similarity": 0.964
+                            }
+                        ]
+                    }
+                }
+            }
+        }
+    },
+    413: {
+        "description": "Image Too Large",
+        "content": {
+            "application/json": {
+                "example": {
+                    "details": "Image must be at most 10485760 bytes"
+                }
+            }
+        }
+    }
+})
+async def similar_meals(
+        food_img: UploadFile = File(...),
+        limit: int = Form(3, ge=1, le=10),
+        db: AsyncSession = Depends(get_async_read_db),
+        current_user: Row = Depends(util.get_current_user)
+):
+    # "Same as before?" suggestions from the user's earlier photos. Accepting one sends its macros
+    # to /analyze as manual values, so a repeated meal is logged without a vision call
+    try:
+        image = await ingest_upload(food_img, util.DIET_IMAGE_MAX_BYTES)
+        meals = await util.similar_meals(current_user.user, image.data, db, limit)
+        return create_success_response(
+            message="Similar meals retrieved successfully",
+            data={"meals": meals}
+        )
+    finally:
+        await food_img.close()
+
+
+@router.post("/analyze_gemini", response_model=GeminiAnalysisResponse, responses={
     200: {
         "description": "Gemini Analysis Completed Successfully",
         "content": {
@@ -433,20 +917,55 @@ async def get_diet_history(db: Session = Depends(get_db), username: str = Depend
                         "pixel": [600, 800],
                         "list": [
                             {
-                                "label": "food1",
+                                "label": "fried rice",
                                 "bbox": [882, 795, 1000, 812],
+                                "nutrition": {
+                                    "Calories": 780.0,
+                                    "Fat": 30.0,
+                                    "Protein": 18.0,
+                                    "Carbs": 105.0
+                                },
+                                "servings": 1.5,
+                                "source": "catalogue",
+                                "food_id": 12
+                            },
+                            {
+                                "label": "food2",
+                                "bbox": [120, 40, 480, 520],
                                 "nutrition": {
                                     "Calories": 100,
                                     "Fat": 10,
                                     "Protein": 20,
                                     "Carbs": 30
-                                }
+                                },
+                                "servings": 1,
+                                "source": "model"
                             }
                         ]
                     }
                 }
             }
         }
+    },
+    413: {
+        "description": "Image Too Large",
+        "content": {
+            "application/json": {
+                "example": {
+                    "details": "Image must be at most 10485760 bytes"
+                }
+            }
+        }
+    },
+    422: {
+        "description": "Unprocessable Entity - Unusable Photo (blurry, dark, empty)",
+        "content": {
+            "application/json": {
+                "example": {
+                    "detail": "The photo is too blurry, please hold the camera steady and retake it"
+                }
+            }
+        }
     }
 })
 async def analyze_gemini(food_img: UploadFile = File(...)):
@@ -457,16 +976,49 @@ async def analyze_gemini(food_img: UploadFile = File(...)):
         )
 
     try:
-        # Read image bytes directly
-        image_bytes = await food_img.read()
-        
-        # Create an instance of FoodRecognition with bytes
-        food_recognition = FoodRecognition(image_bytes)
-        formatted_output = util.analysis_gemini(food_recognition)
+        # Read the image (streamed, capped at DIET_IMAGE_MAX_BYTES)
+        image = await ingest_upload(food_img, util.DIET_IMAGE_MAX_BYTES)
+        await util.ensure_image_quality(image.data)
+
+        # Both model calls are blocking, keep them off the event loop
+        formatted_output = await asyncio.to_thread(lambda: util.analysis_gemini(FoodRecognition(image.data)))
 
         return create_success_response(
             message="Gemini analysis completed successfully",
             data=formatted_output
         )
     finally:
-        await food_img.close()
\ No newline at end of file
+        await food_img.close()
+
+
+@router.get("/metrics", response_model=BaseResponse, responses={
+    200: {
+        "description": "Metrics Retrieved Successfully",
+        "content": {
+            "application/json": {
+                "example": {
+                    "message": "Metrics retrieved successfully",
+                    "data": {
+                        "db_pool": {
+                            "primary": {"status": "Pool size: 10 ...", "size": 10, "checked_out": 1, "overflow": -9}
+                        },
+                        "counters": {},
+                        "timings": {
+                            "db_pool_checkout.primary": {
+                                "count": 42,
+                                "total_seconds": 0.012,
+                                "max_seconds": 0.004,
+                                "avg_seconds": 0.0003
+                            }
+                        }
+                    }
+                }
+            }
+        }
+    }
+})
+async def get_metrics(current_user: Row = Depends(util.get_current_user)):
+    return create_success_response(
+        message="Metrics retrieved successfully",
+        data={"db_pool": get_pool_stats(), **metrics.snapshot()}
+    )
@@ -1,8 +1,16 @@
-from fastapi import APIRouter, Depends, UploadFile, File, Form, HTTPException
+from fastapi import APIRouter, Depends, UploadFile, File, Form, Query, HTTPException
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from backend.utils import util
-from backend.utils.db_session import get_db
-from sqlalchemy.orm import Session
+from backend.utils.db_session import get_async_db, get_async_read_db, get_pool_stats
+from backend.utils.ingest import ingest_upload
+from backend.utils.food_catalogue import food_catalogue, FOOD_SEARCH_MAX_LIMIT
+from backend.utils import metrics
+from sqlalchemy import Row
+from sqlalchemy.ext.asyncio import AsyncSession
 from pydantic import BaseModel
+from typing import Any, Dict, List, Optional, Literal, Union
+from datetime import date, datetime
+import pytz
 
 
 router = APIRouter()
@@ -36,10 +44,79 @@ class DietHistoryRequest(BaseModel):
     fat: int
 
 
+class ImageUploadRequest(BaseModel):
+    content_type: str
+    content_length: int  # Bytes, the upload must send exactly this Content-Length
+
+
+class DietHistoryImportRequest(BaseModel):
+    entries: List[Any]  # Validated row by row, see util.parse_import_entry
+    time_zone: str = util.DEFAULT_TIME_ZONE  # For timestamps without an offset
+
+
+# Response Models (typed so FastAPI serializes them with pydantic-core instead of the generic encoder)
+class ErrorResponse(BaseModel):
+    error: str
+
+
+class UserInfoData(BaseModel):
+    height: Optional[int] = None
+    weight: Optional[int] = None
+    age: Optional[int] = None
+    gender: Optional[str] = None
+    activity_level: Optional[str] = None
+    target: Optional[str] = None
+    preference: Optional[str] = None
+    tdee: Optional[int] = None
+    target_protein: Optional[int] = None
+    target_carbohydrates: Optional[int] = None
+    target_fat: Optional[int] = None
+
+
+class DietHistoryEntry(BaseModel):
+    id: int
+    datetime: datetime
+    meal: Optional[str] = None
+    calories: Optional[int] = None
+    protein: Optional[int] = None
+    carbohydrates: Optional[int] = None
+    fat: Optional[int] = None
+    img_url: Optional[str] = None
+    images: Optional[Dict[str, Dict[str, str]]] = None  # {"thumb"|"card"|"full": {"webp"|"jpg": url}}
+
+
+class DietHistoryPage(BaseModel):
+    diet_history: List[DietHistoryEntry]
+    next_cursor: Optional[str] = None
+
+
+class FoodMatch(BaseModel):
+    id: int
+    food: str
+    calories: Optional[int] = None
+    protein: Optional[int] = None
+    carbohydrates: Optional[int] = None
+    fat: Optional[int] = None
+    match: Literal["exact", "prefix", "fuzzy"]
+    score: float  # Trigram similarity between the query and the name
+
+
+class FoodSearchResults(BaseModel):
+    foods: List[FoodMatch]
+
+
+class SimilarMeal(DietHistoryEntry):
+    similarity: float  # Cosine similarity between the photos' embeddings
+
+
+class SimilarMeals(BaseModel):
+    meals: List[SimilarMeal]
+
+
 @router.post("/signup")
-async def sign_up(signup_request: SignUpRequest, db: Session = Depends(get_db)):
+async def sign_up(signup_request: SignUpRequest, db: AsyncSession = Depends(get_async_db)):
     # Check if the username already exists
-    existing_user = util.get_user_by_username(signup_request.username, db)
+    existing_user = await util.get_user_by_username(signup_request.username, db)
     if existing_user:
         return {"error": "Username already taken"}
 
@@ -47,7 +124,7 @@ async def sign_up(signup_request: SignUpRequest, db: Session = Depends(get_db)):
     hashed_password = util.hash_password(signup_request.password)
 
     # Save the new user in the database
-    new_user = util.create_user(
+    new_user = await util.create_user(
         username=signup_request.username,
         password=hashed_password,
         db=db
@@ -60,9 +137,9 @@ async def sign_up(signup_request: SignUpRequest, db: Session = Depends(get_db)):
 
 
 @router.post("/login")
-async def login(login_request: LoginRequest, db: Session = Depends(get_db)):
+async def login(login_request: LoginRequest, db: AsyncSession = Depends(get_async_db)):
     # Authenticate user using the single database
-    auth_result = util.authenticate_user(login_request.username, login_request.password, db)
+    auth_result = await util.authenticate_user(login_request.username, login_request.password, db)
 
     if "error" in auth_result:
         return {"error": auth_result["error"]}  # Return specific error message
@@ -76,31 +153,23 @@ async def login(login_request: LoginRequest, db: Session = Depends(get_db)):
     return {"jwtToken": token, "message": f"User {user_name} Login successful"}
 
 
-@router.get("/get_user_info")
-async def get_user_info(db: Session = Depends(get_db), username: str = Depends(util.get_current_user)):
-    user_info = util.get_user_info(username, db)
-
-    if user_info:
-        return {
-            "height": user_info.height,
-            "weight": user_info.weight,
-            "age": user_info.age,
-            "gender": user_info.gender,
-            "activity_level": user_info.activity_level,
-            "target": user_info.target,
-            "preference": user_info.preference,
-            'tdee': user_info.tdee,
-            'target_protein': user_info.target_protein,
-            'target_carbohydrates': user_info.target_carbohydrates,
-            'target_fat': user_info.target_fat
-        }
-    return {"error": "User info not found"}
+@router.get("/get_user_info", response_model=Union[ErrorResponse, UserInfoData])
+async def get_user_info(
+    db: AsyncSession = Depends(get_async_read_db),
+    current_user: Row = Depends(util.get_current_user),
+    etag_headers: dict = Depends(util.conditional_get)  # 304 when If-None-Match is current
+):
+    # Read from the replica, in the session the ETag's data version was read in. A profile the replica
+    # has not caught up with yet (just signed up) is answered from the principal, read on the primary
+    # get_current_user has already answered 401 for unknown users
+    user_info = await util.get_user_info(current_user.user, db) or current_user
+    return user_info._asdict()
 
 
 @router.post("/save_user_info")
-async def save_user_info(user_info: UserInfo, db: Session = Depends(get_db), username: str = Depends(util.get_current_user)):
+async def save_user_info(user_info: UserInfo, db: AsyncSession = Depends(get_async_db), current_user: Row = Depends(util.get_current_user)):
     # Save user info to the database for the current user
-    result = util.save_user_info_to_db(user_info, db, username)
+    result = await util.save_user_info_to_db(user_info, db, current_user.user)
 
     if result:
         return {"message": "User info saved successfully"}
@@ -110,8 +179,8 @@ async def save_user_info(user_info: UserInfo, db: Session = Depends(get_db), use
 @router.post("/analyze")
 async def analyze(
     food_img: UploadFile = File(None),  # Make food_img optional
-    db: Session = Depends(get_db),
-    user_name: str = Depends(util.get_current_user),
+    db: AsyncSession = Depends(get_async_read_db),
+    current_user: Row = Depends(util.get_current_user),
     manual_protein: int = Form(None),  # Make manual input fields optional
     manual_carbohydrates: int = Form(None),
     manual_fat: int = Form(None),
@@ -123,10 +192,10 @@ async def analyze(
 
     obj = {}
 
-    # If an image is provided, read it
+    # If an image is provided, read it (streamed, capped at DIET_IMAGE_MAX_BYTES)
     if food_img:
-        image_bytes = await food_img.read()
-        obj['img'] = image_bytes
+        image = await ingest_upload(food_img, util.DIET_IMAGE_MAX_BYTES)
+        obj['img'] = image.data
 
     # If manual input is provided, include it in the obj
     if manual_protein and manual_carbohydrates and manual_fat:
@@ -134,10 +203,16 @@ async def analyze(
         obj['carbohydrates'] = manual_carbohydrates
         obj['fat'] = manual_fat
 
-    analysis_result = util.analysis(obj, db, user_name=user_name, time_zone=time_zone)
+    analysis_result = await util.analysis(obj, db, user_info=current_user, time_zone=time_zone)
     return {"result": analysis_result}
 
 
+@router.post("/create_image_upload")
+async def create_image_upload(upload_request: ImageUploadRequest, current_user: Row = Depends(util.get_current_user)):
+    # The client PUTs the photo straight to storage, then saves the meal with img_key
+    return util.create_diet_image_upload(current_user.user, upload_request.content_type, upload_request.content_length)
+
+
 @router.post("/save_diet_history")
 async def save_diet_history(
     food_img: UploadFile = File(None),
@@ -145,25 +220,27 @@ async def save_diet_history(
     protein: int = Form(...),
     carbohydrates: int = Form(...),
     fat: int = Form(...),
-    db: Session = Depends(get_db),
-    username: str = Depends(util.get_current_user)
+    time_zone: str = Form(util.DEFAULT_TIME_ZONE),  # Decides which day the meal counts towards
+    img_key: str = Form(None),  # From /create_image_upload, instead of food_img
+    db: AsyncSession = Depends(get_async_db),
+    current_user: Row = Depends(util.get_current_user)
 ):
 
-    # If an image is provided, read it
-    if food_img:
-        image_bytes = await food_img.read()
-    else:
-        image_bytes = None
+    # If an image is provided, read it (streamed, capped at DIET_IMAGE_MAX_BYTES)
+    image = await ingest_upload(food_img, util.DIET_IMAGE_MAX_BYTES) if food_img else None
 
-    saved_history = util.save_diet_history(
-        user=username,
+    saved_history = await util.save_diet_history(
+        user=current_user.user,
         meal='lunch',
         calories=calories,
         protein=protein,
         carbohydrates=carbohydrates,
         fat=fat,
-        image_bytes=image_bytes,
+        image_bytes=image.data if image else None,
+        image_sha256=image.sha256 if image else None,
         db=db,
+        time_zone=time_zone,
+        img_key=img_key,
     )
 
     if saved_history:
@@ -172,12 +249,115 @@ async def save_diet_history(
         return {"error": "Failed to save diet history"}
 
 
-@router.get("/get_diet_history")
-async def get_diet_history(db: Session = Depends(get_db), username: str = Depends(util.get_current_user)):
-    # Fetch the diet history from the database using the `get_diet_history` utility function
-    diet_history = util.get_diet_history_from_db(username, db)
-    if not diet_history:
+@router.post("/import_diet_history")
+async def import_diet_history(
+    import_request: DietHistoryImportRequest,
+    db: AsyncSession = Depends(get_async_db),
+    current_user: Row = Depends(util.get_current_user)
+):
+    # Rows that fail validation or image upload come back in errors, the rest are saved
+    return await util.import_diet_history(current_user.user, import_request.entries, db, time_zone=import_request.time_zone)
+
+
+@router.post("/import_diet_history_csv")
+async def import_diet_history_csv(
+    file: UploadFile = File(...),  # Header: datetime,meal,calories,protein,carbohydrates,fat
+    time_zone: str = Form(util.DEFAULT_TIME_ZONE),
+    db: AsyncSession = Depends(get_async_db),
+    current_user: Row = Depends(util.get_current_user)
+):
+    try:
+        upload = await ingest_upload(file, util.DIET_IMPORT_CSV_MAX_BYTES, name="CSV file")
+        entries = util.parse_diet_csv(upload.data)
+    finally:
+        await file.close()
+
+    return await util.import_diet_history(current_user.user, entries, db, time_zone=time_zone)
+
+
+@router.get("/get_diet_history", response_model=Union[ErrorResponse, DietHistoryPage])
+async def get_diet_history(
+    limit: int = Query(util.DIET_HISTORY_PAGE_SIZE, ge=1, le=util.DIET_HISTORY_MAX_PAGE_SIZE),
+    cursor: Optional[str] = Query(None),  # next_cursor from the previous page
+    db: AsyncSession = Depends(get_async_read_db),
+    current_user: Row = Depends(util.get_current_user),
+    etag_headers: dict = Depends(util.conditional_get)  # 304 when If-None-Match is current
+):
+    # Fetch one page of the diet history, newest first
+    diet_history, next_cursor = await util.get_diet_history_page(current_user.user, db, limit=limit, cursor=cursor)
+    if not diet_history and not cursor:
         return {"error": "No diet history found for this user"}
 
-    # Return the diet history in a structured format
-    return {"diet_history": diet_history}
\ No newline at end of file
+    # The rows already carry DietHistoryEntry's column types, so skip response validation and let
+    # orjson render them directly (the response model still documents the payload)
+    return ORJSONResponse({"diet_history": diet_history, "next_cursor": next_cursor}, headers=etag_headers)
+
+
+@router.get("/export_diet_history", response_class=StreamingResponse)
+async def export_diet_history(
+    file_format: Literal["csv", "parquet"] = Query("csv", alias="format"),
+    current_user: Row = Depends(util.get_current_user)
+):
+    # Rows are streamed from a server-side cursor, memory stays flat for any history length
+    if file_format == "parquet":
+        if util.pa is None:
+            raise HTTPException(status_code=501, detail="Parquet export requires pyarrow")
+        content, media_type = util.export_diet_history_parquet(current_user.user), "application/vnd.apache.parquet"
+    else:
+        content, media_type = util.export_diet_history_csv(current_user.user), "text/csv"
+
+    return StreamingResponse(content, media_type=media_type, headers={
+        "Content-Disposition": f'attachment; filename="diet_history.{file_format}"'
+    })
+
+
+@router.get("/get_diet_summary")
+async def get_diet_summary(
+    start_date: date = Query(...),  # Local dates, both inclusive
+    end_date: date = Query(...),
+    time_zone: str = Query(util.DEFAULT_TIME_ZONE),
+    bucket: Literal["day", "week", "month"] = Query("day"),
+    db: AsyncSession = Depends(get_async_read_db),
+    current_user: Row = Depends(util.get_current_user)
+):
+    if end_date < start_date:
+        raise HTTPException(status_code=400, detail="end_date must not be before start_date")
+    if (end_date - start_date).days >= util.SUMMARY_MAX_DAYS:
+        raise HTTPException(status_code=400, detail=f"The date range may cover at most {util.SUMMARY_MAX_DAYS} days")
+    if time_zone not in pytz.all_timezones_set:
+        raise HTTPException(status_code=400, detail=f"Unknown time zone {time_zone}")
+
+    # Per-bucket calorie/macro totals and meal counts, computed in one grouped query
+    summary = await util.get_diet_summary(current_user.user, db, start_date, end_date, time_zone, bucket)
+    return {"bucket": bucket, "time_zone": time_zone, "summary": summary}
+
+
+@router.get("/search_food", response_model=FoodSearchResults)
+async def search_food(
+    q: str = Query(..., min_length=1, max_length=45),
+    limit: int = Query(10, ge=1, le=FOOD_SEARCH_MAX_LIMIT),
+    current_user: Row = Depends(util.get_current_user)
+):
+    # Autocomplete for manual entry, served from the in-memory catalogue
+    return {"foods": food_catalogue.search(q, limit)}
+
+
+@router.post("/similar_meals", response_model=SimilarMeals)
+async def similar_meals(
+    food_img: UploadFile = File(...),
+    limit: int = Form(3, ge=1, le=10),
+    db: AsyncSession = Depends(get_async_read_db),
+    current_user: Row = Depends(util.get_current_user)
+):
+    # "Same as before?" suggestions, accepting one analyzes its macros as manual values (no vision call)
+    try:
+        image = await ingest_upload(food_img, util.DIET_IMAGE_MAX_BYTES)
+        return {"meals": await util.similar_meals(current_user.user, image.data, db, limit)}
+    finally:
+        await food_img.close()
+
+
+@router.get("/metrics")
+async def get_metrics(current_user: Row = Depends(util.get_current_user)):
+    # Connection pool state plus the in-process counters and timings (e.g. pool checkout waits)
+    return {"db_pool": get_pool_stats(), **metrics.snapshot()}
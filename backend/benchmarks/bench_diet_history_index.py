@@ -0,0 +1,110 @@
+"""Query plans and timings of the diet_history hot queries before and after the
+(user, datetime) index from migration 0002.
+
+    python -m backend.benchmarks.bench_diet_history_index --rows 500000 --users 5000
+
+Uses a throwaway SQLite file by default; pass --url to run against a scratch MySQL database.
+"""
+import argparse
+import os
+import random
+import statistics
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import create_engine, insert, select, func, text
+
+from backend.models.database import Base, Diet
+
+INDEX = next(index for index in Diet.__table__.indexes if index.name == "ix_diet_history_user_datetime")
+
+
+def populate(engine, rows: int, users: int):
+    # Create the table without the composite index, like the pre-migration schema
+    Diet.__table__.indexes.discard(INDEX)
+    Base.metadata.drop_all(engine, tables=[Diet.__table__])
+    Base.metadata.create_all(engine, tables=[Diet.__table__])
+    Diet.__table__.indexes.add(INDEX)
+
+    start = datetime(2024, 1, 1)
+    batch = []
+    with engine.begin() as conn:
+        for i in range(rows):
+            batch.append({
+                "user": f"user{random.randrange(users)}",
+                "meal": "lunch",
+                "calories": random.randint(100, 900),
+                "protein": random.randint(0, 60),
+                "carbohydrates": random.randint(0, 120),
+                "fat": random.randint(0, 50),
+                "datetime": start + timedelta(seconds=random.randrange(365 * 24 * 3600)),
+            })
+            if len(batch) == 10000:
+                conn.execute(insert(Diet), batch)
+                batch = []
+        if batch:
+            conn.execute(insert(Diet), batch)
+
+
+def hot_queries(username: str):
+    day_start = datetime(2024, 6, 1)
+    day_end = day_start + timedelta(days=1)
+    return {
+        "get_intake_sum_today": select(
+            func.sum(Diet.calories), func.sum(Diet.protein), func.sum(Diet.carbohydrates), func.sum(Diet.fat)
+        ).where(Diet.user == username, Diet.datetime >= day_start, Diet.datetime < day_end),
+        "get_diet_history_from_db (date)": select(Diet).where(
+            Diet.user == username, Diet.datetime >= day_start, Diet.datetime <= day_end
+        ).order_by(Diet.datetime.desc()),
+        "get_diet_history_from_db (all)": select(Diet).where(Diet.user == username).order_by(Diet.datetime.desc()),
+    }
+
+
+def explain(conn, stmt):
+    sql = str(stmt.compile(conn, compile_kwargs={"literal_binds": True}))
+    if conn.dialect.name == "sqlite":
+        return [row[-1] for row in conn.execute(text(f"EXPLAIN QUERY PLAN {sql}"))]
+    return [str(tuple(row)) for row in conn.execute(text(f"EXPLAIN {sql}"))]
+
+
+def measure(engine, users: int, repeat: int):
+    with engine.connect() as conn:
+        for name, stmt in hot_queries("user0").items():
+            print(f"  {name}")
+            for line in explain(conn, stmt):
+                print(f"    plan: {line}")
+
+            timings = []
+            for _ in range(repeat):
+                stmt_for_user = hot_queries(f"user{random.randrange(users)}")[name]
+                t0 = time.perf_counter()
+                conn.execute(stmt_for_user).all()
+                timings.append(time.perf_counter() - t0)
+            print(f"    median: {statistics.median(timings) * 1000:.2f} ms over {repeat} runs")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=500000)
+    parser.add_argument("--users", type=int, default=5000)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--url", help="scratch database URL (the diet_history table is dropped)")
+    args = parser.parse_args()
+
+    url = args.url or f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'bench.db')}"
+    engine = create_engine(url)
+
+    print(f"Populating {args.rows} rows for {args.users} users ...")
+    populate(engine, args.rows, args.users)
+
+    print("Without ix_diet_history_user_datetime:")
+    measure(engine, args.users, args.repeat)
+
+    INDEX.create(engine)
+    print("With ix_diet_history_user_datetime:")
+    measure(engine, args.users, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
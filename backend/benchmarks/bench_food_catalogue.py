@@ -0,0 +1,84 @@
+"""Build time, memory and lookup latency of the in-memory food catalogue.
+
+    python -m backend.benchmarks.bench_food_catalogue --foods 20000
+
+Uses synthetic food names built from a few common food words plus a larger generated
+vocabulary (no database), the index is the one served by /search_food.
+"""
+import argparse
+import random
+import statistics
+import time
+import tracemalloc
+from collections import namedtuple
+
+from backend.utils.food_catalogue import FoodIndex
+
+FoodRow = namedtuple("FoodRow", "id food calories protein carbohydrates fat updated_at")
+
+WORDS = ["chicken", "beef", "pork", "tofu", "egg", "rice", "noodles", "soup", "salad", "fried", "grilled",
+         "steamed", "curry", "dumplings", "bun", "milk", "tea", "toast", "sandwich", "bento", "braised",
+         "spicy", "sweet", "sour", "garlic", "vegetables", "mushroom", "shrimp", "fish", "potato"]
+SYLLABLES = [consonant + vowel for consonant in "bcdfghjklmnprstvwyz" for vowel in "aeiou"] + ["an", "ong", "ing", "en"]
+QUERIES = {
+    "exact": lambda names: random.choice(names),
+    "prefix": lambda names: random.choice(names)[:4],
+    "word prefix": lambda names: random.choice(names).split()[-1][:3],
+    "typo": lambda names: typo(random.choice(names)),
+}
+
+
+def typo(name: str):
+    i = random.randrange(len(name) - 1)
+    return name[:i] + name[i + 1] + name[i] + name[i + 2:]
+
+
+def vocabulary(size: int):
+    words = set(WORDS)
+    while len(words) < size:
+        words.add("".join(random.choices(SYLLABLES, k=random.randint(2, 4))))
+    return sorted(words)
+
+
+def food_rows(foods: int, words: list):
+    # Common words show up in many names, like "chicken" does in a real catalogue
+    weights = [20 if word in WORDS else 1 for word in words]
+    return [FoodRow(i, " ".join(dict.fromkeys(random.choices(words, weights, k=random.randint(1, 4)))),
+                    random.randint(50, 900), random.randint(0, 60), random.randint(0, 120), random.randint(0, 50), None)
+            for i in range(1, foods + 1)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--foods", type=int, default=20000)
+    parser.add_argument("--vocabulary", type=int, default=3000)
+    parser.add_argument("--queries", type=int, default=2000)
+    args = parser.parse_args()
+
+    random.seed(0)
+    rows = food_rows(args.foods, vocabulary(args.vocabulary))
+
+    # Timed without tracemalloc, it slows allocation-heavy code down a lot
+    t0 = time.perf_counter()
+    FoodIndex(rows)
+    build = time.perf_counter() - t0
+
+    tracemalloc.start()
+    index = FoodIndex(rows)
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    print(f"build {build * 1000:8.1f} ms  {memory / 1024 / 1024:8.1f} MiB for {len(index)} foods")
+
+    for name, make_query in QUERIES.items():
+        queries = [make_query(index.names) for _ in range(args.queries)]
+        timings, found = [], 0
+        for query in queries:
+            t0 = time.perf_counter()
+            found += bool(index.search(query, 10))
+            timings.append(time.perf_counter() - t0)
+        print(f"{name:12s} median {statistics.median(timings) * 1e6:8.1f} us  "
+              f"p99 {sorted(timings)[int(len(timings) * 0.99)] * 1e6:8.1f} us  {found / len(queries):6.1%} found")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+"""Throughput of the local food classifier for different session pool and batch sizes.
+
+    python -m backend.benchmarks.bench_food_classifier --photos 512 --clients 16
+    python -m backend.benchmarks.bench_food_classifier --model path/to/food_model.onnx
+
+Concurrent clients each classify photos through FoodClassifier.classify, the way request
+handlers do. Defaults to the tiny bundled test model, whose inference is nearly free, so
+with it the numbers mostly show the queueing and preprocessing overhead.
+"""
+import argparse
+import io
+import os
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+from backend.utils.food_classifier import FoodClassifier, TEST_MODEL_PATH
+
+
+def photo(rng, size=(1280, 960)):
+    pixels = rng.integers(0, 256, (size[1], size[0], 3), dtype=np.uint8)
+    buffer = io.BytesIO()
+    Image.fromarray(pixels).save(buffer, "JPEG", quality=85)
+    return buffer.getvalue()
+
+
+def run(model: str, sessions: int, batch_size: int, photos: list, clients: int):
+    classifier = FoodClassifier(model, sessions=sessions, batch_size=batch_size)
+    classifier.load()
+    classifier.classify(photos[0])  # Warm up
+
+    def classify(image_bytes):
+        t0 = time.perf_counter()
+        classifier.classify(image_bytes)
+        return time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(clients) as executor:
+        timings = list(executor.map(classify, photos))
+    elapsed = time.perf_counter() - t0
+    print(f"sessions {sessions:2d}  batch {batch_size:2d}  {len(photos) / elapsed:8.1f} photos/s  "
+          f"median {statistics.median(timings) * 1000:7.1f} ms  p99 {sorted(timings)[int(len(timings) * 0.99)] * 1000:7.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", default=str(TEST_MODEL_PATH))
+    parser.add_argument("--photos", type=int, default=512)
+    parser.add_argument("--clients", type=int, default=16)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    photos = [photo(rng) for _ in range(16)] * (args.photos // 16)
+    cores = os.cpu_count() or 1
+    for sessions in sorted({1, max(1, cores // 2), cores}):
+        for batch_size in (1, 8):
+            run(args.model, sessions, batch_size, photos, args.clients)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+"""Rows/sec and memory per request of the diet history read path: ORM entities vs Core column selects.
+
+    python -m backend.benchmarks.bench_history_read_path --rows 100000
+
+Runs against a throwaway SQLite file through aiosqlite, like the tests.
+"""
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+from sqlalchemy import create_engine, insert, select
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+
+from backend.models.database import Base, Diet
+from backend.utils.util import diet_history_query, format_diet_history
+
+USERNAME = "bench_user"
+
+
+def populate(path: str, rows: int):
+    engine = create_engine(f"sqlite:///{path}")
+    Base.metadata.create_all(engine)
+
+    start = datetime(2020, 1, 1)
+    with engine.begin() as conn:
+        for offset in range(0, rows, 10000):
+            conn.execute(insert(Diet), [{
+                "user": USERNAME,
+                "meal": "lunch",
+                "calories": random.randint(100, 900),
+                "protein": random.randint(0, 60),
+                "carbohydrates": random.randint(0, 120),
+                "fat": random.randint(0, 50),
+                "datetime": start + timedelta(minutes=30 * i),
+                "img_url": f"https://example-bucket.s3.amazonaws.com/{i}.jpg"
+            } for i in range(offset, min(offset + 10000, rows))])
+    engine.dispose()
+
+
+async def orm_read_path(db):
+    # The previous implementation: hydrate Diet entities, then copy columns into dicts
+    history = (await db.execute(select(Diet).where(Diet.user == USERNAME)
+                                .order_by(Diet.datetime.desc()))).scalars().all()
+    return [{
+        "datetime": entry.datetime,
+        "meal": entry.meal,
+        "calories": entry.calories,
+        "protein": entry.protein,
+        "carbohydrates": entry.carbohydrates,
+        "fat": entry.fat,
+        "img_url": entry.img_url
+    } for entry in history]
+
+
+async def core_read_path(db):
+    history = (await db.execute(diet_history_query(USERNAME).order_by(Diet.datetime.desc()))).all()
+    return format_diet_history(history)
+
+
+async def measure(session_maker, read_path, repeat: int):
+    # Timings without tracemalloc, it slows allocation-heavy code down a lot
+    timings, count = [], 0
+    for _ in range(repeat):
+        async with session_maker() as db:
+            t0 = time.perf_counter()
+            count = len(await read_path(db))
+            timings.append(time.perf_counter() - t0)
+
+    async with session_maker() as db:
+        tracemalloc.start()
+        result = await read_path(db)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        del result
+
+    elapsed = statistics.median(timings)
+    return count / elapsed, elapsed, peak
+
+
+async def run(path: str, repeat: int):
+    engine = create_async_engine(f"sqlite+aiosqlite:///{path}")
+    session_maker = async_sessionmaker(bind=engine, expire_on_commit=False)
+
+    # Warm up the connection and the statement caches
+    for read_path in (orm_read_path, core_read_path):
+        async with session_maker() as db:
+            await read_path(db)
+
+    for name, read_path in (("ORM entities", orm_read_path), ("Core columns", core_read_path)):
+        rows_per_second, elapsed, peak = await measure(session_maker, read_path, repeat)
+        print(f"{name:14s} {rows_per_second:12,.0f} rows/s  {elapsed * 1000:8.1f} ms/request  "
+              f"{peak / 1024 / 1024:8.1f} MiB peak/request")
+
+    await engine.dispose()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(), "bench.db")
+    print(f"Populating {args.rows} history rows ...")
+    populate(path, args.rows)
+    asyncio.run(run(path, args.repeat))
+
+
+if __name__ == "__main__":
+    main()
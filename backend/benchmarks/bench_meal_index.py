@@ -0,0 +1,80 @@
+"""Similar meal lookups: embedding time per photo, and brute force vs HNSW search per user history size.
+
+    python -m backend.benchmarks.bench_meal_index --meals 100 1000 10000 50000
+
+Histories are clustered random unit vectors the size of image_embedding's output (users eat a
+handful of meals again and again). The graph rows need hnswlib, recall is measured against brute force.
+"""
+import argparse
+import io
+import statistics
+import time
+
+import numpy as np
+from PIL import Image
+
+from backend.utils import meal_index
+from backend.utils.meal_index import MealIndex, image_embedding
+
+
+def photo(rng, size=(1280, 960)):
+    pixels = rng.integers(0, 256, (size[1] // 8, size[0] // 8, 3), dtype=np.uint8)
+    buffer = io.BytesIO()
+    Image.fromarray(pixels).resize(size).save(buffer, "JPEG", quality=85)
+    return buffer.getvalue()
+
+
+def history(rng, meals: int, dimension: int, dishes: int = 30):
+    centres = rng.normal(size=(dishes, dimension))
+    vectors = centres[rng.integers(0, dishes, meals)] + rng.normal(scale=0.3, size=(meals, dimension))
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors.astype(np.float16)
+
+
+def timed_searches(index: MealIndex, queries: np.ndarray, limit: int):
+    timings, results = [], []
+    for query in queries:
+        t0 = time.perf_counter()
+        results.append({entry_id for entry_id, _ in index.search(query, limit, min_similarity=-1)})
+        timings.append(time.perf_counter() - t0)
+    return timings, results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--meals", type=int, nargs="+", default=[100, 1000, 10000, 50000])
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--limit", type=int, default=3)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    photos = [photo(rng) for _ in range(20)]
+    timings = []
+    for image_bytes in photos:
+        t0 = time.perf_counter()
+        vector = image_embedding(image_bytes)
+        timings.append(time.perf_counter() - t0)
+    print(f"embedding    median {statistics.median(timings) * 1000:7.2f} ms  {vector.nbytes} bytes per photo")
+
+    for meals in args.meals:
+        vectors = history(rng, meals, len(vector))
+        queries = history(rng, args.queries, len(vector))
+        ids = list(range(1, meals + 1))
+
+        modes = [("brute", float("inf"))] + ([("graph", 0)] if meal_index.hnswlib is not None else [])
+        exact = None
+        for mode, graph_min in modes:
+            meal_index.MEAL_INDEX_GRAPH_MIN = graph_min
+            t0 = time.perf_counter()
+            index = MealIndex(ids, vectors)
+            build = time.perf_counter() - t0
+            search, results = timed_searches(index, queries, args.limit)
+            exact = exact or results
+            recall = statistics.mean(len(found & expected) / len(expected) for found, expected in zip(results, exact))
+            print(f"{mode:6s} {meals:6d} meals  build {build * 1000:8.1f} ms  "
+                  f"search median {statistics.median(search) * 1e6:8.1f} us  p99 {sorted(search)[int(len(search) * 0.99)] * 1e6:8.1f} us  "
+                  f"recall {recall:6.1%}")
+
+
+if __name__ == "__main__":
+    main()
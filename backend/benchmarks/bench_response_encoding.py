@@ -0,0 +1,102 @@
+"""Response encoding cost of large diet history payloads: untyped responses through
+jsonable_encoder / stdlib json vs typed response models rendered with orjson.
+
+    python -m backend.benchmarks.bench_response_encoding --entries 5000
+
+Each variant is a tiny in-process FastAPI app serving the same in-memory page, so the
+timings only cover validation, serialization and rendering (no database, no network).
+"""
+import argparse
+import asyncio
+import statistics
+import time
+from datetime import datetime, timedelta
+
+import httpx
+from fastapi import FastAPI
+from fastapi.responses import JSONResponse, ORJSONResponse
+
+from backend.api import endpoints_app, endpoints_web
+
+
+def history_page(entries: int):
+    start = datetime(2024, 1, 1, 12, 0, 0, 123456)
+    return [{
+        "id": i,
+        "datetime": start + timedelta(minutes=30 * i),
+        "meal": "lunch",
+        "calories": 500 + i % 300,
+        "protein": 30,
+        "carbohydrates": 50,
+        "fat": 20,
+        "img_url": f"https://example-bucket.s3.amazonaws.com/{i}.jpg"
+    } for i in range(entries)]
+
+
+def variants(diet_history):
+    page = {"diet_history": diet_history, "next_cursor": "MjAyNC0xMC0yOFQxMjowMDowMHw0Mg"}
+    message = "Diet history retrieved successfully"
+    apps = {}
+
+    # Web router before: plain dict, no response model -> jsonable_encoder + json.dumps
+    apps["web: dict + json"] = FastAPI(default_response_class=JSONResponse)
+    apps["web: dict + json"].get("/history")(lambda: page)
+
+    # Typed response model, validated and serialized by pydantic-core, rendered by orjson
+    apps["web: validated + orjson"] = FastAPI(default_response_class=ORJSONResponse)
+    apps["web: validated + orjson"].get("/history", response_model=endpoints_web.DietHistoryPage)(lambda: page)
+
+    # What the endpoint ships: the typed model documents the payload, orjson renders the rows directly
+    apps["web: direct orjson"] = FastAPI(default_response_class=ORJSONResponse)
+    apps["web: direct orjson"].get("/history", response_model=endpoints_web.DietHistoryPage)(
+        lambda: ORJSONResponse(page))
+
+    # App router before: BaseResponse(data=Any) + json.dumps
+    apps["app: Any + json"] = FastAPI(default_response_class=JSONResponse)
+    apps["app: Any + json"].get("/history", response_model=endpoints_app.BaseResponse)(
+        lambda: endpoints_app.create_success_response(message, page))
+
+    apps["app: validated + orjson"] = FastAPI(default_response_class=ORJSONResponse)
+    apps["app: validated + orjson"].get("/history", response_model=endpoints_app.DietHistoryResponse)(
+        lambda: {"message": message, "data": page})
+
+    apps["app: direct orjson"] = FastAPI(default_response_class=ORJSONResponse)
+    apps["app: direct orjson"].get("/history", response_model=endpoints_app.DietHistoryResponse)(
+        lambda: ORJSONResponse({"message": message, "data": page}))
+
+    return apps
+
+
+async def measure(app, repeat: int):
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        response = await client.get("/history")  # Warm up
+        size = len(response.content)
+
+        timings = []
+        for _ in range(repeat):
+            t0 = time.perf_counter()
+            response = await client.get("/history")
+            timings.append(time.perf_counter() - t0)
+            response.raise_for_status()
+    return statistics.median(timings), size
+
+
+async def run(entries: int, repeat: int):
+    for name, app in variants(history_page(entries)).items():
+        elapsed, size = await measure(app, repeat)
+        print(f"{name:24s} {elapsed * 1000:8.1f} ms/request  {entries / elapsed:12,.0f} entries/s  "
+              f"{size / 1024:8.1f} KiB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--entries", type=int, default=5000)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    asyncio.run(run(args.entries, args.repeat))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+"""Peak memory of concurrent photo uploads: UploadFile.read() vs streamed ingestion (ingest_upload).
+
+    python -m backend.benchmarks.bench_upload_ingestion --uploads 32 --size-mb 5
+    python -m backend.benchmarks.bench_upload_ingestion --uploads 32 --size-mb 5 --encode
+
+Each request reads the photo, hashes it for its storage key and holds it for --hold seconds,
+standing in for the vision call. --encode also base64-encodes it like img_analysis does.
+Every variant runs in a fresh subprocess, peak anonymous RSS is sampled from /proc (Linux only).
+"""
+import argparse
+import asyncio
+import base64
+import os
+import subprocess
+import sys
+import threading
+import time
+
+import httpx
+from fastapi import FastAPI, File, UploadFile
+
+from backend.utils.ingest import ingest_upload
+from backend.utils.storage import content_key, digest_key
+
+VARIANTS = ("read", "ingest")
+
+
+def rss_anon():
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("RssAnon:"):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+class PeakSampler(threading.Thread):
+    def __init__(self, interval: float = 0.002):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.peak = 0
+        self.running = True
+
+    def run(self):
+        while self.running:
+            self.peak = max(self.peak, rss_anon())
+            time.sleep(self.interval)
+
+    def stop(self):
+        self.running = False
+        self.join()
+        return self.peak
+
+
+def build_app(variant: str, hold: float, encode: bool, max_bytes: int):
+    app = FastAPI()
+
+    @app.post("/upload")
+    async def upload(food_img: UploadFile = File(...)):
+        if variant == "read":
+            data = await food_img.read()
+            key = content_key(data)
+        else:
+            image = await ingest_upload(food_img, max_bytes)
+            data, key = image.data, digest_key(image.sha256)
+
+        encoded = base64.b64encode(data).decode('utf-8') if encode else None
+        await asyncio.sleep(hold)
+        return {"key": key, "encoded": len(encoded) if encoded else 0}
+
+    return app
+
+
+async def run_variant(variant: str, uploads: int, size: int, hold: float, encode: bool):
+    app = build_app(variant, hold, encode, max_bytes=size)
+    payload = os.urandom(size)  # One shared buffer for every client request
+    transport = httpx.ASGITransport(app=app)
+
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+        async def post():
+            response = await client.post("/upload", files={"food_img": ("meal.jpg", payload, "image/jpeg")})
+            response.raise_for_status()
+
+        await post()  # Warm up
+        baseline = rss_anon()
+        sampler = PeakSampler()
+        sampler.start()
+        t0 = time.perf_counter()
+        await asyncio.gather(*(post() for _ in range(uploads)))
+        elapsed = time.perf_counter() - t0
+        peak = sampler.stop()
+
+    print(f"{variant:8s} {(peak - baseline) / 1024 / 1024:8.1f} MiB peak anon RSS over baseline  "
+          f"{elapsed * 1000:8.1f} ms for {uploads} uploads")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--uploads", type=int, default=32)
+    parser.add_argument("--size-mb", type=float, default=5)
+    parser.add_argument("--hold", type=float, default=0.5)
+    parser.add_argument("--encode", action="store_true")
+    parser.add_argument("--variant", choices=VARIANTS)
+    args = parser.parse_args()
+
+    size = int(args.size_mb * 1024 * 1024)
+    if args.variant:
+        asyncio.run(run_variant(args.variant, args.uploads, size, args.hold, args.encode))
+        return
+
+    # A fresh interpreter per variant, so one variant's heap does not carry over into the next
+    for variant in VARIANTS:
+        subprocess.run([sys.executable, "-m", "backend.benchmarks.bench_upload_ingestion",
+                        "--uploads", str(args.uploads), "--size-mb", str(args.size_mb), "--hold", str(args.hold),
+                        "--variant", variant] + (["--encode"] if args.encode else []), check=True)
+
+
+if __name__ == "__main__":
+    main()
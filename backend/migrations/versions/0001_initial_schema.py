@@ -0,0 +1,83 @@
+"""initial schema
+
+Revision ID: 0001
+Revises:
+Create Date: 2026-10-19 00:00:00
+
+Tables as they existed before migrations were introduced. Existing
+databases should be stamped with this revision instead of running it.
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0001'
+down_revision: Union[str, None] = None
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        'user',
+        sa.Column('id', sa.Integer(), primary_key=True, autoincrement=True),
+        sa.Column('user', sa.String(45)),
+        sa.Column('password', sa.String(255)),
+        sa.Column('gender', sa.String(45)),
+        sa.Column('height', sa.Integer()),
+        sa.Column('weight', sa.Integer()),
+        sa.Column('age', sa.Integer()),
+        sa.Column('activity_level', sa.String(45)),
+        sa.Column('target', sa.String(45)),
+        sa.Column('preference', sa.String(45)),
+        sa.Column('tdee', sa.Integer()),
+        sa.Column('target_protein', sa.Integer()),
+        sa.Column('target_carbohydrates', sa.Integer()),
+        sa.Column('target_fat', sa.Integer()),
+    )
+    op.create_index('ix_user_id', 'user', ['id'])
+    op.create_index('ix_user_user', 'user', ['user'], unique=True)
+
+    op.create_table(
+        'diet_history',
+        sa.Column('id', sa.Integer(), primary_key=True, autoincrement=True),
+        sa.Column('user', sa.String(45)),
+        sa.Column('meal', sa.String(45)),
+        sa.Column('calories', sa.Integer()),
+        sa.Column('protein', sa.Integer()),
+        sa.Column('carbohydrates', sa.Integer()),
+        sa.Column('fat', sa.Integer()),
+        sa.Column('datetime', sa.DateTime()),
+        sa.Column('img_url', sa.String(255)),
+    )
+    op.create_index('ix_diet_history_id', 'diet_history', ['id'])
+
+    op.create_table(
+        'food_nutrition',
+        sa.Column('id', sa.Integer(), primary_key=True, autoincrement=True),
+        sa.Column('food', sa.String(45)),
+        sa.Column('calories', sa.Integer()),
+        sa.Column('protein', sa.Integer()),
+        sa.Column('carbohydrates', sa.Integer()),
+        sa.Column('fat', sa.Integer()),
+    )
+    op.create_index('ix_food_nutrition_id', 'food_nutrition', ['id'])
+
+    op.create_table(
+        'workout',
+        sa.Column('id', sa.Integer(), primary_key=True, autoincrement=True),
+        sa.Column('name', sa.String(45)),
+        sa.Column('calories_consumption', sa.Integer()),
+        sa.Column('type', sa.String(45)),
+    )
+    op.create_index('ix_workout_id', 'workout', ['id'])
+
+
+def downgrade() -> None:
+    op.drop_table('workout')
+    op.drop_table('food_nutrition')
+    op.drop_table('diet_history')
+    op.drop_table('user')
@@ -0,0 +1,28 @@
+"""diet_history (user, datetime) index
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-19 00:00:00
+
+get_intake_sum_today and get_diet_history_from_db filter on user plus a
+datetime range and order by datetime, which needs this index to avoid a
+full table scan.
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0002'
+down_revision: Union[str, None] = '0001'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_index('ix_diet_history_user_datetime', 'diet_history', ['user', 'datetime'])
+
+
+def downgrade() -> None:
+    op.drop_index('ix_diet_history_user_datetime', table_name='diet_history')
@@ -0,0 +1,37 @@
+"""daily_intake rollup table
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-19 00:00:00
+
+Per-user, per-local-date totals kept up to date by save_diet_history.
+Fill it for existing history with `python -m backend.scripts.rebuild_daily_intake`.
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0003'
+down_revision: Union[str, None] = '0002'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        'daily_intake',
+        sa.Column('user', sa.String(45), primary_key=True),
+        sa.Column('date', sa.Date(), primary_key=True),
+        sa.Column('calories', sa.Integer(), nullable=False),
+        sa.Column('protein', sa.Integer(), nullable=False),
+        sa.Column('carbohydrates', sa.Integer(), nullable=False),
+        sa.Column('fat', sa.Integer(), nullable=False),
+        sa.Column('meal_count', sa.Integer(), nullable=False),
+    )
+
+
+def downgrade() -> None:
+    op.drop_table('daily_intake')
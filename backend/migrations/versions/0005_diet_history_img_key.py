@@ -0,0 +1,28 @@
+"""diet_history.img_key for background image uploads
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2026-10-19 00:00:00
+
+save_diet_history stores the object key with the row and fills in img_url once
+the upload executor has finished the upload.
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0005'
+down_revision: Union[str, None] = '0004'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column('diet_history', sa.Column('img_key', sa.String(255), nullable=True))
+
+
+def downgrade() -> None:
+    op.drop_column('diet_history', 'img_key')
@@ -0,0 +1,28 @@
+"""diet_history.img_set for resized image derivatives
+
+Revision ID: 0007
+Revises: 0006
+Create Date: 2026-10-19 00:00:00
+
+Key prefix of the thumb/card/full WebP and JPEG copies of the row's photo,
+filled in by the upload executor after the original has been stored.
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0007'
+down_revision: Union[str, None] = '0006'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column('diet_history', sa.Column('img_set', sa.String(255), nullable=True))
+
+
+def downgrade() -> None:
+    op.drop_column('diet_history', 'img_set')
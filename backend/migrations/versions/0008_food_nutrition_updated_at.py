@@ -0,0 +1,32 @@
+"""food_nutrition.updated_at for incremental food catalogue refreshes
+
+Revision ID: 0008
+Revises: 0007
+Create Date: 2026-10-19 00:00:00
+
+The in-memory food catalogue only reloads rows changed since its last refresh.
+Existing rows are stamped with the migration time (UTC).
+"""
+from datetime import datetime
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0008'
+down_revision: Union[str, None] = '0007'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column('food_nutrition', sa.Column('updated_at', sa.DateTime(), nullable=True))
+    op.execute(sa.text("UPDATE food_nutrition SET updated_at = :now").bindparams(now=datetime.utcnow()))
+    op.create_index('ix_food_nutrition_updated_at', 'food_nutrition', ['updated_at'])
+
+
+def downgrade() -> None:
+    op.drop_index('ix_food_nutrition_updated_at', table_name='food_nutrition')
+    op.drop_column('food_nutrition', 'updated_at')
@@ -0,0 +1,29 @@
+"""diet_history.time_zone for rebuilding the daily_intake rollup
+
+Revision ID: 0010
+Revises: 0009
+Create Date: 2026-10-19 00:00:00
+
+The zone each meal's local date was taken in when it was added to
+daily_intake. Rows saved before this revision have none, the rebuild script
+uses its --time-zone for them.
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0010'
+down_revision: Union[str, None] = '0009'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column('diet_history', sa.Column('time_zone', sa.String(length=64), nullable=True))
+
+
+def downgrade() -> None:
+    op.drop_column('diet_history', 'time_zone')
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, DateTime
+from sqlalchemy import Column, Integer, String, DateTime, Date, Index, LargeBinary
 from sqlalchemy.ext.declarative import declarative_base
 import datetime
 
@@ -23,11 +23,16 @@ class User(Base):
     target_protein = Column(Integer)
     target_carbohydrates = Column(Integer)
     target_fat = Column(Integer)
+    data_version = Column(Integer, nullable=False, default=0, server_default="0")  # Bumped on every profile/history write, backs the ETags
 
 
 # Diet Model (equivalent to diet_history table, with ForeignKey to User)
 class Diet(Base):
     __tablename__ = "diet_history"
+    __table_args__ = (
+        # Per-user date range lookups and newest-first listing
+        Index("ix_diet_history_user_datetime", "user", "datetime"),
+    )
     id = Column(Integer, primary_key=True, index=True, autoincrement=True)
     user = Column(String(45))
     meal = Column(String(45))  # Meal type (breakfast, lunch, etc.)
@@ -36,7 +41,32 @@ class Diet(Base):
     carbohydrates = Column(Integer)
     fat = Column(Integer)
     datetime = Column(DateTime)
-    img_url = Column(String(255))
+    time_zone = Column(String(64))  # Zone whose calendar date the meal was counted on in daily_intake
+    img_key = Column(String(255))  # Storage key (content SHA-256 for server-side uploads), set when the row is saved
+    img_url = Column(String(255))  # Filled in once the upload has finished
+    img_set = Column(String(255))  # Key prefix of the resized WebP/JPEG derivatives, see image_derivatives
+    embedding = Column(LargeBinary)  # float16 image embedding for similar meal suggestions, see meal_index
+
+
+# Daily Intake Model (per-user rollup of diet_history, maintained by save_diet_history)
+class DailyIntake(Base):
+    __tablename__ = "daily_intake"
+    user = Column(String(45), primary_key=True)
+    date = Column(Date, primary_key=True)  # Local calendar date the meals were eaten on
+    calories = Column(Integer, nullable=False, default=0)
+    protein = Column(Integer, nullable=False, default=0)
+    carbohydrates = Column(Integer, nullable=False, default=0)
+    fat = Column(Integer, nullable=False, default=0)
+    meal_count = Column(Integer, nullable=False, default=0)
+
+
+# Image Object Model (stored images, shared by every diet_history row with the same content)
+class ImageObject(Base):
+    __tablename__ = "image_object"
+    key = Column(String(255), primary_key=True)
+    refcount = Column(Integer, nullable=False, default=0)  # diet_history rows referencing the object
+    size = Column(Integer)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
 
 
 # Food Model (independent)
@@ -48,6 +78,8 @@ class Food(Base):
     protein = Column(Integer)
     carbohydrates = Column(Integer)
     fat = Column(Integer)
+    updated_at = Column(DateTime, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow,
+                        index=True)  # Incremental refresh of the in-memory food catalogue
 
 
 # Workout Model (independent)
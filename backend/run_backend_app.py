@@ -1,13 +1,16 @@
 from fastapi import FastAPI
+from fastapi.responses import ORJSONResponse
 from fastapi.middleware.cors import CORSMiddleware  # Import CORS middleware
 import sys
 import os
 
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from backend.utils.food_catalogue import lifespan
 import api.endpoints_app as endpoints
 
-# Create FastAPI app instance
-app = FastAPI(debug=True)
+# Create FastAPI app instance, responses are rendered with orjson
+# The lifespan loads the in-memory food catalogue before serving
+app = FastAPI(debug=True, default_response_class=ORJSONResponse, lifespan=lifespan)
 
 # Configure CORS settings to allow the frontend (Flask) to access this backend
 app.add_middleware(
@@ -0,0 +1,76 @@
+"""Compute the similar-meal embeddings of saved photos that do not have one yet.
+
+    python -m backend.scripts.backfill_meal_embeddings [--user USER] [--all]
+
+New saves are embedded by the upload executor, this fills in rows saved before
+diet_history.embedding existed. --all recomputes every embedding, e.g. after the
+descriptor in meal_index changed. Each stored photo is read and embedded once,
+however many rows share it. Legacy rows that only have an img_url (saved before
+img_key existed) are downloaded from that URL.
+"""
+import argparse
+
+import httpx
+from sqlalchemy import select, update, or_, case
+
+from backend.models.database import Diet
+from backend.utils.db_session import SessionLocal
+from backend.utils.storage import storage
+from backend.utils.util import meal_embedding
+
+
+def backfill_meal_embeddings(db, user: str = None, recompute: bool = False):
+    # The URL only matters for rows without a key, so rows sharing a key are still read once
+    legacy_url = case((Diet.img_key.is_(None), Diet.img_url)).label("img_url")
+    stmt = select(Diet.user, Diet.img_key, legacy_url).where(
+        or_(Diet.img_key.isnot(None), Diet.img_url.isnot(None))
+    ).distinct()
+    if not recompute:
+        stmt = stmt.where(Diet.embedding.is_(None))
+    if user:
+        stmt = stmt.where(Diet.user == user)
+
+    embedded = 0
+    with httpx.Client(timeout=30) as client:
+        for row in db.execute(stmt).all():
+            try:
+                if row.img_key:
+                    image_bytes = storage.get(row.img_key)
+                else:
+                    response = client.get(row.img_url)
+                    response.raise_for_status()
+                    image_bytes = response.content
+            except Exception as e:
+                print(f"Skipping {row.img_key or row.img_url}: {e}")
+                continue
+            embedding = meal_embedding(image_bytes)
+            if embedding is None:
+                continue
+
+            # Rows are matched on the key, or on the URL for legacy rows without one
+            if row.img_key:
+                same_image = Diet.img_key == row.img_key
+            else:
+                same_image = Diet.img_key.is_(None) & (Diet.img_url == row.img_url)
+            db.execute(update(Diet).where(Diet.user == row.user, same_image).values(embedding=embedding))
+            db.commit()
+            embedded += 1
+    return embedded
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--user", help="only embed this user's photos")
+    parser.add_argument("--all", action="store_true", help="recompute existing embeddings too")
+    args = parser.parse_args()
+
+    db = SessionLocal()
+    try:
+        count = backfill_meal_embeddings(db, args.user, args.all)
+    finally:
+        db.close()
+    print(f"Embedded {count} photos")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""Build the tiny ONNX model bundled for testing the local food classifier.
+
+    python -m backend.scripts.build_test_food_classifier [--output backend/assets/food_classifier_test.onnx]
+
+The model averages the normalized image per channel and picks the nearest of a few
+food colours (white rice, green salad, tomato soup, ...). It only exercises the
+classifier plumbing (input layout, batching, labels metadata), it is not a real
+food model. Needs the onnx package, which the server itself does not.
+"""
+import argparse
+import json
+
+import numpy as np
+import onnx
+from onnx import TensorProto, helper, numpy_helper
+
+from backend.utils.food_classifier import IMAGE_MEAN, IMAGE_STD, TEST_MODEL_PATH
+
+INPUT_SIZE = 64
+# Label -> typical RGB colour of the dish
+FOOD_COLOURS = {
+    "White Rice": (235, 232, 222),
+    "Green Salad": (70, 140, 50),
+    "Tomato Soup": (190, 50, 30),
+    "Fried Chicken": (170, 110, 50),
+    "Black Coffee": (40, 25, 20),
+}
+SHARPNESS = 4.0  # Scales the logits, higher gives more confident predictions near a colour
+
+
+def build_model():
+    labels = list(FOOD_COLOURS)
+    centroids = (np.array(list(FOOD_COLOURS.values()), dtype=np.float32) / 255 - IMAGE_MEAN.ravel()) / IMAGE_STD.ravel()
+
+    # Nearest centroid as a linear layer: -|x - c|^2 = 2 x.c - |c|^2 - |x|^2, the last term is the same for every class
+    weights = numpy_helper.from_array((2 * SHARPNESS * centroids.T).astype(np.float32), "weights")
+    bias = numpy_helper.from_array((-SHARPNESS * (centroids ** 2).sum(axis=1)).astype(np.float32), "bias")
+
+    graph = helper.make_graph(
+        [
+            helper.make_node("GlobalAveragePool", ["image"], ["pooled"]),
+            helper.make_node("Flatten", ["pooled"], ["features"]),
+            helper.make_node("Gemm", ["features", "weights", "bias"], ["logits"]),
+        ],
+        "food_classifier_test",
+        [helper.make_tensor_value_info("image", TensorProto.FLOAT, ["batch", 3, INPUT_SIZE, INPUT_SIZE])],
+        [helper.make_tensor_value_info("logits", TensorProto.FLOAT, ["batch", len(labels)])],
+        [weights, bias],
+    )
+    model = helper.make_model(graph, opset_imports=[helper.make_opsetid("", 13)])
+    model.ir_version = 8  # Loadable by older onnxruntime releases too
+    helper.set_model_props(model, {"labels": json.dumps(labels)})
+    onnx.checker.check_model(model)
+    return model
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--output", default=str(TEST_MODEL_PATH))
+    args = parser.parse_args()
+
+    onnx.save(build_model(), args.output)
+    print(f"Wrote {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""Rebuild the daily_intake rollup from diet_history.
+
+    python -m backend.scripts.rebuild_daily_intake [--user USER] [--time-zone Asia/Taipei]
+
+Existing rollup rows (for USER, or all users) are replaced in a single transaction.
+Each meal is dated in the time zone it was saved with (diet_history.time_zone),
+--time-zone only applies to rows saved before that column existed.
+
+The affected daily_intake range is locked (SELECT ... FOR UPDATE, which also locks
+the gaps for dates not written yet) before the history is read. Every save and
+import upserts into that range, so they wait for the rebuild instead of landing
+between its read and its rewrite. SQLite ignores FOR UPDATE, run it there only
+while nothing else writes.
+"""
+import argparse
+
+from sqlalchemy import select, delete, insert
+
+from backend.models.database import Diet, DailyIntake
+from backend.utils.db_session import SessionLocal
+from backend.utils.util import DEFAULT_TIME_ZONE, local_date
+
+
+def rebuild_daily_intake(db, time_zone: str, user: str = None):
+    # Held until the commit: a save already in the range is waited for (and then read), later ones wait for us
+    locked = select(DailyIntake.user).with_for_update()
+    if user:
+        locked = locked.where(DailyIntake.user == user)
+    db.execute(locked).all()
+
+    stmt = select(Diet.user, Diet.datetime, Diet.time_zone, Diet.calories, Diet.protein, Diet.carbohydrates, Diet.fat)
+    if user:
+        stmt = stmt.where(Diet.user == user)
+
+    # Stream the history and total it per (user, local date)
+    totals = {}
+    for row in db.execute(stmt.execution_options(yield_per=10000)):
+        key = (row.user, local_date(row.datetime, row.time_zone or time_zone))
+        day = totals.setdefault(key, {"calories": 0, "protein": 0, "carbohydrates": 0, "fat": 0, "meal_count": 0})
+        day["calories"] += row.calories or 0
+        day["protein"] += row.protein or 0
+        day["carbohydrates"] += row.carbohydrates or 0
+        day["fat"] += row.fat or 0
+        day["meal_count"] += 1
+
+    clear = delete(DailyIntake)
+    if user:
+        clear = clear.where(DailyIntake.user == user)
+    db.execute(clear)
+
+    rows = [{"user": key[0], "date": key[1], **day} for key, day in totals.items()]
+    for i in range(0, len(rows), 1000):
+        db.execute(insert(DailyIntake), rows[i:i + 1000])
+    db.commit()
+
+    return len(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--user", help="only rebuild this user's rollup")
+    parser.add_argument("--time-zone", default=DEFAULT_TIME_ZONE, help="time zone that decides the date of meals saved without one")
+    args = parser.parse_args()
+
+    db = SessionLocal()
+    try:
+        count = rebuild_daily_intake(db, args.time_zone, args.user)
+    finally:
+        db.close()
+    print(f"Rebuilt {count} daily_intake rows")
+
+
+if __name__ == "__main__":
+    main()
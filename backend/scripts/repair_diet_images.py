@@ -0,0 +1,74 @@
+"""Report and repair diet entries whose photo never finished storing.
+
+    python -m backend.scripts.repair_diet_images [--min-age-seconds 600] [--clear-lost]
+
+Saved photos are uploaded in the background (store_diet_image), until then the row
+has an img_key but no img_url. Rows still like that after --min-age-seconds are
+repaired when the object is in storage after all (img_url set, derivatives and
+embedding generated). Otherwise the photo was lost with a failed upload or a crash,
+and the rows are listed; --clear-lost drops the key from them, so they show as
+entries without a photo.
+"""
+import argparse
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, update, delete, func
+
+from backend.models.database import Diet, ImageObject
+from backend.utils.db_session import SessionLocal
+from backend.utils.storage import storage
+from backend.utils.util import bump_data_version, store_image_derivatives
+
+
+def repair_diet_images(db, min_age_seconds: int = 600, clear_lost: bool = False):
+    # Returns (repaired, lost) numbers of (user, image) pairs
+    cutoff = datetime.utcnow() - timedelta(seconds=min_age_seconds)
+    stmt = select(Diet.user, Diet.img_key, func.count().label("entries")).outerjoin(
+        ImageObject, ImageObject.key == Diet.img_key
+    ).where(
+        Diet.img_key.isnot(None), Diet.img_url.is_(None),
+        # Uploads still in flight are left alone, rows without an object row are old enough
+        (ImageObject.created_at < cutoff) | ImageObject.created_at.is_(None)
+    ).group_by(Diet.user, Diet.img_key)
+
+    repaired = lost = 0
+    for row in db.execute(stmt).all():
+        pending = (Diet.user == row.user, Diet.img_key == row.img_key, Diet.img_url.is_(None))
+        if storage.exists(row.img_key):
+            db.execute(update(Diet).where(*pending).values(img_url=storage.url(row.img_key)))
+            db.execute(bump_data_version(row.user))
+            db.commit()
+            store_image_derivatives(row.user, row.img_key)
+            repaired += 1
+            continue
+
+        lost += 1
+        print(f"Lost {row.img_key}: {row.entries} entries of {row.user}")
+        if clear_lost:
+            db.execute(update(Diet).where(*pending).values(img_key=None))
+            db.execute(update(ImageObject).where(ImageObject.key == row.img_key).values(
+                refcount=ImageObject.refcount - row.entries
+            ))
+            db.execute(delete(ImageObject).where(ImageObject.key == row.img_key, ImageObject.refcount <= 0))
+            db.execute(bump_data_version(row.user))
+            db.commit()
+    return repaired, lost
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--min-age-seconds", type=int, default=600,
+                        help="only consider photos saved longer ago than this")
+    parser.add_argument("--clear-lost", action="store_true", help="remove the image key from entries whose photo is lost")
+    args = parser.parse_args()
+
+    db = SessionLocal()
+    try:
+        repaired, lost = repair_diet_images(db, args.min_age_seconds, args.clear_lost)
+    finally:
+        db.close()
+    print(f"Repaired {repaired} photos, {lost} lost" + (" (cleared)" if args.clear_lost and lost else ""))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,29 @@
+"""Delete LINE photos that were staged for saving but never saved.
+
+    python -m backend.scripts.sweep_staged_images [--max-age-seconds 3600]
+
+Staged images are stored under their final content key with refcount 0, so a
+prefix lifecycle rule cannot tell them apart from saved ones. Run this from cron.
+"""
+import argparse
+
+from backend.utils.db_session import SessionLocal
+from backend.utils.util import STAGED_IMAGE_TTL_SECONDS, sweep_staged_images
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--max-age-seconds", type=int, default=STAGED_IMAGE_TTL_SECONDS,
+                        help="delete staged images unreferenced for longer than this")
+    args = parser.parse_args()
+
+    db = SessionLocal()
+    try:
+        count = sweep_staged_images(db, args.max_age_seconds)
+    finally:
+        db.close()
+    print(f"Deleted {count} abandoned staged images")
+
+
+if __name__ == "__main__":
+    main()
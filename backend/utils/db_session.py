@@ -1,6 +1,10 @@
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool, AsyncAdaptedQueuePool
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from backend.utils import metrics
 import os
+import time
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -10,15 +14,90 @@ DB_HOST = os.getenv("DB_HOST")
 DB_PORT = os.getenv("DB_PORT")
 DB_NAME = os.getenv("DB_NAME")
 
+# Optional read replica (defaults to the primary credentials and port)
+DB_REPLICA_HOST = os.getenv("DB_REPLICA_HOST")
+DB_REPLICA_PORT = os.getenv("DB_REPLICA_PORT", DB_PORT)
+
+# Connection pool settings
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 10))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", 20))
+DB_POOL_TIMEOUT = int(os.getenv("DB_POOL_TIMEOUT", 30))  # Seconds to wait for a free connection
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", 1800))  # Stay below MySQL's wait_timeout
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() == "true"
+
 # Construct the SQLALCHEMY_DATABASE_URL dynamically using the retrieved environment variables
-SQLALCHEMY_DATABASE_URL = f"mysql+pymysql://{DB_USERNAME}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
+SQLALCHEMY_DATABASE_URL = os.getenv(
+    "DATABASE_URL",
+    f"mysql+pymysql://{DB_USERNAME}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
+)
+
+# Async driver URL used by the API (e.g. "sqlite+aiosqlite:///./test.db" for tests)
+ASYNC_SQLALCHEMY_DATABASE_URL = os.getenv(
+    "ASYNC_DATABASE_URL",
+    f"mysql+aiomysql://{DB_USERNAME}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
+)
+
+# Async URL for read-only queries, falls back to the primary when no replica is configured
+if DB_REPLICA_HOST:
+    default_replica_url = f"mysql+aiomysql://{DB_USERNAME}:{DB_PASSWORD}@{DB_REPLICA_HOST}:{DB_REPLICA_PORT}/{DB_NAME}"
+else:
+    default_replica_url = None
+ASYNC_READ_REPLICA_DATABASE_URL = os.getenv("ASYNC_READ_REPLICA_DATABASE_URL", default_replica_url)
+
+
+# Queue pool that records how long each checkout waited for a connection
+class TimedQueuePool(QueuePool):
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            metrics.observe(f"db_pool_checkout.{self.logging_name}", time.perf_counter() - start)
+
+
+class TimedAsyncAdaptedQueuePool(TimedQueuePool, AsyncAdaptedQueuePool):
+    pass
+
+
+def engine_options(url: str, poolclass, name: str):
+    # SQLite (tests) manages its own connections, pool tuning only applies to server databases
+    if url.startswith("sqlite"):
+        return {}
+
+    return {
+        "poolclass": poolclass,
+        "pool_logging_name": name,
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_MAX_OVERFLOW,
+        "pool_timeout": DB_POOL_TIMEOUT,
+        "pool_recycle": DB_POOL_RECYCLE,
+        "pool_pre_ping": DB_POOL_PRE_PING,
+    }
+
 
-# Create engine for the single database
-engine = create_engine(SQLALCHEMY_DATABASE_URL)
+# Create engine for the single database (used by scripts and background jobs)
+engine = create_engine(SQLALCHEMY_DATABASE_URL, **engine_options(SQLALCHEMY_DATABASE_URL, TimedQueuePool, "sync"))
 
 # Create a session maker for the single database
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# Create the async engine and session maker used by the FastAPI backends
+async_engine = create_async_engine(
+    ASYNC_SQLALCHEMY_DATABASE_URL,
+    **engine_options(ASYNC_SQLALCHEMY_DATABASE_URL, TimedAsyncAdaptedQueuePool, "primary")
+)
+AsyncSessionLocal = async_sessionmaker(bind=async_engine, autoflush=False, expire_on_commit=False)
+
+# Read-only sessions go to the replica when one is configured
+if ASYNC_READ_REPLICA_DATABASE_URL:
+    async_read_engine = create_async_engine(
+        ASYNC_READ_REPLICA_DATABASE_URL,
+        **engine_options(ASYNC_READ_REPLICA_DATABASE_URL, TimedAsyncAdaptedQueuePool, "replica")
+    )
+else:
+    async_read_engine = async_engine
+AsyncReadSessionLocal = async_sessionmaker(bind=async_read_engine, autoflush=False, expire_on_commit=False)
+
 
 # Dependency to get the database session (single session for all tables)
 def get_db():
@@ -27,3 +106,33 @@ def get_db():
         yield db
     finally:
         db.close()
+
+
+# Async dependency to get the database session without blocking the event loop
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
+
+# Async dependency for read-only queries (history, today's totals, profile)
+async def get_async_read_db():
+    async with AsyncReadSessionLocal() as db:
+        yield db
+
+
+def get_pool_stats():
+    engines = {"sync": engine, "primary": async_engine.sync_engine}
+    if async_read_engine is not async_engine:
+        engines["replica"] = async_read_engine.sync_engine
+
+    stats = {}
+    for name, pool_engine in engines.items():
+        pool = pool_engine.pool
+        stats[name] = {"status": pool.status()}
+        if isinstance(pool, QueuePool):
+            stats[name].update({
+                "size": pool.size(),
+                "checked_out": pool.checkedout(),
+                "overflow": pool.overflow(),
+            })
+    return stats
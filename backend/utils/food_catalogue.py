@@ -0,0 +1,227 @@
+from array import array
+from bisect import bisect_left
+from collections import Counter, defaultdict
+from contextlib import asynccontextmanager
+from sqlalchemy import select
+from backend.models.database import Food
+from backend.utils.db_session import AsyncReadSessionLocal
+from backend.utils import metrics
+from itertools import chain
+import asyncio
+import heapq
+import math
+import os
+import time
+import unicodedata
+
+# In-memory copy of the food_nutrition table for autocomplete and label lookups, so common foods
+# resolve without a model call. Loaded at startup, then refreshed from food_nutrition.updated_at
+FOOD_CATALOGUE_REFRESH_SECONDS = int(os.getenv("FOOD_CATALOGUE_REFRESH_SECONDS", 300))
+FOOD_CATALOGUE_FULL_RELOAD_SECONDS = int(os.getenv("FOOD_CATALOGUE_FULL_RELOAD_SECONDS", 3600))  # Picks up deletes
+FOOD_SEARCH_MIN_SIMILARITY = 0.3
+FOOD_SEARCH_MAX_LIMIT = 50
+FOOD_PREFIX_SCAN_LIMIT = 1000  # Prefix keys examined per search, bounds one-letter queries
+FOOD_RESOLVE_MIN_SIMILARITY = float(os.getenv("FOOD_RESOLVE_MIN_SIMILARITY", 0.6))  # Stricter than autocomplete
+FOOD_COLUMNS = (Food.id, Food.food, Food.calories, Food.protein, Food.carbohydrates, Food.fat, Food.updated_at)
+
+MISSING = -1  # NULL nutrient values in the int arrays
+MATCH_RANKS = ("exact", "prefix", "fuzzy")
+
+
+def normalize(text: str):
+    # Case-, width- and whitespace-insensitive form used for every comparison
+    return " ".join(unicodedata.normalize("NFKC", text).casefold().split())
+
+
+def trigrams(text: str):
+    # Every word padded on its own like pg_trgm, so a misspelt word still matches inside a longer name
+    grams = set()
+    for word in text.split():
+        padded = f"  {word} "
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+class FoodIndex:
+    # Immutable snapshot: one array per column, sorted prefix keys and trigram postings.
+    # A refresh builds a new index and swaps it in, searches never see a half-built one
+    def __init__(self, rows):
+        rows = sorted(rows, key=lambda row: row.id)
+        self.ids = array("i", (row.id for row in rows))
+        self.names = [row.food or "" for row in rows]
+        self.nutrients = {
+            column: array("i", (MISSING if getattr(row, column) is None else getattr(row, column) for row in rows))
+            for column in ("calories", "protein", "carbohydrates", "fat")
+        }
+        self.normalized = [normalize(name) for name in self.names]
+        self.positions = {food_id: position for position, food_id in enumerate(self.ids)}
+        self.by_name = {}  # Normalized name -> position, the lowest id wins for duplicate names
+        for position, name in enumerate(self.normalized):
+            self.by_name.setdefault(name, position)
+
+        # Prefix keys: every whole name and every later word of a name, with the row they belong to
+        keys = set()
+        for position, name in enumerate(self.normalized):
+            if name:
+                keys.add((name, position))
+                keys.update((word, position) for word in name.split()[1:])
+        keys = sorted(keys)
+        self.keys = [key for key, _ in keys]
+        self.key_positions = array("i", (position for _, position in keys))
+
+        # Trigram postings for fuzzy matches
+        postings = defaultdict(list)
+        self.trigram_counts = array("H")
+        for position, name in enumerate(self.normalized):
+            grams = trigrams(name) if name else set()
+            self.trigram_counts.append(len(grams))
+            for gram in grams:
+                postings[gram].append(position)
+        self.postings = {gram: array("i", positions) for gram, positions in postings.items()}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def entry(self, position: int, match: str = None, score: float = None):
+        entry = {"id": self.ids[position], "food": self.names[position]}
+        for column, values in self.nutrients.items():
+            entry[column] = None if values[position] == MISSING else values[position]
+        if match:
+            entry["match"] = match
+            entry["score"] = round(score, 3)
+        return entry
+
+    def get(self, food_id: int):
+        position = self.positions.get(food_id)
+        return None if position is None else self.entry(position)
+
+    def resolve(self, name: str, min_similarity: float = FOOD_RESOLVE_MIN_SIMILARITY):
+        # The catalogue entry a detected label refers to: same normalized name, else the most similar name.
+        # Prefix matches don't count ("chicken" is not "chicken fried rice"), only the similarity does
+        position = self.by_name.get(normalize(name))
+        if position is not None:
+            return self.entry(position, "exact", 1.0)
+
+        similarities = self.similarities(trigrams(normalize(name)), min_similarity)
+        best = max(similarities, key=similarities.get, default=None)
+        if best is None or similarities[best] < min_similarity:
+            return None
+        return self.entry(best, "fuzzy", similarities[best])
+
+    def search(self, query: str, limit: int = 10):
+        # Exact names first, then name or word prefixes, then trigram similarity above the threshold
+        query = normalize(query)
+        if not query:
+            return []
+        query_grams = trigrams(query)
+
+        ranks = {}
+        start = bisect_left(self.keys, query)
+        for i in range(start, min(start + FOOD_PREFIX_SCAN_LIMIT, len(self.keys))):
+            if not self.keys[i].startswith(query):
+                break
+            position = self.key_positions[i]
+            ranks[position] = 0 if self.normalized[position] == query else 1
+
+        if len(ranks) >= limit:
+            # Enough exact and prefix matches, fuzzy ones would rank below all of them
+            matches = sorted((rank, len(self.normalized[position]), position) for position, rank in ranks.items())
+            return [self.entry(position, MATCH_RANKS[rank], self.similarity(query_grams, position))
+                    for rank, _, position in matches[:limit]]
+
+        matches = []
+        for position, similarity in self.similarities(query_grams, FOOD_SEARCH_MIN_SIMILARITY, ranks).items():
+            # Prefix matches always share the query's leading trigram, so every one of them is counted
+            rank = ranks.get(position, 2)
+            if rank < 2 or similarity >= FOOD_SEARCH_MIN_SIMILARITY:
+                matches.append((rank, -similarity, len(self.normalized[position]), position))
+
+        matches = heapq.nsmallest(limit, matches)
+        return [self.entry(position, MATCH_RANKS[rank], -similarity) for rank, similarity, _, position in matches]
+
+    def similarities(self, query_grams: set, min_similarity: float, include=()):
+        # position -> trigram similarity for the rows that can reach min_similarity (and those in include).
+        # Shared trigrams are counted in C by Counter over the query's postings, a row similar enough shares
+        # at least `required` of them, the rest (rows sharing a common word or two) are dropped cheaply
+        shared = Counter(chain.from_iterable(self.postings.get(gram, ()) for gram in query_grams))
+        required = math.ceil(min_similarity * len(query_grams))
+        return {
+            position: count / (len(query_grams) + self.trigram_counts[position] - count)
+            for position, count in shared.items() if count >= required or position in include
+        }
+
+    def similarity(self, query_grams: set, position: int):
+        grams = trigrams(self.normalized[position])
+        shared = len(query_grams & grams)
+        return shared / (len(query_grams) + len(grams) - shared)
+
+
+class FoodCatalogue:
+    def __init__(self):
+        self.index = FoodIndex([])
+        self.rows = {}  # id -> row, the source the index is rebuilt from
+        self.watermark = None  # Latest food_nutrition.updated_at seen
+
+    async def refresh(self, full: bool = False):
+        # Only rows changed since the watermark are read, the index is rebuilt when something differs
+        start = time.perf_counter()
+        stmt = select(*FOOD_COLUMNS)
+        if self.watermark and not full:
+            # >= because the column may only have second precision, unchanged rows are skipped below
+            stmt = stmt.where(Food.updated_at >= self.watermark)
+        async with AsyncReadSessionLocal() as db:
+            changed = (await db.execute(stmt)).all()
+
+        rows = {} if full else dict(self.rows)
+        modified = full
+        for row in changed:
+            if rows.get(row.id) != row:
+                rows[row.id] = row
+                modified = True
+            if row.updated_at and (self.watermark is None or row.updated_at > self.watermark):
+                self.watermark = row.updated_at
+
+        if modified:
+            # Building the index is CPU bound, keep it off the event loop
+            self.index = await asyncio.to_thread(FoodIndex, rows.values())
+            self.rows = rows
+        metrics.observe("food_catalogue_refresh", time.perf_counter() - start)
+        return len(changed)
+
+    async def refresh_periodically(self):
+        last_full = time.monotonic()
+        while True:
+            await asyncio.sleep(FOOD_CATALOGUE_REFRESH_SECONDS)
+            full = time.monotonic() - last_full >= FOOD_CATALOGUE_FULL_RELOAD_SECONDS
+            try:
+                await self.refresh(full=full)
+                if full:
+                    last_full = time.monotonic()
+            except Exception as e:
+                metrics.increment("food_catalogue_refresh_errors")
+                print(f"Food catalogue refresh failed: {e}")
+
+    def search(self, query: str, limit: int = 10):
+        return self.index.search(query, min(limit, FOOD_SEARCH_MAX_LIMIT))
+
+    def get(self, food_id: int):
+        return self.index.get(food_id)
+
+    def resolve(self, name: str):
+        return self.index.resolve(name)
+
+
+food_catalogue = FoodCatalogue()
+
+
+@asynccontextmanager
+async def lifespan(app):
+    # Load the catalogue before serving requests, then keep it fresh in the background
+    try:
+        await food_catalogue.refresh(full=True)
+        print(f"Food catalogue loaded: {len(food_catalogue.index)} foods")
+    except Exception as e:
+        print(f"Food catalogue load failed, retrying in the background: {e}")
+    refresher = asyncio.create_task(food_catalogue.refresh_periodically())
+    yield
+    refresher.cancel()
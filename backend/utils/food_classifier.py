@@ -0,0 +1,176 @@
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from pathlib import Path
+from PIL import Image, ImageOps
+from backend.utils.food_catalogue import food_catalogue
+from backend.utils import metrics
+import numpy as np
+import io
+import json
+import os
+import queue
+import threading
+import time
+
+# Optional, only needed for the local food classifier
+try:
+    import onnxruntime as ort
+except ImportError:
+    ort = None
+
+# Local first-stage estimator: an ONNX image classifier on CPU, whose confident labels are looked up in the
+# food catalogue instead of calling a vision model. Disabled unless FOOD_CLASSIFIER_MODEL points to a model
+FOOD_CLASSIFIER_MODEL = os.getenv("FOOD_CLASSIFIER_MODEL")
+FOOD_CLASSIFIER_MIN_CONFIDENCE = float(os.getenv("FOOD_CLASSIFIER_MIN_CONFIDENCE", 0.85))
+FOOD_CLASSIFIER_SESSIONS = int(os.getenv("FOOD_CLASSIFIER_SESSIONS", max(1, (os.cpu_count() or 2) // 2)))
+FOOD_CLASSIFIER_BATCH_SIZE = int(os.getenv("FOOD_CLASSIFIER_BATCH_SIZE", 8))
+FOOD_CLASSIFIER_BATCH_WAIT_SECONDS = float(os.getenv("FOOD_CLASSIFIER_BATCH_WAIT_MS", 5)) / 1000
+FOOD_CLASSIFIER_TIMEOUT_SECONDS = float(os.getenv("FOOD_CLASSIFIER_TIMEOUT_SECONDS", 10))  # Then the vision model answers
+TEST_MODEL_PATH = Path(__file__).resolve().parent.parent / "assets" / "food_classifier_test.onnx"
+
+# Input normalization used by ImageNet-trained backbones, models read NCHW float32
+IMAGE_MEAN = np.array([0.485, 0.456, 0.406], dtype=np.float32).reshape(3, 1, 1)
+IMAGE_STD = np.array([0.229, 0.224, 0.225], dtype=np.float32).reshape(3, 1, 1)
+
+
+class FoodClassifier:
+    # A pool of inference sessions, one worker thread each. Callers queue preprocessed images and
+    # every worker runs whatever is queued (up to batch_size) as one batch, so concurrent photos share a run
+    def __init__(self, model_path: str = FOOD_CLASSIFIER_MODEL, sessions: int = FOOD_CLASSIFIER_SESSIONS,
+                 batch_size: int = FOOD_CLASSIFIER_BATCH_SIZE, batch_wait: float = FOOD_CLASSIFIER_BATCH_WAIT_SECONDS,
+                 min_confidence: float = FOOD_CLASSIFIER_MIN_CONFIDENCE, timeout: float = FOOD_CLASSIFIER_TIMEOUT_SECONDS):
+        self.model_path = model_path
+        self.sessions = sessions
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.min_confidence = min_confidence
+        self.timeout = timeout
+        self.labels = None
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.loaded = False
+        self.failed = False
+
+    @property
+    def enabled(self):
+        return bool(self.model_path) and ort is not None and not self.failed
+
+    def load(self):
+        # Sessions are created on first use, a model that fails to load disables the stage
+        with self.lock:
+            if self.loaded or self.failed:
+                return self.loaded
+            try:
+                options = ort.SessionOptions()
+                # The pool provides the parallelism, each session keeps to its share of the cores
+                options.intra_op_num_threads = max(1, (os.cpu_count() or 1) // self.sessions)
+                options.inter_op_num_threads = 1
+                sessions = [ort.InferenceSession(self.model_path, options, providers=["CPUExecutionProvider"])
+                            for _ in range(self.sessions)]
+
+                model_input = sessions[0].get_inputs()[0]
+                self.input_name = model_input.name
+                batch, _, height, width = model_input.shape
+                self.input_size = (width, height)
+                if isinstance(batch, int):
+                    self.batch_size = min(self.batch_size, batch)  # Fixed batch dimension in the model
+                # Class names are stored in the model's metadata as a JSON list
+                self.labels = json.loads(sessions[0].get_modelmeta().custom_metadata_map["labels"])
+            except Exception as e:
+                self.failed = True
+                print(f"Food classifier disabled, could not load {self.model_path}: {e}")
+                return False
+
+            for session in sessions:
+                threading.Thread(target=self.worker, args=(session,), daemon=True).start()
+            self.loaded = True
+            print(f"Food classifier loaded: {len(self.labels)} labels, {self.sessions} sessions")
+            return True
+
+    def preprocess(self, image_bytes):
+        image = Image.open(io.BytesIO(image_bytes))
+        image.draft("RGB", self.input_size)  # JPEGs decode straight at a reduced scale
+        image = ImageOps.exif_transpose(image).convert("RGB").resize(self.input_size, Image.BILINEAR)
+        pixels = np.asarray(image, dtype=np.float32).transpose(2, 0, 1) / 255
+        return (pixels - IMAGE_MEAN) / IMAGE_STD
+
+    def submit(self, image_bytes) -> Future:
+        # Future of (label, confidence). Preprocessing runs on the caller's thread, only inference is pooled
+        if not self.loaded and not self.load():
+            raise RuntimeError(f"Food classifier model {self.model_path} is not available")
+        future = Future()
+        self.queue.put((self.preprocess(image_bytes), future))
+        return future
+
+    def classify(self, image_bytes):
+        # Raises TimeoutError when the workers are backed up or stuck
+        return self.submit(image_bytes).result(timeout=self.timeout)
+
+    def worker(self, session):
+        while True:
+            batch = [self.queue.get()]
+            # Wait briefly for more photos to share the run with
+            deadline = time.monotonic() + self.batch_wait
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get(timeout=max(0.0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+
+            # Any failure fails the whole batch, the worker itself must keep running and no future may be left pending
+            start = time.perf_counter()
+            try:
+                outputs = session.run(None, {self.input_name: np.stack([pixels for pixels, _ in batch])})[0]
+                probabilities = softmax(outputs)
+                if len(probabilities) != len(batch):
+                    raise RuntimeError(f"Model returned {len(probabilities)} rows for {len(batch)} images")
+                results = []
+                for row in probabilities:
+                    best = int(row.argmax())
+                    results.append((self.labels[best], float(row[best])))
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            metrics.observe("food_classifier_batch", time.perf_counter() - start)
+            metrics.increment("food_classifier_images", len(batch))
+
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)
+
+    def estimate(self, image_bytes):
+        # Catalogue nutrition for a confidently classified photo, None to fall through to a vision model
+        if not self.enabled or not self.load():
+            return None
+
+        start = time.perf_counter()
+        try:
+            label, confidence = self.classify(image_bytes)
+        except FutureTimeoutError:
+            print(f"Food classifier timed out after {self.timeout}s")
+            metrics.increment("food_classifier_timeouts")
+            return None
+        except Exception as e:
+            print(f"Food classifier failed: {e}")
+            metrics.increment("food_classifier_errors")
+            return None
+        metrics.observe("food_classifier", time.perf_counter() - start)
+
+        food = food_catalogue.resolve(label) if confidence >= self.min_confidence else None
+        if food is None:
+            metrics.increment("food_classifier_fallbacks")
+            return None
+
+        metrics.increment("food_classifier_hits")
+        print(f"Food classifier: {label} ({confidence:.2f}) -> {food['food']}")
+        return {column: food[column] or 0 for column in ("protein", "carbohydrates", "fat")}
+
+
+def softmax(outputs: np.ndarray):
+    # Models may end in a softmax or return raw logits, rows that already are distributions are kept
+    if np.all(outputs >= 0) and np.allclose(outputs.sum(axis=1), 1, atol=1e-3):
+        return outputs
+    exp = np.exp(outputs - outputs.max(axis=1, keepdims=True))
+    return exp / exp.sum(axis=1, keepdims=True)
+
+
+food_classifier = FoodClassifier()
@@ -6,6 +6,10 @@ from PIL import Image, ImageDraw, ImageFont
 import glob
 from io import BytesIO
 
+# Labels, portions and boxes only: a faster, cheaper model is enough when the numbers come from the catalogue
+GEMINI_LABEL_MODEL = os.getenv("GEMINI_LABEL_MODEL", "gemini-1.5-flash")
+GEMINI_NUTRITION_MODEL = os.getenv("GEMINI_NUTRITION_MODEL", "gemini-1.5-pro")
+
 class FoodRecognition:
     def __init__(self, image_bytes):
         # Load environment variables from .env file
@@ -28,8 +32,9 @@ class FoodRecognition:
         # Upload the image bytes to Gemini
         self.file = genai.upload_file(self.image_buffer, mime_type="image/jpeg")
         
-        # Open image from bytes for dimensions
-        self.image = Image.open(BytesIO(image_bytes))
+        # Open image from the same buffer for dimensions (no second copy of the bytes)
+        self.image_buffer.seek(0)
+        self.image = Image.open(self.image_buffer)
         self.pixel = self.image.size
 
     def upload_to_gemini(self, path, mime_type=None):
@@ -38,76 +43,46 @@ class FoodRecognition:
         print(f"Uploaded file '{file.display_name}' as: {file.uri}")
         return file
 
-    def get_food_list(self):
-        """Get the list of food items from the image using Gemini."""
+    def get_food_items(self):
+        """Get the food items with their portion and bounding box, without nutrition."""
         model = genai.GenerativeModel(
-            model_name="gemini-1.5-pro",
+            model_name=GEMINI_LABEL_MODEL,
             generation_config=self.generation_config,
-            system_instruction="Analyze the provided image of a meal. Return a Python list of the food items, grouping together items that appear to be prepared and served as a single dish.",
-        )
-
-        chat_session = model.start_chat(
-            history=[
-                {
-                    "role": "user",
-                    "parts": [
-                        self.file,
-                    ],
-                },
-            ]
-        )
-
-        response = chat_session.send_message("run")
-        return response.text
-
-    def get_food_list_with_nutrition(self):
-        """Get the food items with their nutrition information"""
-        model = genai.GenerativeModel(
-            model_name="gemini-1.5-pro",
-            generation_config=self.generation_config,
-            system_instruction="""Analyze the provided image of a meal. Group together items that appear to be prepared and served as a single dish and return the json foramt:  
+            system_instruction="""Analyze the provided image of a meal. Group together items that appear to be prepared and served as a single dish.
+            Use short, common dish names as labels, estimate each portion in servings (1 = one typical single serving)
+            and return the json format:
             [
                 {
                     "label": "food_name",
-                    "nutrition": {
-                        "Calories": number,
-                        "Fat": number,
-                        "Protein": number,
-                        "Carbs": number
-                    }
+                    "servings": number,
+                    "bbox": [ymin, xmin, ymax, xmax]
                 }
-            ]"""
+            ]
+            Bounding box coordinates are normalized to 0-1000."""
         )
 
         chat_session = model.start_chat(history=[{"role": "user", "parts": [self.file]}])
         response = chat_session.send_message("run")
         return json.loads(response.text)
 
-    def get_bounding_boxes(self, food_list):
-        """Get the bounding boxes for the food items in the image."""
+    def get_nutrition(self, food_items):
+        """Get the nutrition of the given food items (label and servings) as they appear in the image."""
         model = genai.GenerativeModel(
-            model_name="gemini-1.5-pro",
+            model_name=GEMINI_NUTRITION_MODEL,
             generation_config=self.generation_config,
-            system_instruction="""
-                Return a bounding box for the list input. \n {
-                "food_name1": [ymin, xmin, ymax, xmax], 
-                "food_name2": [ymin, xmin, ymax, xmax], 
-                ...
-            }""",
-        )
-
-        chat_session = model.start_chat(
-            history=[
-                {
-                    "role": "user",
-                    "parts": [
-                        self.file,
-                        str(food_list),
-                    ],
-                },
-            ]
+            system_instruction="""Estimate the nutrition of the listed food items in the provided image of a meal,
+            for the given number of servings. Return the json format:
+            {
+                "food_name": {
+                    "Calories": number,
+                    "Fat": number,
+                    "Protein": number,
+                    "Carbs": number
+                }
+            }"""
         )
 
+        chat_session = model.start_chat(history=[{"role": "user", "parts": [self.file, json.dumps(food_items)]}])
         response = chat_session.send_message("run")
         return json.loads(response.text)
 
@@ -151,10 +126,10 @@ if __name__ == "__main__":
 
     for image_path in image_files[2:]:
         print(f"Processing image: {image_path}")
-        fr = FoodRecognition(image_path)
-        food_list = fr.get_food_list()
-        print("Food List:", food_list)
-        annotations = fr.get_bounding_boxes(food_list)
-        print("Bounding Boxes:", annotations)
+        with open(image_path, "rb") as f:
+            fr = FoodRecognition(f.read())
+        food_items = fr.get_food_items()
+        print("Food Items:", food_items)
+        annotations = {item["label"]: item["bbox"] for item in food_items}
         fr.plot_boxes_and_annotations(image_path, annotations)
         print("----------------------------------------------------")
\ No newline at end of file
@@ -0,0 +1,81 @@
+from PIL import Image, ImageOps
+from concurrent.futures import ProcessPoolExecutor
+from backend.utils.storage import storage, content_key
+import io
+import multiprocessing
+import os
+import threading
+
+# Resized copies of every stored meal photo, so each client downloads the smallest one that fits:
+#   thumb - history lists and the LINE overview rows (xxs)
+#   card  - the LINE carousel and the web history page
+#   full  - detail views
+# WebP for clients that accept it, JPEG as the fallback (LINE only accepts JPEG and PNG)
+DERIVATIVE_SIZES = {"thumb": 160, "card": 600, "full": 1600}  # Longest edge in pixels, never upscaled
+DERIVATIVE_FORMATS = {
+    "webp": ("WEBP", "image/webp", {"quality": 80, "method": 4}),
+    "jpg": ("JPEG", "image/jpeg", {"quality": 85, "optimize": True, "progressive": True}),
+}
+
+# Encoding is CPU bound, so it runs in worker processes (created on first use, not at import).
+# forkserver, not fork: the server is multi-threaded (event loop, DB pools, storage clients) by then
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", 2))
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=IMAGE_WORKERS, mp_context=multiprocessing.get_context("forkserver"))
+        return _pool
+
+
+def derivative_key(set_key: str, size: str, ext: str):
+    return f"{set_key}/{size}.{ext}"
+
+
+def derivative_urls(set_key: str):
+    # {"thumb": {"webp": url, "jpg": url}, "card": {...}, "full": {...}}, or None before the set exists
+    if not set_key:
+        return None
+    return {
+        size: {ext: storage.url(derivative_key(set_key, size, ext)) for ext in DERIVATIVE_FORMATS}
+        for size in DERIVATIVE_SIZES
+    }
+
+
+def make_derivatives(image_bytes: bytes):
+    # Runs in a worker process, returns {(size, ext): bytes}
+    image = ImageOps.exif_transpose(Image.open(io.BytesIO(image_bytes)))
+    if image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+
+    derivatives = {}
+    for size, edge in DERIVATIVE_SIZES.items():
+        resized = image.copy()
+        resized.thumbnail((edge, edge), Image.LANCZOS)
+        for ext, (pil_format, _, options) in DERIVATIVE_FORMATS.items():
+            buffer = io.BytesIO()
+            resized.save(buffer, format=pil_format, **options)
+            derivatives[size, ext] = buffer.getvalue()
+    return derivatives
+
+
+def store_derivatives(image_bytes: bytes):
+    # Generate and store the set for this image content (skipped if it already exists), returns its key
+    set_key = content_key(image_bytes, prefix="derivatives")
+
+    # The last derivative is written last, so its presence means the set is complete
+    last_size, last_ext = list(DERIVATIVE_SIZES)[-1], list(DERIVATIVE_FORMATS)[-1]
+    if storage.exists(derivative_key(set_key, last_size, last_ext)):
+        return set_key, False
+
+    # Worker processes receive a pickled copy, memoryviews cannot be pickled
+    if not isinstance(image_bytes, bytes):
+        image_bytes = bytes(image_bytes)
+    derivatives = get_pool().submit(make_derivatives, image_bytes).result()
+    for (size, ext), data in derivatives.items():
+        storage.put(derivative_key(set_key, size, ext), data, content_type=DERIVATIVE_FORMATS[ext][1])
+    return set_key, True
@@ -0,0 +1,67 @@
+from PIL import Image, ImageOps
+from backend.utils import metrics
+import numpy as np
+import io
+import os
+import time
+
+# Cheap checks on a small grayscale copy of a photo, before paying for a vision call.
+# Thresholds are for the QUALITY_MAX_EDGE copy on the 0-255 scale
+QUALITY_MAX_EDGE = 256
+QUALITY_MIN_STD = float(os.getenv("QUALITY_MIN_STD", 10))  # Below: nearly uniform frame, nothing in it
+QUALITY_MIN_MEAN = float(os.getenv("QUALITY_MIN_MEAN", 40))  # Below: too dark
+QUALITY_MAX_MEAN = float(os.getenv("QUALITY_MAX_MEAN", 220))  # Above: overexposed
+QUALITY_MAX_CLIPPED = 0.6  # Share of pixels crushed to black or blown out to white
+QUALITY_MIN_SHARPNESS = float(os.getenv("QUALITY_MIN_SHARPNESS", 50))  # Laplacian variance, below: blurry
+
+QUALITY_MESSAGES = {
+    "unreadable": "The image could not be read, please send a JPEG, PNG or WebP photo",
+    "empty": "No food found in the photo, please take a photo of your meal",
+    "dark": "The photo is too dark, please retake it with more light",
+    "bright": "The photo is overexposed, please retake it out of direct light",
+    "blurry": "The photo is too blurry, please hold the camera steady and retake it",
+}
+
+
+def grayscale_thumbnail(image_bytes):
+    image = Image.open(io.BytesIO(image_bytes))
+    image.draft("L", (QUALITY_MAX_EDGE * 2, QUALITY_MAX_EDGE * 2))  # JPEGs decode straight at a reduced scale
+    image = ImageOps.exif_transpose(image).convert("L")
+    image.thumbnail((QUALITY_MAX_EDGE, QUALITY_MAX_EDGE))
+    return np.asarray(image, dtype=np.float32)
+
+
+def check_image_quality(image_bytes):
+    # Returns the rejection reason (a QUALITY_MESSAGES key), or None for a usable photo
+    start = time.perf_counter()
+    metrics.increment("image_quality_checks")
+    try:
+        pixels = grayscale_thumbnail(image_bytes)
+    except Exception:
+        reason = "unreadable"
+    else:
+        reason = quality_issue(pixels)
+    metrics.observe("image_quality_check", time.perf_counter() - start)
+
+    if reason:
+        metrics.increment("image_quality_rejections")
+        metrics.increment(f"image_quality_rejections_{reason}")
+    return reason
+
+
+def quality_issue(pixels: np.ndarray):
+    # Darkness first: an underexposed frame also has little contrast, but retaking it with light helps
+    mean = pixels.mean()
+    if mean < QUALITY_MIN_MEAN or (pixels < 20).mean() > QUALITY_MAX_CLIPPED:
+        return "dark"
+    if pixels.std() < QUALITY_MIN_STD:
+        return "empty"
+    if mean > QUALITY_MAX_MEAN or (pixels > 235).mean() > QUALITY_MAX_CLIPPED:
+        return "bright"
+
+    # Variance of the 4-neighbour Laplacian: few sharp edges means a blurry photo
+    laplacian = (pixels[1:-1, :-2] + pixels[1:-1, 2:] + pixels[:-2, 1:-1] + pixels[2:, 1:-1]
+                 - 4 * pixels[1:-1, 1:-1])
+    if laplacian.var() < QUALITY_MIN_SHARPNESS:
+        return "blurry"
+    return None
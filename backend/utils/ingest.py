@@ -0,0 +1,52 @@
+from fastapi import HTTPException, UploadFile
+import hashlib
+import mmap
+import os
+import tempfile
+
+# Streamed ingestion of uploaded photos: read in chunks with a hard size cap, hash while reading,
+# keep small files in memory and spool large ones to disk (memory-mapped afterwards)
+INGEST_CHUNK_BYTES = 64 * 1024
+INGEST_SPOOL_BYTES = int(os.getenv("INGEST_SPOOL_BYTES", 1024 * 1024))
+
+
+class IngestedUpload:
+    def __init__(self, data: memoryview, sha256: str, content_type: str = None, filename: str = None):
+        self.data = data  # Read-only view of the whole file, in memory or mapped from the spool file
+        self.sha256 = sha256
+        self.size = data.nbytes
+        self.content_type = content_type
+        self.filename = filename
+
+
+async def ingest_upload(upload: UploadFile, max_bytes: int, spool_bytes: int = INGEST_SPOOL_BYTES, name: str = "Image"):
+    # Rejects the upload with 413 as soon as it grows past max_bytes, nothing past the cap is kept
+    digest = hashlib.sha256()
+    buffer, spool, size = bytearray(), None, 0
+    try:
+        while chunk := await upload.read(INGEST_CHUNK_BYTES):
+            size += len(chunk)
+            if size > max_bytes:
+                raise HTTPException(status_code=413, detail=f"{name} must be at most {max_bytes} bytes")
+            digest.update(chunk)
+
+            if spool is None and len(buffer) + len(chunk) > spool_bytes:
+                spool = tempfile.TemporaryFile()
+                spool.write(buffer)
+                buffer = None
+            if spool is None:
+                buffer += chunk
+            else:
+                spool.write(chunk)
+
+        if spool is None:
+            data = memoryview(buffer).toreadonly()
+        else:
+            # The mapping stays valid after the spool file is closed, and is released with the last view
+            spool.flush()
+            data = memoryview(mmap.mmap(spool.fileno(), 0, access=mmap.ACCESS_READ))
+    finally:
+        if spool is not None:
+            spool.close()
+
+    return IngestedUpload(data, digest.hexdigest(), upload.content_type, upload.filename)
@@ -0,0 +1,161 @@
+from collections import OrderedDict
+from PIL import Image, ImageOps
+from sqlalchemy import select, func, case
+from sqlalchemy.ext.asyncio import AsyncSession
+from backend.models.database import Diet
+from backend.utils import metrics
+import numpy as np
+import asyncio
+import io
+import os
+import threading
+import time
+
+# Optional, only needed for the graph index of users with many meals
+try:
+    import hnswlib
+except ImportError:
+    hnswlib = None
+
+# Per-user similar meal retrieval: every saved photo gets a compact embedding (float16, stored in
+# diet_history.embedding), and a new photo is compared against the user's earlier ones
+MEAL_EMBEDDING_EDGE = 64
+MEAL_SIMILARITY_MIN = float(os.getenv("MEAL_SIMILARITY_MIN", 0.9))  # Cosine similarity for a suggestion
+MEAL_INDEX_GRAPH_MIN = int(os.getenv("MEAL_INDEX_GRAPH_MIN", 20000))  # Meals above which an HNSW graph is built
+MEAL_INDEX_GRAPH_EF = 200  # HNSW search breadth, meals cluster tightly around a few dishes
+MEAL_INDEX_CACHE_USERS = int(os.getenv("MEAL_INDEX_CACHE_USERS", 1000))
+COLOUR_BINS = 4  # Per channel, for the joint colour histogram
+LAYOUT_GRID = 4
+EDGE_GRID = 2
+EDGE_BINS = 8
+
+
+def image_embedding(image_bytes):
+    # Handcrafted CPU descriptor, L2-normalized: joint colour histogram (what is on the plate),
+    # coarse colour layout (where) and gradient orientations per quadrant (texture and shapes)
+    image = Image.open(io.BytesIO(image_bytes))
+    image.draft("RGB", (MEAL_EMBEDDING_EDGE * 2, MEAL_EMBEDDING_EDGE * 2))
+    image = ImageOps.exif_transpose(image).convert("RGB").resize((MEAL_EMBEDDING_EDGE, MEAL_EMBEDDING_EDGE), Image.BILINEAR)
+    pixels = np.asarray(image, dtype=np.float32) / 255
+
+    bins = np.minimum((pixels * COLOUR_BINS).astype(np.int32), COLOUR_BINS - 1)
+    colour = np.bincount(((bins[..., 0] * COLOUR_BINS + bins[..., 1]) * COLOUR_BINS + bins[..., 2]).ravel(),
+                         minlength=COLOUR_BINS ** 3).astype(np.float32)
+    colour = np.sqrt(colour / colour.sum())  # Hellinger, so one dominant colour does not drown the rest
+
+    cell = MEAL_EMBEDDING_EDGE // LAYOUT_GRID
+    layout = pixels.reshape(LAYOUT_GRID, cell, LAYOUT_GRID, cell, 3).mean(axis=(1, 3)).ravel()
+    layout = layout - layout.mean()
+
+    gray = pixels.mean(axis=2)
+    dx, dy = np.gradient(gray)
+    magnitude = np.hypot(dx, dy)
+    orientation = np.minimum(((np.arctan2(dy, dx) % np.pi) / np.pi * EDGE_BINS).astype(np.int32), EDGE_BINS - 1)
+    half = MEAL_EMBEDDING_EDGE // EDGE_GRID
+    quadrant = (np.arange(MEAL_EMBEDDING_EDGE)[:, None] // half) * EDGE_GRID + np.arange(MEAL_EMBEDDING_EDGE)[None, :] // half
+    edges = np.bincount((quadrant * EDGE_BINS + orientation).ravel(), weights=magnitude.ravel(),
+                        minlength=EDGE_GRID * EDGE_GRID * EDGE_BINS).astype(np.float32)
+
+    parts = [unit(colour), unit(layout), unit(np.sqrt(edges))]
+    return unit(np.concatenate(parts)).astype(np.float16)
+
+
+def unit(vector: np.ndarray):
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+def embedding_from_bytes(data: bytes):
+    return np.frombuffer(data, dtype=np.float16)
+
+
+class MealIndex:
+    # One user's embedded meals. Brute force over the matrix, or an HNSW graph for users with more
+    # than MEAL_INDEX_GRAPH_MIN meals when hnswlib is installed. Searched in float32: converting the
+    # stored float16 on every query costs more than the dot products
+    def __init__(self, ids: list, vectors: np.ndarray, fingerprint=None):
+        self.ids = np.asarray(ids, dtype=np.int64)
+        self.fingerprint = fingerprint
+        self.graph = None
+        if hnswlib is not None and len(ids) > MEAL_INDEX_GRAPH_MIN:
+            self.vectors = None
+            self.dimension = vectors.shape[1]
+            self.graph = hnswlib.Index(space="ip", dim=self.dimension)
+            self.graph.init_index(max_elements=len(ids), ef_construction=200, M=16)
+            self.graph.add_items(vectors.astype(np.float32), np.arange(len(ids)))
+            self.graph.set_ef(MEAL_INDEX_GRAPH_EF)
+        else:
+            self.vectors = vectors.astype(np.float32)
+            self.dimension = vectors.shape[1]
+
+    def __len__(self):
+        return len(self.ids)
+
+    def search(self, vector: np.ndarray, limit: int = 3, min_similarity: float = MEAL_SIMILARITY_MIN):
+        # [(diet_history id, cosine similarity)], most similar first
+        if not len(self.ids) or self.dimension != len(vector):
+            return []
+        query = vector.astype(np.float32)
+        if self.graph is not None:
+            positions, distances = self.graph.knn_query(query, k=min(limit, len(self.ids)))
+            positions, similarities = positions[0], 1 - distances[0]  # hnswlib's ip distance is 1 - dot
+        else:
+            scores = self.vectors @ query
+            positions = np.argpartition(-scores, limit - 1)[:limit] if limit < len(scores) else np.arange(len(scores))
+            positions = positions[np.argsort(-scores[positions])]
+            similarities = scores[positions]
+        return [(int(self.ids[position]), float(similarity))
+                for position, similarity in zip(positions, similarities) if similarity >= min_similarity]
+
+
+def user_meals_fingerprint(user: str):
+    # Changes whenever an embedded meal is added or deleted, cheaper than reading the embeddings
+    return select(
+        func.count(Diet.embedding),
+        func.coalesce(func.sum(case((Diet.embedding.isnot(None), Diet.id), else_=0)), 0)
+    ).where(Diet.user == user)
+
+
+class MealIndexCache:
+    # Recently used users' indexes (LRU). Saves may happen in another process (LINE bot, web app),
+    # so each lookup compares the user's fingerprint with the database and rebuilds on a change
+    def __init__(self, max_users: int = MEAL_INDEX_CACHE_USERS):
+        self.max_users = max_users
+        self.indexes = OrderedDict()
+        self.lock = threading.Lock()
+
+    async def get(self, user: str, db: AsyncSession):
+        fingerprint = tuple((await db.execute(user_meals_fingerprint(user))).one())
+        with self.lock:
+            index = self.indexes.get(user)
+            if index is not None and index.fingerprint == fingerprint:
+                self.indexes.move_to_end(user)
+                metrics.increment("meal_index_cache_hits")
+                return index
+
+        start = time.perf_counter()
+        rows = (await db.execute(
+            select(Diet.id, Diet.embedding).where(Diet.user == user, Diet.embedding.isnot(None)).order_by(Diet.id)
+        )).all()
+        index = await asyncio.to_thread(build_meal_index, rows, fingerprint)
+        metrics.observe("meal_index_build", time.perf_counter() - start)
+
+        with self.lock:
+            self.indexes[user] = index
+            self.indexes.move_to_end(user)
+            while len(self.indexes) > self.max_users:
+                self.indexes.popitem(last=False)
+        return index
+
+
+def build_meal_index(rows, fingerprint):
+    vectors = [embedding_from_bytes(row.embedding) for row in rows]
+    if not vectors:
+        return MealIndex([], np.zeros((0, 0), dtype=np.float16), fingerprint)
+    # Embeddings of another size (descriptor changed since they were stored) are left out until backfilled
+    size = len(vectors[-1])
+    rows, vectors = zip(*((row, vector) for row, vector in zip(rows, vectors) if len(vector) == size))
+    return MealIndex([row.id for row in rows], np.stack(vectors), fingerprint)
+
+
+meal_indexes = MealIndexCache()
@@ -0,0 +1,30 @@
+import threading
+
+# In-process counters and timings, exposed through the /metrics endpoint
+_lock = threading.Lock()
+_counters = {}
+_timings = {}
+
+
+def increment(name: str, value: int = 1):
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def observe(name: str, seconds: float):
+    with _lock:
+        timing = _timings.setdefault(name, {"count": 0, "total_seconds": 0.0, "max_seconds": 0.0})
+        timing["count"] += 1
+        timing["total_seconds"] += seconds
+        timing["max_seconds"] = max(timing["max_seconds"], seconds)
+
+
+def snapshot():
+    with _lock:
+        timings = {}
+        for name, timing in _timings.items():
+            timings[name] = {
+                **timing,
+                "avg_seconds": timing["total_seconds"] / timing["count"] if timing["count"] else 0.0
+            }
+        return {"counters": dict(_counters), "timings": timings}
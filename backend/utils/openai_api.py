@@ -16,8 +16,25 @@ def encode_image(image_path):
         return base64.b64encode(image_file.read()).decode('utf-8')
 
 
-def img_analysis(image_bytes: bytes, max_retries=3):
-    base64_image = base64.b64encode(image_bytes).decode('utf-8')
+def img_analysis(image_bytes, max_retries=3):
+    # One photo, or a list of photos of the same meal analyzed together in a single request
+    images = image_bytes if isinstance(image_bytes, list) else [image_bytes]
+    image_content = [
+        {
+            "type": "image_url",
+            "image_url": {
+                "url": f"data:image/jpeg;base64,{base64.b64encode(image).decode('utf-8')}"
+            }
+        }
+        for image in images
+    ]
+    prompt = ("Analyze the food shown in the image and return a JSON object containing the "
+              "amounts of protein (in grams), carbohydrates (in grams), and fat (in grams). "
+              "Be as accurate as possible and only return the nutritional information in the "
+              "specified format.")
+    if len(images) > 1:
+        prompt = (f"These {len(images)} photos show one meal, possibly several dishes or the same dish from "
+                  "different angles. Count every dish once, even when it appears in several photos. " + prompt)
 
     # Define the initial response format
     response = {
@@ -36,19 +53,7 @@ def img_analysis(image_bytes: bytes, max_retries=3):
                 messages=[
                     {
                         "role": "user",
-                        "content": [
-                            {"type": "text",
-                             "text": "Analyze the food shown in the image and return a JSON object containing the "
-                                     "amounts of protein (in grams), carbohydrates (in grams), and fat (in grams). "
-                                     "Be as accurate as possible and only return the nutritional information in the "
-                                     "specified format."},
-                            {
-                                "type": "image_url",
-                                "image_url": {
-                                    "url": f"data:image/jpeg;base64,{base64_image}"
-                                }
-                            },
-                        ],
+                        "content": [{"type": "text", "text": prompt}] + image_content,
                     }
                 ],
                 max_tokens=300,
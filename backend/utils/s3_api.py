@@ -1,7 +1,10 @@
 import boto3
-from botocore.exceptions import NoCredentialsError
+from botocore.config import Config
+from botocore.exceptions import ClientError, NoCredentialsError
+from concurrent.futures import ThreadPoolExecutor
+from backend.utils import metrics
 import os
-import io
+import time
 from dotenv import load_dotenv
 
 
@@ -9,19 +12,73 @@ load_dotenv()
 ACCESS_KEY = os.getenv("AWS_ACCESS_KEY_ID")
 SECRET_KEY = os.getenv("AWS_SECRET_ACCESS_KEY")
 BUCKET_NAME = os.getenv("AWS_S3_BUCKET")
+S3_ENDPOINT_URL = os.getenv("AWS_S3_ENDPOINT_URL")  # S3-compatible stand-in, e.g. http://localhost:9000 for MinIO
+S3_PRESIGN_EXPIRES_SECONDS = int(os.getenv("S3_PRESIGN_EXPIRES_SECONDS", 300))
 
+# Connection pool shared by all upload threads, keep it at least as large as the executor
+S3_MAX_POOL_CONNECTIONS = int(os.getenv("S3_MAX_POOL_CONNECTIONS", 32))
+S3_UPLOAD_WORKERS = int(os.getenv("S3_UPLOAD_WORKERS", 8))
 
-def upload_file_to_s3(file_name, file_data, bucket=BUCKET_NAME):
-    # Convert bytes data to a BytesIO object for S3 upload
-    file_data_io = io.BytesIO(file_data)
+# boto3 clients are thread-safe (sessions are not), so one client serves every thread
+s3_client = boto3.client(
+    's3',
+    aws_access_key_id=ACCESS_KEY,
+    aws_secret_access_key=SECRET_KEY,
+    endpoint_url=S3_ENDPOINT_URL,
+    config=Config(
+        signature_version="s3v4",  # Presigned URLs sign Content-Type and Content-Length
+        s3={"addressing_style": "path"} if S3_ENDPOINT_URL else None,
+        max_pool_connections=S3_MAX_POOL_CONNECTIONS,
+        connect_timeout=5,
+        read_timeout=30,
+        tcp_keepalive=True,
+        retries={"max_attempts": 3, "mode": "standard"}
+    )
+)
 
-    # Upload the file to S3
-    s3_client = boto3.client('s3', aws_access_key_id=ACCESS_KEY, aws_secret_access_key=SECRET_KEY)
+# Bounded pool for uploads that run off the request path
+upload_executor = ThreadPoolExecutor(max_workers=S3_UPLOAD_WORKERS, thread_name_prefix="s3-upload")
 
+
+def object_url(file_name, bucket=BUCKET_NAME):
+    if S3_ENDPOINT_URL:
+        return f"{S3_ENDPOINT_URL.rstrip('/')}/{bucket}/{file_name}"
+    return f"https://{bucket}.s3.amazonaws.com/{file_name}"
+
+
+def create_presigned_put(file_name, content_type, content_length, bucket=BUCKET_NAME,
+                         expires_in=S3_PRESIGN_EXPIRES_SECONDS):
+    # The upload must send exactly this Content-Type and Content-Length, or S3 rejects the signature
+    return s3_client.generate_presigned_url("put_object", Params={
+        "Bucket": bucket,
+        "Key": file_name,
+        "ContentType": content_type,
+        "ContentLength": content_length
+    }, ExpiresIn=expires_in, HttpMethod="PUT")
+
+
+def get_object_size(file_name, bucket=BUCKET_NAME):
+    # Size of an uploaded object, or None if it does not exist
+    try:
+        return s3_client.head_object(Bucket=bucket, Key=file_name)["ContentLength"]
+    except ClientError as e:
+        if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+            return None
+        raise
+
+
+def upload_file_to_s3(file_name, file_data, bucket=BUCKET_NAME, content_type="image/jpeg"):
+    # Meal photos are small, a single PUT avoids the multipart transfer manager
+    start = time.perf_counter()
     try:
-        s3_client.upload_fileobj(file_data_io, bucket, file_name)
+        s3_client.put_object(Bucket=bucket, Key=file_name, Body=file_data, ContentType=content_type)
+        metrics.observe("s3_upload", time.perf_counter() - start)
         print(f"File uploaded successfully to {bucket}/{file_name}")
-        return f"https://{bucket}.s3.amazonaws.com/{file_name}"
+        return object_url(file_name, bucket)
     except NoCredentialsError:
+        metrics.increment("s3_upload_errors")
         print("Credentials not available")
         raise Exception
+    except Exception:
+        metrics.increment("s3_upload_errors")
+        raise
@@ -0,0 +1,78 @@
+from sqlalchemy import Date, DateTime
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.functions import FunctionElement
+
+# Date arithmetic used by the history aggregations, compiled for MySQL (default) and SQLite (tests)
+
+
+class add_seconds(FunctionElement):
+    """add_seconds(datetime, seconds): shift a datetime, e.g. from UTC to a local time."""
+    type = DateTime()
+    name = "add_seconds"
+    inherit_cache = True
+
+
+@compiles(add_seconds)
+def compile_add_seconds(element, compiler, **kw):
+    value, seconds = list(element.clauses)
+    return f"DATE_ADD({compiler.process(value, **kw)}, INTERVAL ({compiler.process(seconds, **kw)}) SECOND)"
+
+
+@compiles(add_seconds, "sqlite")
+def compile_add_seconds_sqlite(element, compiler, **kw):
+    value, seconds = list(element.clauses)
+    return f"datetime({compiler.process(value, **kw)}, ({compiler.process(seconds, **kw)}) || ' seconds')"
+
+
+class day_start(FunctionElement):
+    """day_start(datetime): the calendar date."""
+    type = Date()
+    name = "day_start"
+    inherit_cache = True
+
+
+@compiles(day_start)
+def compile_day_start(element, compiler, **kw):
+    return f"DATE({compiler.process(element.clauses, **kw)})"
+
+
+@compiles(day_start, "sqlite")
+def compile_day_start_sqlite(element, compiler, **kw):
+    return f"date({compiler.process(element.clauses, **kw)})"
+
+
+class week_start(FunctionElement):
+    """week_start(datetime): the Monday of its ISO week."""
+    type = Date()
+    name = "week_start"
+    inherit_cache = True
+
+
+@compiles(week_start)
+def compile_week_start(element, compiler, **kw):
+    value = compiler.process(element.clauses, **kw)
+    return f"DATE_SUB(DATE({value}), INTERVAL WEEKDAY({value}) DAY)"
+
+
+@compiles(week_start, "sqlite")
+def compile_week_start_sqlite(element, compiler, **kw):
+    # Move forward to Sunday (no-op on a Sunday), then back to that week's Monday
+    return f"date({compiler.process(element.clauses, **kw)}, 'weekday 0', '-6 days')"
+
+
+class month_start(FunctionElement):
+    """month_start(datetime): the first day of its month."""
+    type = Date()
+    name = "month_start"
+    inherit_cache = True
+
+
+@compiles(month_start)
+def compile_month_start(element, compiler, **kw):
+    value = compiler.process(element.clauses, **kw)
+    return f"DATE_SUB(DATE({value}), INTERVAL DAYOFMONTH({value}) - 1 DAY)"
+
+
+@compiles(month_start, "sqlite")
+def compile_month_start_sqlite(element, compiler, **kw):
+    return f"date({compiler.process(element.clauses, **kw)}, 'start of month')"
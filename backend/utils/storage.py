@@ -0,0 +1,140 @@
+from backend.utils import s3_api
+import hashlib
+import io
+import os
+import tempfile
+from dotenv import load_dotenv
+
+# Image storage used by the diet history: S3 in production, a local directory for offline work and tests
+
+load_dotenv()
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "s3")  # "s3" or "local"
+LOCAL_STORAGE_DIR = os.getenv("LOCAL_STORAGE_DIR", "./storage")
+LOCAL_STORAGE_BASE_URL = os.getenv("LOCAL_STORAGE_BASE_URL")  # Defaults to file:// URLs
+
+
+def content_key(data, prefix: str = "images"):
+    # Objects are named by the SHA-256 of their full content, identical photos share one object
+    return digest_key(hashlib.sha256(data).hexdigest(), prefix)
+
+
+def digest_key(sha256: str, prefix: str = "images"):
+    # Same key from a digest computed while the upload was read
+    return f"{prefix}/{sha256}"
+
+
+class MemoryviewReader(io.RawIOBase):
+    # boto3 takes bytes or file objects, not memoryviews: read the view in place instead of copying it
+    def __init__(self, view: memoryview):
+        self.view = view.cast("B")
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, buffer):
+        n = min(len(buffer), len(self.view) - self.position)
+        buffer[:n] = self.view[self.position:self.position + n]
+        self.position += n
+        return n
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET):
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self.position, io.SEEK_END: len(self.view)}[whence]
+        self.position = max(0, base + offset)
+        return self.position
+
+    def tell(self):
+        return self.position
+
+
+class S3Storage:
+    def exists(self, key: str):
+        return s3_api.get_object_size(key) is not None
+
+    def size(self, key: str):
+        return s3_api.get_object_size(key)
+
+    def get(self, key: str):
+        return s3_api.s3_client.get_object(Bucket=s3_api.BUCKET_NAME, Key=key)["Body"].read()
+
+    def put(self, key: str, data, content_type: str = "image/jpeg"):
+        if isinstance(data, memoryview):
+            data = MemoryviewReader(data)
+        return s3_api.upload_file_to_s3(key, data, content_type=content_type)
+
+    def delete(self, key: str):
+        s3_api.s3_client.delete_object(Bucket=s3_api.BUCKET_NAME, Key=key)
+
+    def url(self, key: str):
+        return s3_api.object_url(key)
+
+    def presigned_put(self, key: str, content_type: str, content_length: int):
+        return s3_api.create_presigned_put(key, content_type, content_length)
+
+
+class LocalStorage:
+    def __init__(self, root: str, base_url: str = None):
+        self.root = os.path.abspath(root)
+        self.base_url = (base_url or f"file://{self.root}").rstrip("/")
+
+    def path(self, key: str):
+        path = os.path.abspath(os.path.join(self.root, key))
+        if not path.startswith(self.root + os.sep):
+            raise ValueError(f"Invalid storage key {key}")
+        return path
+
+    def exists(self, key: str):
+        return os.path.exists(self.path(key))
+
+    def size(self, key: str):
+        try:
+            return os.path.getsize(self.path(key))
+        except FileNotFoundError:
+            return None
+
+    def get(self, key: str):
+        with open(self.path(key), "rb") as f:
+            return f.read()
+
+    def put(self, key: str, data, content_type: str = "image/jpeg"):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # Write to a temporary file first so readers never see a partial object
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        return self.url(key)
+
+    def delete(self, key: str):
+        try:
+            os.remove(self.path(key))
+        except FileNotFoundError:
+            pass
+
+    def url(self, key: str):
+        return f"{self.base_url}/{key}"
+
+    def presigned_put(self, key: str, content_type: str, content_length: int):
+        raise NotImplementedError("The local storage backend does not support direct uploads")
+
+
+if STORAGE_BACKEND == "local":
+    storage = LocalStorage(LOCAL_STORAGE_DIR, LOCAL_STORAGE_BASE_URL)
+else:
+    storage = S3Storage()
+
+
+def save_if_absent(key: str, data, content_type: str = "image/jpeg"):
+    # Returns (url, uploaded), the upload is skipped when the object already exists
+    if storage.exists(key):
+        return storage.url(key), False
+    return storage.put(key, data, content_type), True
@@ -2,19 +2,41 @@ from passlib.context import CryptContext
 import jwt
 from datetime import datetime, timedelta
 import pytz
-from sqlalchemy.orm import Session
-from sqlalchemy import func
-from fastapi import Depends, HTTPException
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import Row, select, insert, update, delete, or_, and_, case, func
+from fastapi import Depends, HTTPException, Request, Response
 from fastapi.security import OAuth2PasswordBearer
-from backend.models.database import User, Diet, Food, Workout
-from backend.utils.db_session import get_db
+from backend.models.database import User, Diet, DailyIntake, ImageObject, Food, Workout
+from sqlalchemy.dialects import mysql, sqlite
+from backend.utils.db_session import get_async_db, get_async_read_db, AsyncReadSessionLocal, SessionLocal
 from backend.utils.openai_api import img_analysis
-from backend.utils.s3_api import upload_file_to_s3
+from backend.utils.s3_api import upload_executor, S3_PRESIGN_EXPIRES_SECONDS
+from backend.utils.storage import storage, content_key, digest_key, save_if_absent
+from backend.utils.image_derivatives import store_derivatives, derivative_urls
+from backend.utils.food_catalogue import food_catalogue
+from backend.utils.image_quality import check_image_quality, QUALITY_MESSAGES
+from backend.utils.food_classifier import food_classifier
+from backend.utils.meal_index import image_embedding, meal_indexes
+from backend.utils import metrics
+from backend.utils.sql_functions import add_seconds, day_start, week_start, month_start
 import os
 import uuid
 import hashlib
+import asyncio
+import base64
+import csv
+import io
+import time
+import threading
 from dotenv import load_dotenv
 
+# Optional, only needed for Parquet exports
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
 # Load environment variables from .env file
 load_dotenv()
 
@@ -26,32 +48,83 @@ JWT_SECRET_KEY = os.getenv("JWT_SECRET_KEY")
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 1440
 
+# Time zone used when the client does not send one (LINE users)
+DEFAULT_TIME_ZONE = 'Asia/Taipei'
+
+# Columns served by the read paths (Core selects, no ORM hydration)
+USER_INFO_COLUMNS = (
+    User.id, User.user, User.gender, User.height, User.weight, User.age, User.activity_level, User.target,
+    User.preference, User.tdee, User.target_protein, User.target_carbohydrates, User.target_fat, User.data_version
+)
+DIET_HISTORY_COLUMNS = (
+    Diet.id, Diet.datetime, Diet.meal, Diet.calories, Diet.protein, Diet.carbohydrates, Diet.fat, Diet.img_url,
+    Diet.img_set
+)
+DIET_EXPORT_COLUMNS = (
+    Diet.id, Diet.datetime, Diet.meal, Diet.calories, Diet.protein, Diet.carbohydrates, Diet.fat, Diet.img_url
+)
+
+# Diet history pagination
+DIET_HISTORY_PAGE_SIZE = 20
+DIET_HISTORY_MAX_PAGE_SIZE = 100
+
+# Meal photos uploaded directly to storage through presigned URLs
+DIET_IMAGE_MAX_BYTES = int(os.getenv("DIET_IMAGE_MAX_BYTES", 10 * 1024 * 1024))
+DIET_IMAGE_CONTENT_TYPES = {"image/jpeg": "jpg", "image/png": "png", "image/webp": "webp", "image/heic": "heic"}
+
+# LINE photos are stored while the user decides whether to save them (refcount 0 until a row references
+# them), the sweeper deletes the ones still unreferenced after this long. Keep it well above the LINE cache timeout
+STAGED_IMAGE_TTL_SECONDS = int(os.getenv("STAGED_IMAGE_TTL_SECONDS", 3600))
+
+# Background uploads of saved photos are retried (with 1s, 2s, ... between attempts) before the photo is
+# given up on, backend.scripts.repair_diet_images reports and repairs rows left without an img_url
+DIET_IMAGE_STORE_ATTEMPTS = int(os.getenv("DIET_IMAGE_STORE_ATTEMPTS", 3))
+
+# Bulk import limits
+DIET_IMPORT_MAX_ENTRIES = 5000
+DIET_IMPORT_CSV_MAX_BYTES = 2 * 1024 * 1024  # Room for DIET_IMPORT_MAX_ENTRIES rows, checked while reading
+DIET_IMPORT_CHUNK_SIZE = 500  # Rows per executemany
+
+# Rows per server-side cursor partition (and per Parquet row group) when exporting
+DIET_EXPORT_BATCH_SIZE = 10000
+
+# Diet summary buckets and the longest range a single summary may cover
+SUMMARY_BUCKETS = {"day": day_start, "week": week_start, "month": month_start}
+SUMMARY_MAX_DAYS = 366 * 3
+
 # OAuth2PasswordBearer for extracting the token from the header
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="login")
 
+# Authenticated principal cache settings (verified token -> user record)
+PRINCIPAL_CACHE_TTL_SECONDS = int(os.getenv("PRINCIPAL_CACHE_TTL_SECONDS", 60))
+PRINCIPAL_CACHE_MAX_SIZE = int(os.getenv("PRINCIPAL_CACHE_MAX_SIZE", 1024))
+_principal_cache = {}  # token -> (expires_at, user)
+_principal_cache_lock = threading.Lock()
 
-def get_user_by_username(username: str, db: Session):
-    return db.query(User).filter(User.user == username).first()
+
+async def get_user_by_username(username: str, db: AsyncSession):
+    result = await db.execute(select(User).where(User.user == username))
+    return result.scalars().first()
 
 
 def hash_password(password: str):
     return pwd_context.hash(password)
 
 
-def create_user(username: str, password: str, db: Session):
+async def create_user(username: str, password: str, db: AsyncSession):
     new_user = User(
         user=username,
         password=password
     )
     db.add(new_user)
-    db.commit()
-    db.refresh(new_user)
+    await db.commit()
+    await db.refresh(new_user)
     return new_user
 
 
 # 1. Authenticate User (Interacts with User Info DB)
-def authenticate_user(username: str, password: str, db: Session):
-    user = db.query(User).filter(User.user == username).first()
+async def authenticate_user(username: str, password: str, db: AsyncSession):
+    user = await get_user_by_username(username, db)
 
     if not user:
         return {"error": "User not found"}  # Specific case for user not found
@@ -75,9 +148,9 @@ def create_access_token(data: dict):
 
 
 # 3. Save User Info (Interacts with User Info DB)
-def save_user_info_to_db(user_info, db: Session, username: str):
+async def save_user_info_to_db(user_info, db: AsyncSession, username: str):
     # Find the user by the username from the JWT token
-    existing_user = db.query(User).filter(User.user == username).first()
+    existing_user = await get_user_by_username(username, db)
 
     if not existing_user:
         return None  # Handle user not found error
@@ -97,24 +170,27 @@ def save_user_info_to_db(user_info, db: Session, username: str):
     existing_user.target_protein = target['protein']
     existing_user.target_carbohydrates = target['carbohydrates']
     existing_user.target_fat = target['fat']
+    existing_user.data_version = User.data_version + 1
 
     # Commit the changes to the database
-    db.commit()
-    db.refresh(existing_user)  # Refresh the instance with the latest data
+    await db.commit()
+    await db.refresh(existing_user)  # Refresh the instance with the latest data
+
+    # The cached principal still carries the old targets and data version
+    invalidate_cached_user(username)
 
     return existing_user  # Optionally return the updated user
 
 
-def verify_jwt_token(token: str):
+def decode_jwt_token(token: str):
     try:
         # Decode the JWT token
         payload = jwt.decode(token, JWT_SECRET_KEY, algorithms=[ALGORITHM])
-        username: str = payload.get("sub")  # Extract the username from the token payload
 
-        if username is None:
+        if payload.get("sub") is None:
             raise HTTPException(status_code=401, detail="Invalid token")
 
-        return username  # Return the username for further use
+        return payload
 
     except jwt.ExpiredSignatureError:
         raise HTTPException(status_code=401, detail="Token has expired")
@@ -122,66 +198,186 @@ def verify_jwt_token(token: str):
         raise HTTPException(status_code=401, detail="Invalid token")
 
 
-def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
-    # Step 1: Verify the token and get the username
-    username = verify_jwt_token(token)
-
-    # Step 2: Extract the user from the database
-    user = db.query(User).filter(User.user == username).first()
+def verify_jwt_token(token: str):
+    # Extract the username from the token payload
+    return decode_jwt_token(token)["sub"]
+
+
+def get_cached_user(token: str):
+    with _principal_cache_lock:
+        cached = _principal_cache.get(token)
+        if cached is None:
+            return None
+        expires_at, user = cached
+        if expires_at <= time.time():
+            del _principal_cache[token]
+            return None
+        return user
+
+
+def cache_user(token: str, user, token_expires_at: float):
+    # Never keep a principal around longer than its token is valid
+    expires_at = min(time.time() + PRINCIPAL_CACHE_TTL_SECONDS, token_expires_at)
+
+    with _principal_cache_lock:
+        if len(_principal_cache) >= PRINCIPAL_CACHE_MAX_SIZE:
+            now = time.time()
+            for key in [k for k, (exp, _) in _principal_cache.items() if exp <= now]:
+                del _principal_cache[key]
+        if len(_principal_cache) >= PRINCIPAL_CACHE_MAX_SIZE:
+            # Still full, drop the oldest entry (dicts keep insertion order)
+            del _principal_cache[next(iter(_principal_cache))]
+        _principal_cache[token] = (expires_at, user)
+
+
+def invalidate_cached_user(username: str):
+    with _principal_cache_lock:
+        for key in [k for k, (_, user) in _principal_cache.items() if user.user == username]:
+            del _principal_cache[key]
+
+
+async def get_current_user(token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(get_async_db)):
+    # Step 1: Serve the principal from the cache if this token was verified recently
+    user = get_cached_user(token)
+    if user is not None:
+        return user
+
+    # Step 2: Verify the token and get the username
+    payload = decode_jwt_token(token)
+    username = payload["sub"]
+
+    # Step 3: Extract the user from the database (an immutable row, safe to share across requests)
+    user = await get_user_info(username, db)
     if user is None:
         raise HTTPException(status_code=401, detail="User not found")
 
-    return user.user  # Return the user object
+    cache_user(token, user, payload["exp"])
 
+    return user  # Return the user row
 
-def get_user_info(username: str, db: Session):
-    # Query the database to get the user information by username
-    user_info = db.query(User).filter(User.user == username).first()
 
-    if user_info:
-        return user_info  # Return the user information object
+def bump_data_version(user: str):
+    # Invalidates every ETag handed out for this user's profile and history
+    return update(User).where(User.user == user).values(data_version=User.data_version + 1)
 
-    return None  # Return None if no user is found
 
+def data_etag(username: str, data_version: int, request: Request):
+    # Strong validator for one user's view of a resource (path and query), changes with every write
+    key = f"{username}:{data_version}:{request.url.path}?{request.url.query}"
+    return '"' + hashlib.sha256(key.encode()).hexdigest()[:32] + '"'
 
-# get today diet history
-def get_intake_sum_today(user: str, db: Session, time_zone: str):
-    # Get the current UTC time
-    utc_now = datetime.utcnow()
 
-    # Convert UTC time to the client's timezone
-    client_tz = pytz.timezone(time_zone)
-    client_now = utc_now.astimezone(client_tz)
-
-    # Get the start and end of the day in the client's timezone
-    client_start_of_day = client_tz.localize(datetime(client_now.year, client_now.month, client_now.day, 0, 0, 0))
-    client_end_of_day = client_start_of_day + timedelta(days=1)
-
-    # Convert start and end of day to UTC for the query
-    utc_start_of_day = client_start_of_day.astimezone(pytz.UTC)
-    utc_end_of_day = client_end_of_day.astimezone(pytz.UTC)
-
-    # Query the database to sum up calories, protein, carbohydrates, and fat
-    totals = db.query(
-        func.sum(Diet.calories).label('total_calories'),
-        func.sum(Diet.protein).label('total_protein'),
-        func.sum(Diet.carbohydrates).label('total_carbohydrates'),
-        func.sum(Diet.fat).label('total_fat')
-    ).filter(
-        Diet.user == user,
-        Diet.datetime >= utc_start_of_day,
-        Diet.datetime < utc_end_of_day
-    ).first()
-
-    # Return the summed totals in the desired format
-    result = {
-        "calories": int(totals.total_calories or 0),  # Cast to int, handle None by defaulting to 0
-        "protein": int(totals.total_protein or 0),
-        "carbohydrates": int(totals.total_carbohydrates or 0),
-        "fat": int(totals.total_fat or 0)
+def etag_matches(if_none_match: str, etag: str):
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    # If-None-Match uses the weak comparison
+    return any(tag.strip().removeprefix("W/") == etag for tag in if_none_match.split(","))
+
+
+async def conditional_get(request: Request, response: Response, current_user: Row = Depends(get_current_user),
+                          db: AsyncSession = Depends(get_async_read_db)):
+    # The data version is read in the endpoint's own read session (FastAPI shares the dependency per
+    # request), so the ETag and the body come from the same snapshot even on a lagging replica. The
+    # cached principal's version is not used, it can predate another worker's write
+    data_version = (await db.execute(select(User.data_version).where(User.user == current_user.user))).scalar()
+    etag = data_etag(current_user.user, data_version, request)
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache", "Vary": "Authorization"}
+
+    # A client that is up to date gets a 304 before the endpoint queries anything else
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        raise HTTPException(status_code=304, headers=headers)
+
+    response.headers.update(headers)
+    return headers
+
+
+async def get_user_info(username: str, db: AsyncSession):
+    # Query the profile columns by username, returns a Row or None if no user is found
+    result = await db.execute(select(*USER_INFO_COLUMNS).where(User.user == username))
+    return result.first()
+
+
+def local_date(utc_datetime: datetime, time_zone: str):
+    # Calendar date of a naive UTC datetime in the given time zone
+    return pytz.utc.localize(utc_datetime).astimezone(pytz.timezone(time_zone)).date()
+
+
+def daily_intake_upsert_statement(dialect_name: str):
+    # Add to the existing row for that day, or create it (values bound per execution, so it also batches)
+    if dialect_name == "mysql":
+        stmt = mysql.insert(DailyIntake)
+        new_values = stmt.inserted
+        return stmt.on_duplicate_key_update(**{
+            column: getattr(DailyIntake, column) + getattr(new_values, column)
+            for column in ("calories", "protein", "carbohydrates", "fat", "meal_count")
+        })
+
+    stmt = sqlite.insert(DailyIntake)
+    new_values = stmt.excluded
+    return stmt.on_conflict_do_update(index_elements=["user", "date"], set_={
+        column: getattr(DailyIntake, column) + getattr(new_values, column)
+        for column in ("calories", "protein", "carbohydrates", "fat", "meal_count")
+    })
+
+
+def daily_intake_upsert(dialect_name: str, user: str, date, calories: int, protein: int, carbohydrates: int,
+                        fat: int, meal_count: int = 1):
+    return daily_intake_upsert_statement(dialect_name).values(
+        user=user,
+        date=date,
+        calories=calories,
+        protein=protein,
+        carbohydrates=carbohydrates,
+        fat=fat,
+        meal_count=meal_count
+    )
+
+
+async def get_daily_intake(user: str, db: AsyncSession, date):
+    # Single-row primary key lookup on the daily rollup
+    totals = await db.get(DailyIntake, (user, date))
+
+    return {
+        "calories": totals.calories if totals else 0,
+        "protein": totals.protein if totals else 0,
+        "carbohydrates": totals.carbohydrates if totals else 0,
+        "fat": totals.fat if totals else 0,
+        "meal_count": totals.meal_count if totals else 0
     }
 
-    return result
+
+# Targets and today's totals in one round-trip (user LEFT JOIN today's daily_intake row)
+async def get_intake_target_and_today(user: str, db: AsyncSession, time_zone: str):
+    # Today's date in the client's timezone
+    client_today = datetime.now(pytz.timezone(time_zone)).date()
+
+    stmt = select(
+        User.tdee, User.target_protein, User.target_carbohydrates, User.target_fat,
+        func.coalesce(DailyIntake.calories, 0).label("calories"),
+        func.coalesce(DailyIntake.protein, 0).label("protein"),
+        func.coalesce(DailyIntake.carbohydrates, 0).label("carbohydrates"),
+        func.coalesce(DailyIntake.fat, 0).label("fat")
+    ).select_from(User).outerjoin(
+        DailyIntake, and_(DailyIntake.user == User.user, DailyIntake.date == client_today)
+    ).where(User.user == user)
+    row = (await db.execute(stmt)).first()
+
+    intake_target = {
+        'calories': row.tdee,
+        'protein': row.target_protein,
+        'carbohydrates': row.target_carbohydrates,
+        'fat': row.target_fat
+    }
+    intake_prior = {
+        'calories': row.calories,
+        'protein': row.protein,
+        'carbohydrates': row.carbohydrates,
+        'fat': row.fat
+    }
+
+    return intake_target, intake_prior
 
 
 def get_target_number(user_info):
@@ -244,24 +440,38 @@ def get_target_number(user_info):
 
 
 # 6. Analyze Function (Interacts with All 4 Databases)
-def analysis(obj, db: Session, user_name: str, time_zone: str):
-    user_info = get_user_info(user_name, db)
-    intake_target = {
-        'calories': user_info.tdee,
-        'protein': user_info.target_protein,
-        'carbohydrates': user_info.target_carbohydrates,
-        'fat': user_info.target_fat
-    }
+async def ensure_image_quality(image_bytes):
+    # Blurry, dark or empty photos are rejected in milliseconds instead of going to a vision model
+    reason = await asyncio.to_thread(check_image_quality, image_bytes)
+    if reason:
+        raise HTTPException(status_code=422, detail=QUALITY_MESSAGES[reason])
 
-    intake_prior = get_intake_sum_today(user_name, db, time_zone)
 
+def estimate_nutrition(image_bytes):
+    # The local classifier answers for dishes it is confident about, everything else goes to the vision model.
+    # Several photos of one meal go to the vision model together, in one request
+    if isinstance(image_bytes, list):
+        if len(image_bytes) > 1:
+            return img_analysis(image_bytes=image_bytes)
+        image_bytes = image_bytes[0]
+    return food_classifier.estimate(image_bytes) or img_analysis(image_bytes=image_bytes)
+
+
+async def analysis(obj, db: AsyncSession, user_info: Row, time_zone: str):
     if 'protein' not in obj:
-        intake_current = img_analysis(image_bytes=obj['img'])
+        await ensure_image_quality(obj['img'])
+
+        # The vision call blocks, run it in a worker thread while the database query runs
+        (intake_target, intake_prior), intake_current = await asyncio.gather(
+            get_intake_target_and_today(user_info.user, db, time_zone),
+            asyncio.to_thread(estimate_nutrition, obj['img'])
+        )
         # intake_current = {'protein': 25, 'carbohydrates': 30, 'fat': 15, 'calories': 355}
     else:
         if 'img' in obj:
             del obj['img']
         intake_current = obj
+        intake_target, intake_prior = await get_intake_target_and_today(user_info.user, db, time_zone)
     # meal_ingredient = {'pork': 100, 'egg': 50, 'vegetables': 200, 'milk': 30}
 
     intake_current['calories'] = intake_current['protein']*4 + intake_current['carbohydrates']*4 + intake_current['fat']*9
@@ -276,17 +486,223 @@ def analysis(obj, db: Session, user_name: str, time_zone: str):
     return result
 
 
+def image_object_ref_statement(dialect_name: str):
+    # Add references to a stored image object, or start counting them
+    if dialect_name == "mysql":
+        stmt = mysql.insert(ImageObject)
+        return stmt.on_duplicate_key_update(refcount=ImageObject.refcount + stmt.inserted.refcount)
+
+    stmt = sqlite.insert(ImageObject)
+    return stmt.on_conflict_do_update(index_elements=["key"], set_={
+        "refcount": ImageObject.refcount + stmt.excluded.refcount
+    })
+
+
+def image_object_ref(dialect_name: str, key: str, size: int, refcount: int = 1):
+    return image_object_ref_statement(dialect_name).values(
+        key=key, refcount=refcount, size=size, created_at=datetime.utcnow()
+    )
+
+
+def image_object_stage(dialect_name: str, key: str, size: int):
+    # Register a stored image without a reference, unreferenced objects restart their sweeper clock
+    now = datetime.utcnow()
+    if dialect_name == "mysql":
+        stmt = mysql.insert(ImageObject).values(key=key, refcount=0, size=size, created_at=now)
+        return stmt.on_duplicate_key_update(
+            created_at=case((ImageObject.refcount == 0, stmt.inserted.created_at), else_=ImageObject.created_at)
+        )
+
+    stmt = sqlite.insert(ImageObject).values(key=key, refcount=0, size=size, created_at=now)
+    return stmt.on_conflict_do_update(index_elements=["key"], set_={
+        "created_at": case((ImageObject.refcount == 0, stmt.excluded.created_at), else_=ImageObject.created_at)
+    })
+
+
+def stage_diet_image(image_bytes: bytes):
+    # Runs on the upload executor while the LINE user decides whether to save the meal, returns the key
+    # that save_diet_history(image_staged=True) links to. Nothing is copied on save: the key is final
+    start = time.perf_counter()
+    img_key = content_key(image_bytes)
+
+    db = SessionLocal()
+    try:
+        db.execute(image_object_stage(db.get_bind().dialect.name, img_key, len(image_bytes)))
+        db.commit()
+    finally:
+        db.close()
+
+    _, uploaded = save_if_absent(img_key, image_bytes)
+    if not uploaded:
+        metrics.increment("diet_image_dedup_hits")
+    metrics.observe("diet_image_stage", time.perf_counter() - start)
+    return img_key
+
+
+def sweep_staged_images(db, max_age_seconds: int = STAGED_IMAGE_TTL_SECONDS):
+    # Delete staged images that were never saved, returns the number of deleted objects
+    cutoff = datetime.utcnow() - timedelta(seconds=max_age_seconds)
+    abandoned = select(ImageObject.key).where(ImageObject.refcount == 0, ImageObject.created_at < cutoff)
+
+    deleted = 0
+    for key in db.execute(abandoned).scalars().all():
+        # Claim the row first, an image saved or staged again in the meantime no longer matches. The claim
+        # keeps the row locked until the commit, after the object is gone, so a save reusing the image waits
+        # and then finds no row (and uploads the photo again) instead of linking a deleted object
+        claimed = db.execute(delete(ImageObject).where(
+            ImageObject.key == key, ImageObject.refcount == 0, ImageObject.created_at < cutoff
+        ))
+        try:
+            if claimed.rowcount:
+                storage.delete(key)
+                deleted += 1
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            print(f"Failed to sweep staged image {key}: {e}")
+    return deleted
+
+
+def store_diet_image(entry_id: int, user: str, img_key: str, image_bytes: bytes, queued_at: float):
+    # Runs on the upload executor: upload (unless the same photo is already stored), generate the
+    # derivatives, then point the saved row at both. The photo only exists in memory until this succeeds
+    for attempt in range(1, DIET_IMAGE_STORE_ATTEMPTS + 1):
+        try:
+            img_url, uploaded = save_if_absent(img_key, image_bytes)
+            if not uploaded:
+                metrics.increment("diet_image_dedup_hits")
+            img_set = generate_derivatives(image_bytes)
+            embedding = meal_embedding(image_bytes)
+
+            db = SessionLocal()
+            try:
+                db.execute(update(Diet).where(Diet.id == entry_id).values(img_url=img_url, img_set=img_set,
+                                                                          embedding=embedding))
+                db.execute(bump_data_version(user))
+                db.commit()
+            finally:
+                db.close()
+            invalidate_cached_user(user)
+
+            # Time from the save until the photo is visible in the history
+            metrics.observe("diet_image_store", time.perf_counter() - queued_at)
+            return
+        except Exception as e:
+            metrics.increment("diet_image_store_errors")
+            print(f"Failed to store image {img_key} for diet entry {entry_id} (attempt {attempt}): {e}")
+            if attempt < DIET_IMAGE_STORE_ATTEMPTS:
+                time.sleep(2 ** (attempt - 1))
+
+    metrics.increment("diet_image_store_failures")
+
+
+def generate_derivatives(image_bytes: bytes):
+    start = time.perf_counter()
+    img_set, generated = store_derivatives(image_bytes)
+    if generated:
+        metrics.observe("image_derivatives", time.perf_counter() - start)
+    return img_set
+
+
+def meal_embedding(image_bytes: bytes):
+    # None when the photo cannot be embedded, the row is then left out of similar meal suggestions
+    start = time.perf_counter()
+    try:
+        embedding = image_embedding(image_bytes).tobytes()
+    except Exception as e:
+        metrics.increment("meal_embedding_errors")
+        print(f"Failed to embed image: {e}")
+        return None
+    metrics.observe("meal_embedding", time.perf_counter() - start)
+    return embedding
+
+
+def store_image_derivatives(user: str, img_key: str, image_bytes: bytes = None):
+    # Runs on the upload executor for images that are already stored (presigned uploads, imports)
+    try:
+        if image_bytes is None:
+            image_bytes = storage.get(img_key)
+        img_set = generate_derivatives(image_bytes)
+        embedding = meal_embedding(image_bytes)
+
+        db = SessionLocal()
+        try:
+            db.execute(update(Diet).where(Diet.user == user, Diet.img_key == img_key).values(img_set=img_set,
+                                                                                             embedding=embedding))
+            db.execute(bump_data_version(user))
+            db.commit()
+        finally:
+            db.close()
+        invalidate_cached_user(user)
+    except Exception as e:
+        metrics.increment("image_derivatives_errors")
+        print(f"Failed to generate derivatives of {img_key}: {e}")
+
+
+def user_upload_prefix(user: str):
+    # Keys handed out to a user share a prefix, so a save can only reference that user's uploads
+    return f"uploads/{hashlib.sha256(user.encode()).hexdigest()[:16]}/"
+
+
+def create_diet_image_upload(user: str, content_type: str, content_length: int):
+    if content_type not in DIET_IMAGE_CONTENT_TYPES:
+        raise HTTPException(status_code=415, detail=f"Unsupported image type {content_type}")
+    if not 0 < content_length <= DIET_IMAGE_MAX_BYTES:
+        raise HTTPException(status_code=413, detail=f"Images must be between 1 and {DIET_IMAGE_MAX_BYTES} bytes")
+
+    img_key = f"{user_upload_prefix(user)}{uuid.uuid4().hex}.{DIET_IMAGE_CONTENT_TYPES[content_type]}"
+    try:
+        upload_url = storage.presigned_put(img_key, content_type, content_length)
+    except NotImplementedError as e:
+        raise HTTPException(status_code=501, detail=str(e))
+
+    return {
+        "img_key": img_key,
+        "upload_url": upload_url,
+        "method": "PUT",
+        "headers": {"Content-Type": content_type},  # Content-Length is set by the client from the body
+        "expires_in": S3_PRESIGN_EXPIRES_SECONDS
+    }
+
+
+async def verify_uploaded_image(user: str, img_key: str):
+    if not img_key.startswith(user_upload_prefix(user)):
+        raise HTTPException(status_code=403, detail="Image key does not belong to this user")
+
+    size = await asyncio.to_thread(storage.size, img_key)
+    if size is None:
+        raise HTTPException(status_code=400, detail="Image has not been uploaded")
+    if size > DIET_IMAGE_MAX_BYTES:
+        raise HTTPException(status_code=413, detail=f"Images must be between 1 and {DIET_IMAGE_MAX_BYTES} bytes")
+
+    return size
+
+
 # 5 Save Diet History into the Database
-def save_diet_history(user: str, meal: str, calories: int, protein: int, carbohydrates: int, fat: int
-                      ,db: Session, image_bytes: bytes = None):
+async def save_diet_history(user: str, meal: str, calories: int, protein: int, carbohydrates: int, fat: int
+                            ,db: AsyncSession, image_bytes: bytes = None, time_zone: str = DEFAULT_TIME_ZONE,
+                            img_key: str = None, image_sha256: str = None, image_staged: bool = False):
+    # The zone dates the meal in daily_intake, reject an unknown one before anything is written
+    if time_zone not in pytz.all_timezones_set:
+        raise HTTPException(status_code=400, detail=f"Unknown time zone {time_zone}")
 
     if image_bytes:
-        unique_id = str(uuid.uuid4())
-        hash_object = hashlib.sha256(image_bytes[:1024])
-        hash_prefix = hash_object.hexdigest()[:8]
-        filename = f"{unique_id}_{hash_prefix}"
-        img_url = upload_file_to_s3(filename, image_bytes)
-    # img_url = 'https://via.placeholder.com/150'
+        # The row is written with the content key now, img_url is filled in once the upload finishes
+        # (right away when stage_diet_image already stored it)
+        img_key = digest_key(image_sha256) if image_sha256 else content_key(image_bytes)
+        img_size = len(image_bytes)
+        if image_staged:
+            # Lock the staged image's row for this transaction. Without the row the sweeper already took it,
+            # and the photo is uploaded again like an unstaged one
+            staged = await db.execute(select(ImageObject.key).where(ImageObject.key == img_key).with_for_update())
+            image_staged = staged.first() is not None
+            if not image_staged:
+                metrics.increment("diet_image_staged_swept")
+        img_url = storage.url(img_key) if image_staged else None
+    elif img_key:
+        # Already uploaded by the client through a presigned URL
+        img_size = await verify_uploaded_image(user, img_key)
+        img_url = storage.url(img_key)
     else:
         img_url = None
 
@@ -298,19 +714,191 @@ def save_diet_history(user: str, meal: str, calories: int, protein: int, carbohy
         protein=protein,
         carbohydrates=carbohydrates,
         fat=fat,
+        img_key=img_key,
         img_url=img_url,
-        datetime=datetime.utcnow()
+        datetime=datetime.utcnow(),
+        time_zone=time_zone
     )
 
-    # Add the new entry to the session and commit it to the database
+    # Add the new entry, update the daily rollup, the image references and the data version in one transaction
     db.add(new_diet_entry)
-    db.commit()
-    db.refresh(new_diet_entry)  # Refresh to get the latest state of the new entry (e.g., auto-generated ID)
+    await db.execute(daily_intake_upsert(
+        db.get_bind().dialect.name,
+        user=user,
+        date=local_date(new_diet_entry.datetime, time_zone),
+        calories=calories,
+        protein=protein,
+        carbohydrates=carbohydrates,
+        fat=fat
+    ))
+    if img_key:
+        await db.execute(image_object_ref(db.get_bind().dialect.name, img_key, img_size))
+    await db.execute(bump_data_version(user))
+    await db.commit()
+    await db.refresh(new_diet_entry)  # Refresh to get the latest state of the new entry (e.g., auto-generated ID)
+
+    # The cached principal still carries the old data version
+    invalidate_cached_user(user)
+
+    if image_bytes and not image_staged:
+        upload_executor.submit(store_diet_image, new_diet_entry.id, user, img_key, image_bytes, time.perf_counter())
+    elif img_key:
+        upload_executor.submit(store_image_derivatives, user, img_key, image_bytes)
+
+    return new_diet_entry  # Optionally return the newly created entry
+
+
+def parse_import_entry(raw, time_zone: str):
+    # Validate one imported entry, raises ValueError with a message for the row
+    if not isinstance(raw, dict):
+        raise ValueError("Entry must be an object")
+
+    entry = {"meal": raw.get("meal") or "lunch"}
+    if not isinstance(entry["meal"], str) or len(entry["meal"]) > 45:
+        raise ValueError("meal must be a string of at most 45 characters")
+
+    for field in ("calories", "protein", "carbohydrates", "fat"):
+        value = raw.get(field)
+        try:
+            entry[field] = int(value)
+        except (TypeError, ValueError):
+            raise ValueError(f"{field} must be an integer")
+        if entry[field] < 0:
+            raise ValueError(f"{field} must not be negative")
+
+    # Timestamps without an offset are local times in the import's time zone
+    value = raw.get("datetime")
+    try:
+        meal_time = value if isinstance(value, datetime) else datetime.fromisoformat(str(value))
+    except ValueError:
+        raise ValueError("datetime must be an ISO 8601 timestamp")
+    if meal_time.tzinfo is None:
+        meal_time = pytz.timezone(time_zone).localize(meal_time)
+    entry["datetime"] = meal_time.astimezone(pytz.utc).replace(tzinfo=None)
 
-    return new_diet_entry, img_url  # Optionally return the newly created entry
+    entry["image_bytes"] = None
+    if raw.get("image"):
+        try:
+            entry["image_bytes"] = base64.b64decode(raw["image"], validate=True)
+        except (TypeError, ValueError):
+            raise ValueError("image must be base64 encoded")
 
+    return entry
 
-def get_diet_history_from_db(username: str, db: Session, filter_date: datetime.date = None):
+
+def parse_diet_csv(data):
+    # CSV with a header row: datetime,meal,calories,protein,carbohydrates,fat. Bytes or a memoryview
+    try:
+        text = str(data, "utf-8-sig")
+    except UnicodeDecodeError:
+        raise HTTPException(status_code=400, detail="CSV file must be UTF-8 encoded")
+    return [dict(row) for row in csv.DictReader(io.StringIO(text))]
+
+
+async def upload_import_images(entries, errors):
+    # Upload the batch's distinct images in parallel on the upload executor, a failed upload only drops its rows
+    loop = asyncio.get_running_loop()
+
+    images = {}
+    for _, entry in entries:
+        if entry["image_bytes"]:
+            entry["img_key"] = content_key(entry["image_bytes"])
+            images[entry["img_key"]] = entry["image_bytes"]
+
+    async def upload(img_key, image_bytes):
+        try:
+            img_url, uploaded = await loop.run_in_executor(upload_executor, save_if_absent, img_key, image_bytes)
+            if not uploaded:
+                metrics.increment("diet_image_dedup_hits")
+            return img_key, img_url
+        except Exception as e:
+            print(f"Image upload failed for {img_key}: {e}")
+            return img_key, None
+
+    img_urls = dict(await asyncio.gather(*(upload(img_key, data) for img_key, data in images.items())))
+
+    uploaded = []
+    for index, entry in entries:
+        if entry["image_bytes"]:
+            entry["img_url"] = img_urls[entry["img_key"]]
+            if entry["img_url"] is None:
+                errors.append({"row": index, "error": "Image upload failed"})
+                continue
+        uploaded.append((index, entry))
+    return uploaded
+
+
+async def import_diet_history(user: str, raw_entries: list, db: AsyncSession, time_zone: str = DEFAULT_TIME_ZONE):
+    if len(raw_entries) > DIET_IMPORT_MAX_ENTRIES:
+        raise HTTPException(status_code=413, detail=f"At most {DIET_IMPORT_MAX_ENTRIES} entries per import")
+    if time_zone not in pytz.all_timezones_set:
+        raise HTTPException(status_code=400, detail=f"Unknown time zone {time_zone}")
+
+    # Validate every row, invalid rows are reported instead of failing the batch
+    entries, errors = [], []
+    for index, raw in enumerate(raw_entries):
+        try:
+            entries.append((index, parse_import_entry(raw, time_zone)))
+        except ValueError as e:
+            errors.append({"row": index, "error": str(e)})
+
+    entries = await upload_import_images(entries, errors)
+
+    rows, daily_totals, image_refs = [], {}, {}
+    for _, entry in entries:
+        rows.append({
+            "user": user,
+            "meal": entry["meal"],
+            "calories": entry["calories"],
+            "protein": entry["protein"],
+            "carbohydrates": entry["carbohydrates"],
+            "fat": entry["fat"],
+            "datetime": entry["datetime"],
+            "time_zone": time_zone,
+            "img_key": entry.get("img_key"),
+            "img_url": entry.get("img_url")
+        })
+
+        # One rollup upsert per local day instead of one per meal
+        day = daily_totals.setdefault(local_date(entry["datetime"], time_zone), {
+            "calories": 0, "protein": 0, "carbohydrates": 0, "fat": 0, "meal_count": 0
+        })
+        for column in ("calories", "protein", "carbohydrates", "fat"):
+            day[column] += entry[column]
+        day["meal_count"] += 1
+
+        if entry.get("img_key"):
+            refs = image_refs.setdefault(entry["img_key"], {"refcount": 0, "size": len(entry["image_bytes"])})
+            refs["refcount"] += 1
+
+    if rows:
+        # executemany in chunks, all inside one transaction (no per-row refresh)
+        for i in range(0, len(rows), DIET_IMPORT_CHUNK_SIZE):
+            await db.execute(insert(Diet), rows[i:i + DIET_IMPORT_CHUNK_SIZE])
+        await db.execute(
+            daily_intake_upsert_statement(db.get_bind().dialect.name),
+            [{"user": user, "date": date, **totals} for date, totals in daily_totals.items()]
+        )
+        if image_refs:
+            await db.execute(
+                image_object_ref_statement(db.get_bind().dialect.name),
+                [{"key": key, "created_at": datetime.utcnow(), **refs} for key, refs in image_refs.items()]
+            )
+        await db.execute(bump_data_version(user))
+        await db.commit()
+
+        # The cached principal still carries the old data version
+        invalidate_cached_user(user)
+
+        # Derivatives of each distinct image, generated off the request path
+        for _, entry in entries:
+            if entry.get("img_key") and image_refs.pop(entry["img_key"], None):
+                upload_executor.submit(store_image_derivatives, user, entry["img_key"], entry["image_bytes"])
+
+    return {"imported": len(rows), "errors": sorted(errors, key=lambda error: error["row"])}
+
+
+def diet_history_query(username: str, filter_date: datetime.date = None):
     # Define the Taipei timezone
     taipei_tz = pytz.timezone('Asia/Taipei')
 
@@ -325,45 +913,290 @@ def get_diet_history_from_db(username: str, db: Session, filter_date: datetime.d
         end_of_day_utc = end_of_day_taipei.astimezone(pytz.utc)
 
         # Filter the entries between start and end of the day in UTC
-        history = db.query(Diet).filter(Diet.user == username,
-                                        Diet.datetime >= start_of_day_utc,
-                                        Diet.datetime <= end_of_day_utc).order_by(Diet.datetime.desc()).all()
+        return select(*DIET_HISTORY_COLUMNS).where(Diet.user == username,
+                                                   Diet.datetime >= start_of_day_utc,
+                                                   Diet.datetime <= end_of_day_utc)
+
+    # If no filter date is provided, fetch all entries
+    return select(*DIET_HISTORY_COLUMNS).where(Diet.user == username)
+
+
+def format_diet_history(history):
+    # Row tuples from DIET_HISTORY_COLUMNS map onto the response entries, the derivative set becomes its URLs
+    entries = []
+    for entry in history:
+        entry = entry._asdict()
+        entry["images"] = derivative_urls(entry.pop("img_set"))
+        entries.append(entry)
+    return entries
+
+
+async def similar_meals(user: str, image_bytes, db: AsyncSession, limit: int = 3):
+    # The user's earlier meals that look like this photo, most similar first, with their macros, so a
+    # repeated meal can be logged without a vision call
+    vector, index = await asyncio.gather(asyncio.to_thread(image_embedding, image_bytes), meal_indexes.get(user, db))
+    matches = index.search(vector, limit)
+    metrics.increment("meal_suggestions" if matches else "meal_suggestion_misses")
+    if not matches:
+        return []
+
+    # Rows deleted since the index was built simply drop out
+    rows = (await db.execute(
+        select(*DIET_HISTORY_COLUMNS).where(Diet.user == user, Diet.id.in_([entry_id for entry_id, _ in matches]))
+    )).all()
+    entries = {entry["id"]: entry for entry in format_diet_history(rows)}
+    return [{**entries[entry_id], "similarity": round(similarity, 3)}
+            for entry_id, similarity in matches if entry_id in entries]
+
+
+async def get_diet_history_from_db(username: str, db: AsyncSession, filter_date: datetime.date = None):
+    stmt = diet_history_query(username, filter_date)
+    history = (await db.execute(stmt.order_by(Diet.datetime.desc()))).all()
+
+    return format_diet_history(history)
+
+
+def encode_history_cursor(entry_datetime: datetime, entry_id: int):
+    # Opaque to clients, it only marks the last entry of the previous page
+    raw = f"{entry_datetime.isoformat()}|{entry_id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_history_cursor(cursor: str):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        entry_datetime, entry_id = raw.split("|")
+        return datetime.fromisoformat(entry_datetime), int(entry_id)
+    except (ValueError, UnicodeDecodeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+async def get_diet_history_page(username: str, db: AsyncSession, limit: int = DIET_HISTORY_PAGE_SIZE,
+                                cursor: str = None, filter_date: datetime.date = None):
+    stmt = diet_history_query(username, filter_date)
+
+    # Keyset pagination: continue strictly after the (datetime, id) of the previous page's last entry
+    if cursor:
+        cursor_datetime, cursor_id = decode_history_cursor(cursor)
+        stmt = stmt.where(or_(Diet.datetime < cursor_datetime,
+                              and_(Diet.datetime == cursor_datetime, Diet.id < cursor_id)))
+
+    # Fetch one extra row to know whether another page exists
+    stmt = stmt.order_by(Diet.datetime.desc(), Diet.id.desc()).limit(limit + 1)
+    history = (await db.execute(stmt)).all()
+
+    next_cursor = None
+    if len(history) > limit:
+        history = history[:limit]
+        next_cursor = encode_history_cursor(history[-1].datetime, history[-1].id)
+
+    return format_diet_history(history), next_cursor
+
+
+def utc_offset_segments(time_zone: str, start_utc: datetime, end_utc: datetime):
+    """Return [(segment_start_utc, offset_seconds), ...] covering start_utc..end_utc (naive UTC)."""
+    client_tz = pytz.timezone(time_zone)
+
+    def offset_at(utc_datetime):
+        return int(pytz.utc.localize(utc_datetime).astimezone(client_tz).utcoffset().total_seconds())
+
+    segments = [(start_utc, offset_at(start_utc))]
+    day_start_utc = start_utc
+    while day_start_utc < end_utc:
+        day_end_utc = min(day_start_utc + timedelta(days=1), end_utc)
+        if offset_at(day_end_utc) != segments[-1][1]:
+            # A DST transition happened during this day, find it to the second
+            low, high = day_start_utc, day_end_utc
+            while high - low > timedelta(seconds=1):
+                middle = low + timedelta(seconds=(high - low).total_seconds() // 2)
+                if offset_at(middle) == segments[-1][1]:
+                    low = middle
+                else:
+                    high = middle
+            segments.append((high, offset_at(high)))
+        day_start_utc = day_end_utc
+
+    return segments
+
+
+async def get_diet_summary(username: str, db: AsyncSession, start_date, end_date, time_zone: str, bucket: str):
+    client_tz = pytz.timezone(time_zone)
+
+    # The local date range [start_date, end_date] as naive UTC datetimes, like Diet.datetime
+    start_utc = client_tz.localize(datetime.combine(start_date, datetime.min.time())) \
+        .astimezone(pytz.utc).replace(tzinfo=None)
+    end_utc = client_tz.localize(datetime.combine(end_date + timedelta(days=1), datetime.min.time())) \
+        .astimezone(pytz.utc).replace(tzinfo=None)
+
+    # UTC offset of each entry, switching at every DST transition inside the range
+    segments = utc_offset_segments(time_zone, start_utc, end_utc)
+    if len(segments) == 1:
+        offset = segments[0][1]
     else:
-        # If no filter date is provided, fetch all entries
-        history = db.query(Diet).filter(Diet.user == username).order_by(Diet.datetime.desc()).all()
+        offset = case(
+            *[(Diet.datetime < segments[i + 1][0], segments[i][1]) for i in range(len(segments) - 1)],
+            else_=segments[-1][1]
+        )
+
+    # Totals per local day / week / month, grouped in the database
+    bucket_start = SUMMARY_BUCKETS[bucket](add_seconds(Diet.datetime, offset)).label("bucket")
+    stmt = select(
+        bucket_start,
+        func.sum(Diet.calories).label("calories"),
+        func.sum(Diet.protein).label("protein"),
+        func.sum(Diet.carbohydrates).label("carbohydrates"),
+        func.sum(Diet.fat).label("fat"),
+        func.count(Diet.id).label("meal_count")
+    ).where(
+        Diet.user == username,
+        Diet.datetime >= start_utc,
+        Diet.datetime < end_utc
+    ).group_by("bucket").order_by("bucket")
 
-    # Structure the response in the desired format
     result = []
-    for entry in history:
+    for row in await db.execute(stmt):
         result.append({
-            "datetime": entry.datetime,
-            "meal": entry.meal,
-            "calories": entry.calories,
-            "protein": entry.protein,
-            "carbohydrates": entry.carbohydrates,
-            "fat": entry.fat,
-            'img_url': entry.img_url
+            "start": row.bucket,
+            "calories": int(row.calories or 0),
+            "protein": int(row.protein or 0),
+            "carbohydrates": int(row.carbohydrates or 0),
+            "fat": int(row.fat or 0),
+            "meal_count": row.meal_count
         })
 
     return result
 
 
+async def stream_diet_history(username: str):
+    # Own session: the request's session is closed before a streaming response is sent
+    async with AsyncReadSessionLocal() as db:
+        stmt = select(*DIET_EXPORT_COLUMNS).where(Diet.user == username).order_by(Diet.datetime, Diet.id) \
+            .execution_options(yield_per=DIET_EXPORT_BATCH_SIZE)
+        result = await db.stream(stmt)  # Server-side cursor, rows arrive in partitions
+        async for partition in result.partitions():
+            yield partition
+
+
+async def export_diet_history_csv(username: str):
+    # Same columns as the CSV import, timestamps in UTC with an explicit offset
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow([column.key for column in DIET_EXPORT_COLUMNS])
+    yield buffer.getvalue().encode()
+
+    async for partition in stream_diet_history(username):
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows(
+            (entry.id, pytz.utc.localize(entry.datetime).isoformat(), entry.meal, entry.calories, entry.protein,
+             entry.carbohydrates, entry.fat, entry.img_url)
+            for entry in partition
+        )
+        yield buffer.getvalue().encode()
+
+
+class ParquetChunkSink(io.RawIOBase):
+    # Write-only file that hands the bytes written so far back to the response
+    def __init__(self):
+        super().__init__()
+        self.chunks = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+DIET_EXPORT_PARQUET_SCHEMA = pa.schema([
+    ("id", pa.int64()),
+    ("datetime", pa.timestamp("us", tz="UTC")),
+    ("meal", pa.string()),
+    ("calories", pa.int32()),
+    ("protein", pa.int32()),
+    ("carbohydrates", pa.int32()),
+    ("fat", pa.int32()),
+    ("img_url", pa.string()),
+]) if pa else None
+
+
+async def export_diet_history_parquet(username: str):
+    # One row group per cursor partition, each flushed to the client as soon as it is written
+    sink = ParquetChunkSink()
+    writer = pq.ParquetWriter(sink, DIET_EXPORT_PARQUET_SCHEMA, compression="zstd")
+    try:
+        async for partition in stream_diet_history(username):
+            columns = list(zip(*partition))
+            writer.write_table(pa.Table.from_arrays(
+                [pa.array(values, type=field.type) for values, field in zip(columns, DIET_EXPORT_PARQUET_SCHEMA)],
+                schema=DIET_EXPORT_PARQUET_SCHEMA
+            ))
+            yield sink.drain()
+    finally:
+        writer.close()
+    yield sink.drain()
+
+
+GEMINI_NUTRITION_COLUMNS = (("Calories", "calories"), ("Fat", "fat"), ("Protein", "protein"), ("Carbs", "carbohydrates"))
+
+
+def catalogue_nutrition(food: dict, servings: float):
+    # Catalogue values are per serving, in the Gemini response format. None when a value is missing,
+    # the model estimates the item instead of counting it as 0
+    if any(food[column] is None for _, column in GEMINI_NUTRITION_COLUMNS):
+        return None
+    return {name: round(food[column] * servings, 1) for name, column in GEMINI_NUTRITION_COLUMNS}
+
+
 def analysis_gemini(food_recognition):
     """Return the complete formatted output matching the required format"""
-    food_items = food_recognition.get_food_list_with_nutrition()
-    food_labels = [item["label"] for item in food_items]
-    bounding_boxes = food_recognition.get_bounding_boxes(food_labels)
-    
-    formatted_list = []
-    
-    for idx, food_item in enumerate(food_items):
+    # One labels/portions/boxes call, catalogue values for the labels the catalogue knows,
+    # and a nutrition call for the rest only
+    food_items = food_recognition.get_food_items()
+
+    formatted_list, unresolved = [], {}
+    for food_item in food_items:
+        servings = food_item.get("servings") or 1
         formatted_item = {
             "label": food_item["label"],
-            "bbox": bounding_boxes[food_item["label"]],
-            "nutrition": food_item["nutrition"]
+            "bbox": food_item.get("bbox"),  # The label model sometimes leaves it out
+            "servings": servings
         }
+
+        food = food_catalogue.resolve(food_item["label"])
+        nutrition = catalogue_nutrition(food, servings) if food else None
+        if nutrition:
+            formatted_item.update(nutrition=nutrition, source="catalogue", food_id=food["id"])
+        else:
+            unresolved.setdefault(food_item["label"], []).append(formatted_item)
         formatted_list.append(formatted_item)
 
+    unresolved_count = sum(len(items) for items in unresolved.values())
+    metrics.increment("gemini_labels_resolved", len(formatted_list) - unresolved_count)
+    if unresolved:
+        metrics.increment("gemini_labels_unresolved", unresolved_count)
+        # The answer is keyed by label, so a label seen several times is asked once for all of its servings
+        # and the estimate is shared out by each item's servings
+        servings = {label: sum(item["servings"] for item in items) for label, items in unresolved.items()}
+        nutrition = food_recognition.get_nutrition([{"label": label, "servings": servings[label]} for label in unresolved])
+        for label, items in unresolved.items():
+            estimate = nutrition.get(label, {})
+            for item in items:
+                share = item["servings"] / servings[label]
+                item.update(nutrition={name: round(estimate.get(name, 0) * share, 1) for name, _ in GEMINI_NUTRITION_COLUMNS},
+                            source="model")
+
     return {
         "pixel": list(food_recognition.pixel),
         "list": formatted_list
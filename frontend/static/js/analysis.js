@@ -398,6 +398,45 @@ document.getElementById('food-image').addEventListener('change', function () {
 });
 
 
+// Food autocomplete for manual input, picking a suggestion fills in its macros
+let foodSuggestions = [];
+let foodSearchTimer = null;
+
+document.getElementById('food-search').addEventListener('input', function () {
+    const query = this.value.trim();
+    const selected = foodSuggestions.find(food => food.food === this.value);
+    if (selected) {
+        document.getElementById('manual-protein').value = selected.protein ?? '';
+        document.getElementById('manual-carbohydrates').value = selected.carbohydrates ?? '';
+        document.getElementById('manual-fat').value = selected.fat ?? '';
+        return;
+    }
+
+    clearTimeout(foodSearchTimer);
+    if (!query) {
+        return;
+    }
+    foodSearchTimer = setTimeout(async () => {
+        try {
+            const response = await fetch(`${backendUrl}/search_food?q=${encodeURIComponent(query)}&limit=8`, {
+                headers: {
+                    'Authorization': `Bearer ${getJwtToken()}`,
+                },
+            });
+            if (!response.ok) {
+                return;
+            }
+            foodSuggestions = (await response.json()).foods;
+            document.getElementById('food-suggestions').innerHTML = foodSuggestions
+                .map(food => `<option value="${food.food.replace(/"/g, '&quot;')}">${food.calories ?? '?'} kcal</option>`)
+                .join('');
+        } catch (error) {
+            console.error('Error searching foods:', error);
+        }
+    }, 150);
+});
+
+
 // Handle 'Analyze' button click
 document.getElementById('food-upload-form').addEventListener('submit', async function (e) {
     e.preventDefault();
@@ -507,6 +546,35 @@ document.getElementById('food-upload-form').addEventListener('submit', async fun
 });
 
 
+// Upload the photo straight to storage through a presigned URL, returns the object key (or null on failure)
+async function uploadImageDirect(imageFile, jwtToken) {
+    try {
+        const response = await fetch(`${backendUrl}/create_image_upload`, {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json',
+                'Authorization': `Bearer ${jwtToken}`,
+            },
+            body: JSON.stringify({ content_type: imageFile.type, content_length: imageFile.size })
+        });
+        if (!response.ok) {
+            return null;
+        }
+        const upload = await response.json();
+
+        const uploadResponse = await fetch(upload.upload_url, {
+            method: upload.method,
+            headers: upload.headers,
+            body: imageFile
+        });
+        return uploadResponse.ok ? upload.img_key : null;
+    } catch (error) {
+        console.error('Direct upload failed, sending the image with the save instead:', error);
+        return null;
+    }
+}
+
+
 // Handle 'Save' button click
 document.getElementById('save-button').addEventListener('click', async function () {
     const saveButton = document.getElementById('save-button'); // Select the save button
@@ -525,19 +593,24 @@ document.getElementById('save-button').addEventListener('click', async function
     }
 
     const formData = new FormData();
+    const jwtToken = getJwtToken();
 
     // Check if image upload was used
     const imageFile = document.getElementById('food-image').files[0];
     if (imageFile) {
-        formData.append('food_img', imageFile);
+        const imgKey = await uploadImageDirect(imageFile, jwtToken);
+        if (imgKey) {
+            formData.append('img_key', imgKey);
+        } else {
+            formData.append('food_img', imageFile);
+        }
     }
 
     formData.append('calories', resultData.intake_current.calories);
     formData.append('protein', resultData.intake_current.protein);
     formData.append('carbohydrates', resultData.intake_current.carbohydrates);
     formData.append('fat', resultData.intake_current.fat);
-
-    const jwtToken = getJwtToken();
+    formData.append('time_zone', Intl.DateTimeFormat().resolvedOptions().timeZone);
 
     try {
         // Send the result data to the backend to save it in the diet history
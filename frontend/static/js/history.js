@@ -1,15 +1,29 @@
 const backendUrl = `http://${window.location.hostname}:8000`;
 
+const pageSize = 20;
+let loadedHistory = [];  // All entries fetched so far, newest first
+let nextCursor = null;
+
 document.addEventListener('DOMContentLoaded', function () {
-    // Fetch diet history when the page loads
+    // Fetch the first page of diet history when the page loads
     fetchDietHistory();
+
+    // Fetch the next page when the user asks for older meals
+    document.getElementById('load-more').addEventListener('click', function () {
+        fetchDietHistory(nextCursor);
+    });
 });
 
-async function fetchDietHistory() {
+async function fetchDietHistory(cursor = null) {
     const jwtToken = getJwtToken();
 
-    // Send GET request to fetch diet history
-    const response = await fetch(`${backendUrl}/get_diet_history`, {
+    const params = new URLSearchParams({ limit: pageSize });
+    if (cursor) {
+        params.append('cursor', cursor);
+    }
+
+    // Send GET request to fetch one page of diet history
+    const response = await fetch(`${backendUrl}/get_diet_history?${params}`, {
         method: 'GET',
         headers: {
             'Authorization': `Bearer ${jwtToken}`,
@@ -21,8 +35,13 @@ async function fetchDietHistory() {
     if (data.error) {
         console.error('Error fetching diet history:', data.error);
     } else {
-        renderDietHistory(data.diet_history);
+        loadedHistory = loadedHistory.concat(data.diet_history);
+        nextCursor = data.next_cursor;
+        renderDietHistory(loadedHistory);
     }
+
+    // Only offer older meals when the backend says there are more
+    document.getElementById('load-more').style.display = nextCursor ? 'inline-block' : 'none';
 }
 
 function renderDietHistory(history) {
@@ -76,7 +95,14 @@ function renderDietHistory(history) {
                                 <strong>Carbohydrates:</strong> ${meal.carbohydrates}g<br>
                                 <strong>Fat:</strong> ${meal.fat}g<br>
                             </div>
-                            ${meal.img_url ? `
+                            ${meal.images ? `
+                                <div class="meal-image">
+                                    <picture>
+                                        <source type="image/webp" srcset="${meal.images.card.webp}">
+                                        <img src="${meal.images.card.jpg}" alt="Meal Image" loading="lazy">
+                                    </picture>
+                                </div>
+                            ` : meal.img_url ? `
                                 <div class="meal-image">
                                     <img src="${meal.img_url}" alt="Meal Image">
                                 </div>
@@ -2,11 +2,16 @@ from fastapi import FastAPI, Request
 import uvicorn
 import json
 from line_utils import *
-from backend.utils.openai_api import img_analysis
-from backend.utils.util import save_diet_history, get_diet_history_from_db
-from backend.utils.db_session import get_db
+from backend.utils.util import save_diet_history, get_diet_history_page, get_daily_intake, stage_diet_image, estimate_nutrition, \
+    similar_meals
+from backend.utils.image_quality import check_image_quality
+from backend.utils.s3_api import upload_executor
+from backend.utils.food_catalogue import lifespan
+from backend.utils import metrics
+from backend.utils.db_session import AsyncSessionLocal, AsyncReadSessionLocal
 from datetime import datetime
 import os
+import time
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -17,9 +22,131 @@ CHANNEL_ACCESS_TOKEN = os.getenv("LINE_CHANNEL_ACCESS_TOKEN")
 LINE_CONTENT_ENDPOINT = "https://api-data.line.me/v2/bot/message/{message_id}/content"
 
 
-app = FastAPI()
+# The lifespan loads the food catalogue, which resolves the local classifier's labels
+app = FastAPI(lifespan=lifespan)
 nutrition_cache = {}
 history_cache = {}
+meal_photo_sets = {}  # user_id -> image set still arriving
+
+# Several photos of one meal are analyzed together in one vision request, with one reply and one save
+MEAL_PHOTO_WINDOW_SECONDS = int(os.getenv("MEAL_PHOTO_WINDOW_SECONDS", 60))  # A later photo within this joins the unsaved meal
+MEAL_PHOTO_SET_WAIT_SECONDS = 10  # Longest wait for the rest of an image set, in case an event is lost
+MEAL_PHOTO_MAX = 4
+
+
+async def reply_with_nutrition(user_id: str, reply_token: str, nutrition_info: dict, photos: list, image: bytes, staged):
+    nutrition_info['calories'] = nutrition_info['protein'] * 4 + nutrition_info['carbohydrates'] * 4 + nutrition_info['fat'] * 9
+    print(nutrition_info)
+
+    # Cache the user's nutrition data, the meal's photos and the normalized image until they save it
+    nutrition_cache[user_id] = {
+        **nutrition_info,
+        'photos': photos,
+        'at': time.monotonic(),
+        'image': image,
+        'staged': staged
+    }
+
+    # Start a timer to clear the cache after 10 seconds
+    asyncio.create_task(clear_cache_after_timeout(nutrition_cache, user_id, timeout=300))
+
+    reply_status = await reply_with_bubble_nutrition(reply_token, nutrition_info, photo_count=len(photos))
+    print(f"Reply with Flex Message sent: {reply_status}")
+
+
+async def analyze_meal_photos(user_id: str, reply_token: str, photos: list, image: bytes = None, staged=None):
+    if image is None:
+        # Normalize the first photo and start storing it before the analysis, so saving doesn't wait for it
+        image = await asyncio.to_thread(compress_image, photos[0])
+        image = await asyncio.to_thread(rotate_image_if_vertical, image)
+        staged = upload_executor.submit(stage_diet_image, image)
+
+    if len(photos) == 1:
+        # A photo like one of the user's earlier meals is offered as that meal first
+        try:
+            async with AsyncReadSessionLocal() as db:
+                suggestions = await similar_meals(user_id, image, db, limit=1)
+        except Exception as e:
+            print(f"Similar meal lookup failed: {e}")
+            suggestions = []
+
+        if suggestions:
+            nutrition_cache[user_id] = {
+                'suggestion': suggestions[0],
+                'photos': photos,
+                'image': image,
+                'staged': staged
+            }
+            asyncio.create_task(clear_cache_after_timeout(nutrition_cache, user_id, timeout=300))
+
+            reply_status = await reply_with_meal_suggestion(reply_token, suggestions[0])
+            print(f"Reply with meal suggestion sent: {reply_status}")
+            return
+
+    # One vision request for all of the meal's photos
+    nutrition_info = await asyncio.to_thread(estimate_nutrition, photos)
+    await reply_with_nutrition(user_id, reply_token, nutrition_info, photos, image, staged)
+
+
+async def collect_image_set(user_id: str, reply_token: str, image_set: dict, image_bytes: bytes):
+    quality_issue = await asyncio.to_thread(check_image_quality, image_bytes) if image_bytes else "unreadable"
+
+    # The set's state is read and updated without awaiting in between, so concurrent events of a set
+    # (or of the next set) never work on a stale copy
+    collected = meal_photo_sets.get(user_id)
+    previous = None
+    if collected is not None and collected['id'] != image_set['id']:
+        previous, collected = collected, None  # A new set started before the last one completed
+    if collected is None:
+        collected = meal_photo_sets[user_id] = {
+            'id': image_set['id'], 'total': image_set['total'], 'received': 0, 'photos': [], 'issue': None,
+            'timer': None, 'flushed': False
+        }
+
+    collected['received'] += 1
+    collected['reply_token'] = reply_token  # The latest event's token answers for the whole set
+    if quality_issue:
+        collected['issue'] = quality_issue
+    else:
+        collected['photos'].append((image_set.get('index', collected['received']), image_bytes))
+
+    complete = collected['received'] >= collected['total']
+    if collected['timer']:
+        collected['timer'].cancel()
+        collected['timer'] = None
+    if not complete:
+        collected['timer'] = asyncio.create_task(flush_image_set_later(user_id, collected))
+
+    if previous is not None:
+        await flush_image_set(user_id, previous)
+    if complete:
+        await flush_image_set(user_id, collected)
+
+
+async def flush_image_set_later(user_id: str, collected: dict):
+    await asyncio.sleep(MEAL_PHOTO_SET_WAIT_SECONDS)
+    await flush_image_set(user_id, collected)
+
+
+async def flush_image_set(user_id: str, collected: dict):
+    # Runs once per set, for whichever comes first: its last photo, its wait timer or the next set
+    if collected['flushed']:
+        return
+    collected['flushed'] = True
+    timer = collected['timer']
+    if timer is not None and timer is not asyncio.current_task():
+        timer.cancel()
+    if meal_photo_sets.get(user_id) is collected:
+        del meal_photo_sets[user_id]
+    metrics.increment("line_meal_photo_sets")
+
+    photos = [photo for _, photo in sorted(collected['photos'], key=lambda photo: photo[0])][:MEAL_PHOTO_MAX]
+    if not photos:
+        # Every photo of the set was rejected
+        reply_status = await reply_with_message(collected['reply_token'], QUALITY_REPLIES[collected['issue']])
+        print(f"Rejected image set ({collected['issue']}), reply status: {reply_status}")
+        return
+    await analyze_meal_photos(user_id, collected['reply_token'], photos)
 
 
 @app.post("/webhook")
@@ -29,154 +156,199 @@ async def receive_message(request: Request):
     print(f'datetime: {datetime.now()}')
     print(json.dumps(body, indent=4))
 
+    # A webhook can carry several events, e.g. photos sent together
+    for event in body.get("events", []):
+        await handle_event(event)
+
+    return {"status": "ok"}
+
+
+async def handle_event(event: dict):
     # Check if it's a message or postback event
-    if "events" in body and len(body["events"]) > 0:
-        event = body["events"][0]
-        user_id = event['source']['userId']
-        reply_token = event["replyToken"]
-
-        # Check if the event is 'follow' (user added the bot) or 'join' (bot joined a group)
-        # if event["type"] == "follow" or event["type"] == "join":
-        #     reply_message = "Hello"
-        #     reply_status = await reply_with_message(reply_token, reply_message)
-        #     print(f"Welcome message sent: {reply_status}")
-        #     return {"status": "ok"}
-
-        # Handle postback action
-        if event["type"] == "postback":
-            postback_data = event["postback"]["data"]
-
-            # If the postback data is for cancel, do nothing
-            if postback_data == "action=cancel":
-                print("User canceled the action.")
+    user_id = event['source']['userId']
+    reply_token = event["replyToken"]
+
+    # Check if the event is 'follow' (user added the bot) or 'join' (bot joined a group)
+    # if event["type"] == "follow" or event["type"] == "join":
+    #     reply_message = "Hello"
+    #     reply_status = await reply_with_message(reply_token, reply_message)
+    #     print(f"Welcome message sent: {reply_status}")
+    #     return {"status": "ok"}
+
+    # Handle postback action
+    if event["type"] == "postback":
+        postback_data = event["postback"]["data"]
+
+        # If the postback data is for cancel, do nothing
+        if postback_data == "action=cancel":
+            print("User canceled the action.")
+            return {"status": "ok"}
+
+        # Check if the postback data is for triggering the camera
+        if postback_data == "action=trigger_camera":
+            # Send Quick Reply with camera action
+            reply_status = await reply_with_camera_quick_reply(reply_token)
+            print(f"Quick Reply with camera sent: {reply_status}")
+            return {"status": "ok"}
+
+        # The user answered whether the photo is the same as the suggested earlier meal
+        if postback_data == "action=accept_suggestion" or postback_data == "action=reject_suggestion":
+            pending = nutrition_cache.get(user_id)
+            if not pending or 'suggestion' not in pending:
+                reply_status = await reply_with_message(reply_token, "請重傳圖片")
+                print(f"Reply status: {reply_status}")
                 return {"status": "ok"}
 
-            # Check if the postback data is for triggering the camera
-            if postback_data == "action=trigger_camera":
-                # Send Quick Reply with camera action
-                reply_status = await reply_with_camera_quick_reply(reply_token)
-                print(f"Quick Reply with camera sent: {reply_status}")
-                return {"status": "ok"}
+            await start_loading_animation(chat_id=user_id)
+            if postback_data == "action=accept_suggestion":
+                # The earlier meal's macros, no analysis needed
+                suggestion = pending['suggestion']
+                nutrition_info = {column: suggestion[column] or 0 for column in ('protein', 'carbohydrates', 'fat')}
+                metrics.increment("line_meal_suggestions_accepted")
+            else:
+                nutrition_info = await asyncio.to_thread(estimate_nutrition, pending['photos'])
+                metrics.increment("line_meal_suggestions_rejected")
+
+            await reply_with_nutrition(user_id, reply_token, nutrition_info, pending['photos'], pending['image'],
+                                       pending['staged'])
+            return {"status": "ok"}
 
-            # Check if the postback is for saving the data
-            if postback_data == "action=save":
-                await start_loading_animation(chat_id=user_id)
-                if user_id in nutrition_cache:
-                    # Save the data from cache using the save_diet_history function
-                    user = nutrition_cache[user_id]
-                    rotated_img = rotate_image_if_vertical(user['image'])
-                    saved_history = save_diet_history(
+        # Check if the postback is for saving the data
+        if postback_data == "action=save":
+            await start_loading_animation(chat_id=user_id)
+            # A pending meal suggestion has no nutrition to save yet
+            if 'calories' in nutrition_cache.get(user_id, {}):
+                # Save the data from cache using the save_diet_history function
+                user = nutrition_cache[user_id]
+
+                # Usually the image was stored while the user was deciding, then saving only links it
+                staged = user['staged']
+                image_staged = staged.done() and staged.exception() is None
+                metrics.increment("line_image_staged_hits" if image_staged else "line_image_staged_misses")
+
+                async with AsyncSessionLocal() as db:
+                    saved_history = await save_diet_history(
                         user=user_id,
                         meal='lunch',  # You can dynamically set meal info
                         calories=user['calories'],
                         protein=user['protein'],
                         carbohydrates=user['carbohydrates'],
                         fat=user['fat'],
-                        image_bytes=rotated_img,  # Save the cached image
-                        db=next(get_db()),  # Assume db session is managed
+                        image_bytes=user['image'],  # Save the cached image
+                        image_staged=image_staged,
+                        db=db,
                     )
 
-                    if saved_history:
-                        # Clear the user's cache after saving
-                        del nutrition_cache[user_id]
-                        reply_message = f"$ 記錄成功" #"\n$ 到【每餐】或【報告】查看"
-                        emoji = [
-                            {
-                                "index": 0,
-                                "productId": "5ac22b23040ab15980c9b44d",
-                                "emojiId": "070"
-                            },
-                            # {
-                            #     "index": 7,
-                            #     "productId": "5ac21e6c040ab15980c9b444",
-                            #     "emojiId": "020"
-                            # },
-                        ]
-                        reply_status = await reply_with_message(reply_token, reply_message, emoji)
-                        print(f"Reply status: {reply_status}")
-                        return {"status": "ok"}
-                    else:
-                        return {"error": "Failed to save diet history"}
-                else:
-                    # Cache expired, inform the user
-                    reply_message = "請重傳圖片"
-                    reply_status = await reply_with_message(reply_token, reply_message)
+                if saved_history:
+                    # Clear the user's cache after saving
+                    del nutrition_cache[user_id]
+                    reply_message = f"$ 記錄成功" #"\n$ 到【每餐】或【報告】查看"
+                    emoji = [
+                        {
+                            "index": 0,
+                            "productId": "5ac22b23040ab15980c9b44d",
+                            "emojiId": "070"
+                        },
+                        # {
+                        #     "index": 7,
+                        #     "productId": "5ac21e6c040ab15980c9b444",
+                        #     "emojiId": "020"
+                        # },
+                    ]
+                    reply_status = await reply_with_message(reply_token, reply_message, emoji)
                     print(f"Reply status: {reply_status}")
                     return {"status": "ok"}
-
-            if postback_data == "action=selected_datetime_details" or postback_data == "action=selected_datetime_overview":
-                await start_loading_animation(chat_id=user_id)
-
-                selected_date_str = event["postback"]["params"]["date"]
-                selected_date = datetime.strptime(selected_date_str, "%Y-%m-%d").date()
-
-                history_type = postback_data[25:]
-                diet_history = get_diet_history_from_db(username=user_id, db=next(get_db()), filter_date=selected_date)
-
-                if not diet_history:
-                    reply_message = "找不到紀錄"
-                    reply_status = await reply_with_message(reply_token, reply_message)
-                    print(f"Reply status: {reply_status}")
-                    return {"status": "ok"}
-
-                if history_type == 'details':
-                    reply_status = await reply_with_carousel_history(reply_token, diet_history)
                 else:
-                    reply_status = await reply_with_overview_history(reply_token, diet_history)
-                print(f"Reply status: {reply_status}")
-                return {"status": "ok"}
-
-            if postback_data == "action=view_details" or postback_data == "action=view_overview":
-                history_type = postback_data[12:]
-                reply_status = await reply_with_datetime_picker_quick_reply(reply_token, history_type)
+                    return {"error": "Failed to save diet history"}
+            else:
+                # Cache expired, inform the user
+                reply_message = "請重傳圖片"
+                reply_status = await reply_with_message(reply_token, reply_message)
                 print(f"Reply status: {reply_status}")
                 return {"status": "ok"}
 
-        # Handle image message
-        if "message" in event and event["message"]["type"] == "image":
+        if postback_data == "action=selected_datetime_details" or postback_data == "action=selected_datetime_overview":
             await start_loading_animation(chat_id=user_id)
 
-            message_id = event["message"]["id"]
-
-            # Download the image from LINE's server
-            image_bytes = await download_image(message_id)
-
-            if image_bytes:
-                nutrition_info = img_analysis(image_bytes)
-                nutrition_info['calories'] = nutrition_info['protein'] * 4 + nutrition_info['carbohydrates'] * 4 + nutrition_info['fat'] * 9
-                print(nutrition_info)
-
-                compressed_image = compress_image(image_bytes)
-                # Cache the user's nutrition data and compressed image
-                nutrition_cache[user_id] = {
-                    **nutrition_info,
-                    'image': compressed_image
-                }
-
-                # Start a timer to clear the cache after 10 seconds
-                asyncio.create_task(clear_cache_after_timeout(nutrition_cache, user_id, timeout=300))
+            selected_date_str = event["postback"]["params"]["date"]
+            selected_date = datetime.strptime(selected_date_str, "%Y-%m-%d").date()
 
-                reply_status = await reply_with_bubble_nutrition(reply_token, nutrition_info)
-                print(f"Reply with Flex Message sent: {reply_status}")
-                return {"status": "ok"}
+            history_type = postback_data[25:]
+            async with AsyncReadSessionLocal() as db:
+                # The carousel and overview show at most 10 meals, don't load more than that
+                diet_history, _ = await get_diet_history_page(username=user_id, db=db, limit=10,
+                                                              filter_date=selected_date)
 
-            else:
-                reply_message = "Sorry, I couldn't process the image."
+            if not diet_history:
+                reply_message = "找不到紀錄"
                 reply_status = await reply_with_message(reply_token, reply_message)
                 print(f"Reply status: {reply_status}")
                 return {"status": "ok"}
 
-        # Handle text message (echo the message)
-        if "message" in event and event["message"]["type"] == "text":
-            # user_message = event["message"]["text"]
-            reply_message = '不支援文字對話模式'
-            print(f"Received message: {reply_message}")
+            if history_type == 'details':
+                reply_status = await reply_with_carousel_history(reply_token, diet_history)
+            else:
+                async with AsyncReadSessionLocal() as db:
+                    daily_totals = await get_daily_intake(user_id, db, selected_date)
+                reply_status = await reply_with_overview_history(reply_token, diet_history, daily_totals)
+            print(f"Reply status: {reply_status}")
+            return {"status": "ok"}
 
-            # Reply to the user with the same message
+        if postback_data == "action=view_details" or postback_data == "action=view_overview":
+            history_type = postback_data[12:]
+            reply_status = await reply_with_datetime_picker_quick_reply(reply_token, history_type)
+            print(f"Reply status: {reply_status}")
+            return {"status": "ok"}
+
+    # Handle image message
+    if "message" in event and event["message"]["type"] == "image":
+        await start_loading_animation(chat_id=user_id)
+
+        message_id = event["message"]["id"]
+
+        # Download the image from LINE's server
+        image_bytes = await download_image(message_id)
+
+        # Photos sent together arrive as separate events, the meal is analyzed once the whole set is in
+        image_set = event["message"].get("imageSet")
+        if image_set:
+            await collect_image_set(user_id, reply_token, image_set, image_bytes)
+            return {"status": "ok"}
+
+        # Blurry, dark or empty photos get a retake hint instead of a vision call
+        quality_issue = await asyncio.to_thread(check_image_quality, image_bytes) if image_bytes else None
+        if quality_issue:
+            reply_status = await reply_with_message(reply_token, QUALITY_REPLIES[quality_issue])
+            print(f"Rejected photo ({quality_issue}), reply status: {reply_status}")
+            return {"status": "ok"}
+
+        if image_bytes:
+            pending = nutrition_cache.get(user_id)
+            if (pending and 'calories' in pending and len(pending['photos']) < MEAL_PHOTO_MAX
+                    and time.monotonic() - pending['at'] < MEAL_PHOTO_WINDOW_SECONDS):
+                # Another photo of the meal that is not saved yet, the meal is analyzed again with all its photos
+                metrics.increment("line_meal_photo_followups")
+                await analyze_meal_photos(user_id, reply_token, pending['photos'] + [image_bytes],
+                                          pending['image'], pending['staged'])
+            else:
+                await analyze_meal_photos(user_id, reply_token, [image_bytes])
+            return {"status": "ok"}
+
+        else:
+            reply_message = "Sorry, I couldn't process the image."
             reply_status = await reply_with_message(reply_token, reply_message)
             print(f"Reply status: {reply_status}")
+            return {"status": "ok"}
 
-    return {"status": "ok"}
+    # Handle text message (echo the message)
+    if "message" in event and event["message"]["type"] == "text":
+        # user_message = event["message"]["text"]
+        reply_message = '不支援文字對話模式'
+        print(f"Received message: {reply_message}")
+
+        # Reply to the user with the same message
+        reply_status = await reply_with_message(reply_token, reply_message)
+        print(f"Reply status: {reply_status}")
 
 
 # Add this block to run the app when the script is executed directly
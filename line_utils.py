@@ -13,6 +13,17 @@ LINE_REPLY_ENDPOINT = "https://api.line.me/v2/bot/message/reply"
 CHANNEL_ACCESS_TOKEN = os.getenv("LINE_CHANNEL_ACCESS_TOKEN")
 LINE_CONTENT_ENDPOINT = "https://api-data.line.me/v2/bot/message/{message_id}/content"
 
+WEEKDAYS = ["一", "二", "三", "四", "五", "六", "日"]  # Monday first, like datetime.weekday()
+
+# Replies for photos rejected by the image quality check, before any vision call
+QUALITY_REPLIES = {
+    "unreadable": "無法讀取圖片，請重新傳送照片",
+    "empty": "照片中找不到食物，請拍攝您的餐點",
+    "dark": "照片太暗，請在光線充足處重拍",
+    "bright": "照片過度曝光，請避開強光重拍",
+    "blurry": "照片太模糊，請保持相機穩定後重拍",
+}
+
 
 # Function to compress the image to meet minimum resolution
 def compress_image(image_bytes, max_size=(600, 400)):
@@ -103,7 +114,7 @@ async def start_loading_animation(chat_id: str, loading_seconds: int = 20):
 
 
 # Function to reply to the user with a Flex Message in receipt layout
-async def reply_with_bubble_nutrition(reply_token: str, nutrition_info: dict):
+async def reply_with_bubble_nutrition(reply_token: str, nutrition_info: dict, photo_count: int = 1):
     headers = {
         "Content-Type": "application/json",
         "Authorization": f"Bearer {CHANNEL_ACCESS_TOKEN}"
@@ -260,11 +271,110 @@ async def reply_with_bubble_nutrition(reply_token: str, nutrition_info: dict):
         ]
     }
 
+    if photo_count > 1:
+        # Several photos of one meal were analyzed together
+        payload["messages"][0]["contents"]["body"]["contents"].insert(1, {
+            "type": "text",
+            "text": f"{photo_count} 張照片合併分析",
+            "size": "xs",
+            "color": "#aaaaaa",
+            "align": "center"
+        })
+
     async with httpx.AsyncClient() as client:
         response = await client.post(LINE_REPLY_ENDPOINT, json=payload, headers=headers)
         return response.status_code
 
 
+# Function to ask whether a photo is the same meal as an earlier one (skips the analysis when it is)
+async def reply_with_meal_suggestion(reply_token: str, entry: dict):
+    headers = {
+        "Content-Type": "application/json",
+        "Authorization": f"Bearer {CHANNEL_ACCESS_TOKEN}"
+    }
+    local_time = entry['datetime'].replace(tzinfo=pytz.utc).astimezone(pytz.timezone('Asia/Taipei'))
+    when = f"{local_time:%m/%d} ({WEEKDAYS[local_time.weekday()]}) {local_time:%H:%M}"
+
+    payload = {
+        "replyToken": reply_token,
+        "messages": [
+            {
+                "type": "flex",
+                "altText": "和之前的餐點一樣嗎？",
+                "contents": {
+                    "type": "bubble",
+                    "size": "kilo",
+                    "hero": {
+                        "type": "image",
+                        "url": entry_image_url(entry, "card", "https://via.placeholder.com/400"),
+                        "size": "full",
+                        "aspectRatio": "4:3",
+                        "aspectMode": "cover",
+                    },
+                    "body": {
+                        "type": "box",
+                        "layout": "vertical",
+                        "spacing": "sm",
+                        "contents": [
+                            {
+                                "type": "text",
+                                "text": f"跟 {when} 那餐一樣嗎？",
+                                "weight": "bold",
+                                "size": "md",
+                                "wrap": True
+                            },
+                            {
+                                "type": "text",
+                                "text": f"熱量 {entry['calories']} 大卡｜蛋白質 {entry['protein']}g｜碳水 {entry['carbohydrates']}g｜脂肪 {entry['fat']}g",
+                                "size": "xs",
+                                "color": "#aaaaaa",
+                                "wrap": True
+                            }
+                        ]
+                    },
+                    "footer": {
+                        "type": "box",
+                        "layout": "horizontal",
+                        "spacing": "sm",
+                        "contents": [
+                            {
+                                "type": "button",
+                                "style": "primary",
+                                "color": "#27ACB2",
+                                "action": {
+                                    "type": "postback",
+                                    "label": "一樣",
+                                    "data": "action=accept_suggestion"
+                                }
+                            },
+                            {
+                                "type": "button",
+                                "style": "secondary",
+                                "action": {
+                                    "type": "postback",
+                                    "label": "重新分析",
+                                    "data": "action=reject_suggestion"
+                                }
+                            }
+                        ]
+                    }
+                }
+            }
+        ]
+    }
+
+    async with httpx.AsyncClient() as client:
+        response = await client.post(LINE_REPLY_ENDPOINT, json=payload, headers=headers)
+        return response.status_code
+
+
+def entry_image_url(entry: dict, size: str, placeholder: str):
+    # Resized JPEG derivative when it exists (LINE only shows JPEG and PNG), then the original, then the placeholder
+    if entry.get('images'):
+        return entry['images'][size]['jpg']
+    return entry['img_url'] if entry.get('img_url') else placeholder
+
+
 # Function to reply with the carousel view history
 async def reply_with_carousel_history(reply_token: str, diet_history: list):
     headers = {
@@ -285,7 +395,7 @@ async def reply_with_carousel_history(reply_token: str, diet_history: list):
             "size": "kilo",
             "hero": {
                 "type": "image",
-                "url": entry['img_url'] if entry.get('img_url') else "https://via.placeholder.com/400",
+                "url": entry_image_url(entry, "card", "https://via.placeholder.com/400"),
                 # Fallback if no image URL
                 "size": "full",
                 "aspectRatio": "4:3",  # Matches the aspect ratio in the example
@@ -428,7 +538,7 @@ async def reply_with_carousel_history(reply_token: str, diet_history: list):
         return response.status_code
 
 
-async def reply_with_overview_history(reply_token: str, diet_history: list):
+async def reply_with_overview_history(reply_token: str, diet_history: list, daily_totals: dict):
     headers = {
         "Content-Type": "application/json",
         "Authorization": f"Bearer {CHANNEL_ACCESS_TOKEN}"
@@ -442,21 +552,9 @@ async def reply_with_overview_history(reply_token: str, diet_history: list):
     diet_history = diet_history[:10]
     diet_history = diet_history[::-1]
 
-    # Initialize the total values
-    total_protein = 0
-    total_carbohydrates = 0
-    total_fat = 0
-    total_calories = 0
-
     # Create a formatted summary for each meal entry
     meal_entries = []
     for entry in diet_history:
-        # Add the current entry's values to the total
-        total_protein += entry['protein']
-        total_carbohydrates += entry['carbohydrates']
-        total_fat += entry['fat']
-        total_calories += entry['calories']
-
         # Add each meal as a row in the report
         meal_entries.append({
             "type": "box",
@@ -464,7 +562,7 @@ async def reply_with_overview_history(reply_token: str, diet_history: list):
             "contents": [
                 {
                     "type": "image",
-                    "url": entry['img_url'] if entry.get('img_url') else "https://via.placeholder.com/100",
+                    "url": entry_image_url(entry, "thumb", "https://via.placeholder.com/100"),
                     "size": "xxs",
                     "aspectMode": "cover",
                     "aspectRatio": "1:1"
@@ -511,7 +609,7 @@ async def reply_with_overview_history(reply_token: str, diet_history: list):
         "margin": "md"
     })
 
-    # Add the totals row at the end
+    # Add the totals row at the end (from the daily_intake rollup, covers every meal of the day)
     meal_entries.append({
         "type": "box",
         "layout": "horizontal",
@@ -526,7 +624,7 @@ async def reply_with_overview_history(reply_token: str, diet_history: list):
             },
             {
                 "type": "text",
-                "text": f"{total_protein}",
+                "text": f"{daily_totals['protein']}",
                 "size": "sm",
                 "flex": 1,
                 "align": "center",
@@ -534,7 +632,7 @@ async def reply_with_overview_history(reply_token: str, diet_history: list):
             },
             {
                 "type": "text",
-                "text": f"{total_carbohydrates}",
+                "text": f"{daily_totals['carbohydrates']}",
                 "size": "sm",
                 "flex": 1,
                 "align": "center",
@@ -542,7 +640,7 @@ async def reply_with_overview_history(reply_token: str, diet_history: list):
             },
             {
                 "type": "text",
-                "text": f"{total_fat}",
+                "text": f"{daily_totals['fat']}",
                 "size": "sm",
                 "flex": 1,
                 "align": "center",
@@ -550,7 +648,7 @@ async def reply_with_overview_history(reply_token: str, diet_history: list):
             },
             {
                 "type": "text",
-                "text": f"{total_calories}",
+                "text": f"{daily_totals['calories']}",
                 "size": "sm",
                 "flex": 1,
                 "align": "center",